@@ -0,0 +1,238 @@
+import hashlib
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, Optional
+
+import librosa
+import numpy as np
+
+from database_handler import Database, Table
+from http_client import HttpClient, RequestScheduler
+from logger import LoggerWrapper
+
+PREVIEW_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'preview_cache')
+
+N_MFCC = 20
+N_CHROMA = 12
+N_CONTRAST_BANDS = 7
+
+# Layout of the float32 feature vector saved per track
+FEATURE_NAMES = (
+    [f'mfcc_mean_{i}' for i in range(N_MFCC)]
+    + [f'mfcc_std_{i}' for i in range(N_MFCC)]
+    + [f'chroma_mean_{i}' for i in range(N_CHROMA)]
+    + [f'chroma_std_{i}' for i in range(N_CHROMA)]
+    + [f'spectral_contrast_mean_{i}' for i in range(N_CONTRAST_BANDS)]
+    + ['spectral_centroid_mean', 'spectral_centroid_std',
+       'spectral_bandwidth_mean', 'spectral_bandwidth_std',
+       'spectral_rolloff_mean', 'spectral_rolloff_std',
+       'zero_crossing_rate_mean', 'zero_crossing_rate_std',
+       'rms_mean', 'rms_std',
+       'tempo']
+)
+
+log = LoggerWrapper()
+
+
+def _cache_file_path(content_hash: str, cache_path: str = PREVIEW_CACHE_PATH) -> str:
+    """
+    Return the path of a preview in the content addressed cache, sharded by the first two characters of the hash.
+
+    Args:
+        content_hash (str): The sha256 hex digest of the preview file
+        cache_path (str): The root folder of the cache
+
+    Returns:
+        str: The path of the cached file
+    """
+    return os.path.join(cache_path, content_hash[:2], f'{content_hash}.mp3')
+
+
+def download_preview(client: HttpClient, preview_url: str, cache_path: str = PREVIEW_CACHE_PATH) -> str:
+    """
+    Download a preview into the content addressed cache.
+    The file is streamed into a temporary file while hashing it and then moved to the path of its hash,
+    so identical previews of different tracks are stored once and an interrupted download never leaves a partial file.
+
+    Args:
+        client (HttpClient): The client used to download the preview
+        preview_url (str): The URL of the preview
+        cache_path (str): The root folder of the cache
+
+    Returns:
+        str: The sha256 hex digest of the preview file
+    """
+    Path(cache_path).mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+
+    file_descriptor, temp_path = tempfile.mkstemp(dir=cache_path, suffix='.part')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as file, client.get(preview_url, stream=True) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(65536):
+                digest.update(chunk)
+                file.write(chunk)
+
+        content_hash = digest.hexdigest()
+        file_path = _cache_file_path(content_hash, cache_path)
+        Path(os.path.dirname(file_path)).mkdir(parents=True, exist_ok=True)
+        os.replace(temp_path, file_path)
+        return content_hash
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def extract_features(file_path: str) -> bytes:
+    """
+    Extract the librosa features of a preview file. Executed inside the worker processes of the pipeline.
+
+    Args:
+        file_path (str): The path of the preview file
+
+    Returns:
+        bytes: The float32 feature vector laid out as FEATURE_NAMES
+    """
+    y, sr = librosa.load(file_path, sr=22050, mono=True)
+
+    mfcc = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=N_MFCC)
+    chroma = librosa.feature.chroma_stft(y=y, sr=sr, n_chroma=N_CHROMA)
+    contrast = librosa.feature.spectral_contrast(y=y, sr=sr, n_bands=N_CONTRAST_BANDS - 1)
+    centroid = librosa.feature.spectral_centroid(y=y, sr=sr)
+    bandwidth = librosa.feature.spectral_bandwidth(y=y, sr=sr)
+    rolloff = librosa.feature.spectral_rolloff(y=y, sr=sr)
+    zero_crossing_rate = librosa.feature.zero_crossing_rate(y)
+    rms = librosa.feature.rms(y=y)
+    tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
+
+    features = np.concatenate([
+        mfcc.mean(axis=1), mfcc.std(axis=1),
+        chroma.mean(axis=1), chroma.std(axis=1),
+        contrast.mean(axis=1),
+        [centroid.mean(), centroid.std(),
+         bandwidth.mean(), bandwidth.std(),
+         rolloff.mean(), rolloff.std(),
+         zero_crossing_rate.mean(), zero_crossing_rate.std(),
+         rms.mean(), rms.std(),
+         float(np.atleast_1d(tempo)[0])],
+    ]).astype(np.float32)
+
+    return features.tobytes()
+
+
+def _resolve_content_hashes(db: Database, client: HttpClient, preview_urls: list, download_workers: int, cache_path: str) -> dict:
+    """
+    Return the content hash of every preview URL, downloading only previews which are not in the cache yet.
+
+    Returns:
+        dict: Mapping of preview URL to content hash, failed downloads are left out
+    """
+    content_hashes = {
+        preview_url: content_hash
+        for preview_url, content_hash in db.read_rows_by_ids(Table.PREVIEW_FILE, 'preview_url', preview_urls, 'preview_url, content_hash')
+        if os.path.exists(_cache_file_path(content_hash, cache_path))
+    }
+    missing_urls = [preview_url for preview_url in preview_urls if preview_url not in content_hashes]
+
+    def download(preview_url: str) -> Optional[str]:
+        try:
+            return download_preview(client, preview_url, cache_path)
+        except Exception as e:
+            log.error(f"Failed to download preview {preview_url}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=download_workers) as executor:
+        downloaded = dict(zip(missing_urls, executor.map(download, missing_urls)))
+
+    downloaded = {preview_url: content_hash for preview_url, content_hash in downloaded.items() if content_hash}
+    db.add_rows(Table.PREVIEW_FILE, downloaded.items(), ignore_duplicates=True)
+    content_hashes.update(downloaded)
+    return content_hashes
+
+
+def extract_audio_features(db: Database, workers: Optional[int] = None, download_workers: int = 16, chunk_size: int = 256,
+                           cache_path: str = PREVIEW_CACHE_PATH, client: Optional[HttpClient] = None) -> int:
+    """
+    Download the previews of all tracks with a resolved preview URL and without features yet, and extract their features.
+    Tracks are processed in chunks which are committed one by one, so the pipeline can be interrupted and resumed,
+    and each run only processes tracks added since the last one. Tracks without a preview are saved without features.
+
+    Args:
+        db (Database): The database holding the preview_url and audio_features tables
+        workers (Optional[int]): Number of processes extracting features, by default the number of CPUs
+        download_workers (int): Maximal number of previews downloaded at once
+        chunk_size (int): Number of tracks processed and committed at once
+        cache_path (str): The root folder of the preview cache
+        client (Optional[HttpClient]): The client used to download the previews
+
+    Returns:
+        int: Number of tracks whose features were extracted
+    """
+    if client is None:
+        client = HttpClient(pool_size=download_workers, scheduler=RequestScheduler(rate=50, max_rate=100, burst=download_workers))
+
+    missing_track_ids = list(db.iter_missing_ids(Table.AUDIO_FEATURES, 'track_id', Table.PREVIEW_URL))
+    n_extracted = 0
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk_start in range(0, len(missing_track_ids), chunk_size):
+            track_ids = missing_track_ids[chunk_start:chunk_start + chunk_size]
+            preview_rows = db.read_rows_by_ids(Table.PREVIEW_URL, 'track_id', track_ids, 'track_id, preview_url')
+            tracks = [(track_id, preview_url) for track_id, preview_url in preview_rows if preview_url]
+            content_hashes = _resolve_content_hashes(db, client, list({preview_url for _, preview_url in tracks}), download_workers, cache_path)
+
+            # Tracks sharing a preview file are extracted once
+            unique_hashes = list({content_hashes[preview_url] for _, preview_url in tracks if preview_url in content_hashes})
+            futures = {content_hash: executor.submit(extract_features, _cache_file_path(content_hash, cache_path))
+                       for content_hash in unique_hashes}
+
+            extracted_at = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+            # Tracks without a preview are saved without features, so they are not picked again by the next run
+            no_preview_rows = [(track_id, None, None, extracted_at) for track_id, preview_url in preview_rows if not preview_url]
+            db.add_rows(Table.AUDIO_FEATURES, no_preview_rows, ignore_duplicates=True)
+
+            rows = []
+            for track_id, preview_url in tracks:
+                content_hash = content_hashes.get(preview_url)
+                if content_hash is None:
+                    continue
+                try:
+                    features = futures[content_hash].result()
+                except Exception as e:
+                    log.error(f"Failed to extract features of track {track_id}: {e}")
+                    continue
+                rows.append((track_id, content_hash, features, extracted_at))
+
+            n_extracted += db.add_rows(Table.AUDIO_FEATURES, rows, ignore_duplicates=True)
+            log.info(f"Extracted audio features of {n_extracted}/{len(missing_track_ids)} tracks "
+                     f"({n_extracted / (time.perf_counter() - start):.1f} tracks/s)")
+
+    return n_extracted
+
+
+def load_audio_features(db: Database, track_ids: Optional[Iterable[str]] = None) -> tuple:
+    """
+    Load the extracted features as one float32 matrix.
+
+    Args:
+        db (Database): The database holding the audio_features table
+        track_ids (Optional[Iterable[str]]): Only load these tracks, by default all tracks
+
+    Returns:
+        tuple: The list of track IDs and a matrix with one row per track with features laid out as FEATURE_NAMES
+    """
+    if track_ids is None:
+        rows = db.read_all_rows(Table.AUDIO_FEATURES, 'track_id, features')
+    else:
+        rows = db.read_rows_by_ids(Table.AUDIO_FEATURES, 'track_id', track_ids, 'track_id, features')
+    # Tracks without a preview have no features
+    rows = [row for row in rows if row[1] is not None]
+
+    features = np.empty((len(rows), len(FEATURE_NAMES)), dtype=np.float32)
+    for i, (_, blob) in enumerate(rows):
+        features[i] = np.frombuffer(blob, dtype=np.float32)
+    return [row[0] for row in rows], features
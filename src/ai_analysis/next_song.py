@@ -0,0 +1,222 @@
+import heapq
+import os
+import pickle
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+from operator import itemgetter
+from typing import Optional
+
+from database_handler import Database
+from id_dictionary import IdDictionary
+from logger import LoggerWrapper
+
+# Plays further apart than this belong to different listening sessions
+SESSION_GAP_SECONDS = 30 * 60
+TOP_K = 20
+
+log = LoggerWrapper()
+
+
+def _played_at_to_epoch_seconds(played_at: str) -> float:
+    """
+    Convert a played_at timestamp of the database into unix seconds.
+
+    Args:
+        played_at (str): ISO 8601 UTC timestamp, with or without fractional seconds
+
+    Returns:
+        float: The unix time of the play
+    """
+    return datetime.fromisoformat(played_at.replace('Z', '+00:00')).timestamp()
+
+
+class TransitionIndex:
+    """
+    Sparse transition counts between the id dictionary keys of one entity type,
+    together with the precomputed top k successors of every source as Spotify ids.
+    """
+
+    def __init__(self, top_k: int = TOP_K):
+        """
+        Args:
+            top_k (int): Number of successors kept in the index per source
+        """
+        self.top_k = top_k
+        self.counts = defaultdict(dict)
+        self.totals = defaultdict(int)
+        self.index = {}
+
+    def add(self, source: int, target: int) -> None:
+        """
+        Count a transition from source to target.
+
+        Args:
+            source (int): The key of the previous play
+            target (int): The key of the next play
+        """
+        successors = self.counts[source]
+        successors[target] = successors.get(target, 0) + 1
+        self.totals[source] += 1
+
+    def rebuild(self, sources, ids: IdDictionary) -> None:
+        """
+        Recompute the top k successors of the given sources, all other entries of the index stay untouched.
+
+        Args:
+            sources (Iterable[int]): Keys whose transitions changed
+            ids (IdDictionary): The dictionary resolving keys to Spotify ids
+        """
+        for source in sources:
+            total = self.totals[source]
+            top = heapq.nlargest(self.top_k, self.counts[source].items(), key=itemgetter(1))
+            self.index[ids.spotify_id(source)] = [(ids.spotify_id(target), count / total) for target, count in top]
+
+    def predict(self, spotify_id: str, k: Optional[int] = None) -> list:
+        """
+        Look up the most likely successors of an id.
+
+        Args:
+            spotify_id (str): The Spotify id of the previous play
+            k (Optional[int]): Number of successors returned, by default all indexed ones
+
+        Returns:
+            list: (spotify_id, probability) tuples ordered by probability, empty for unknown ids
+        """
+        return self.index.get(spotify_id, [])[:k]
+
+
+class NextSongModel:
+    """
+    A first order Markov model of the listening history predicting the next track and artist.
+    Consecutive plays of one session count as a transition, a session ends when the gap between two plays
+    exceeds session_gap seconds. The model is updated incrementally from the plays inserted since the last update,
+    and only the index entries of tracks and artists with new transitions are recomputed.
+    """
+
+    def __init__(self, session_gap: float = SESSION_GAP_SECONDS, top_k: int = TOP_K):
+        """
+        Args:
+            session_gap (float): Longest gap in seconds between two plays of the same session
+            top_k (int): Number of successors kept in the index per track and artist
+        """
+        self.session_gap = session_gap
+        self.tracks = TransitionIndex(top_k)
+        self.artists = TransitionIndex(top_k)
+        self.last_rowid = 0
+        # (epoch seconds, track key, artist key) of the newest play seen, continues its session into the next update
+        self.last_play = None
+
+    def update(self, db: Database, chunk_size: int = 100000) -> int:
+        """
+        Add the transitions of all plays inserted since the last update.
+        Plays are read in insertion order, a play older than its predecessor starts a new session,
+        so histories imported out of order only lose the transitions at their boundaries.
+
+        Args:
+            db (Database): The database holding the play history
+            chunk_size (int): Number of plays read at once
+
+        Returns:
+            int: Number of plays added to the model
+        """
+        start = time.perf_counter()
+        changed_tracks = set()
+        changed_artists = set()
+        n_plays = 0
+
+        for rows in db.iter_play_history(self.last_rowid, chunk_size):
+            for rowid, played_at, track_key, artist_key, _, _ in rows:
+                played_at = _played_at_to_epoch_seconds(played_at)
+
+                if self.last_play is not None and 0 <= played_at - self.last_play[0] <= self.session_gap:
+                    _, last_track_key, last_artist_key = self.last_play
+                    if last_track_key is not None and track_key is not None:
+                        self.tracks.add(last_track_key, track_key)
+                        changed_tracks.add(last_track_key)
+                    if last_artist_key is not None and artist_key is not None:
+                        self.artists.add(last_artist_key, artist_key)
+                        changed_artists.add(last_artist_key)
+
+                self.last_play = (played_at, track_key, artist_key)
+            self.last_rowid = rows[-1][0]
+            n_plays += len(rows)
+
+        self.tracks.rebuild(changed_tracks, db.ids)
+        self.artists.rebuild(changed_artists, db.ids)
+        log.info(f"Updated the next song model with {n_plays} plays in {time.perf_counter() - start:.2f}s, "
+                 f"{len(changed_tracks)} tracks and {len(changed_artists)} artists reindexed")
+        return n_plays
+
+    def predict_next(self, track_id: str, k: int = 10) -> list:
+        """
+        Predict the tracks most likely played after a track.
+
+        Args:
+            track_id (str): The Spotify id of the current track
+            k (int): Number of predictions, at most top_k
+
+        Returns:
+            list: (track_id, probability) tuples ordered by probability, empty for tracks never followed by another
+        """
+        return self.tracks.predict(track_id, k)
+
+    def predict_next_artist(self, artist_id: str, k: int = 10) -> list:
+        """
+        Predict the artists most likely played after an artist.
+
+        Args:
+            artist_id (str): The Spotify id of the current artist
+            k (int): Number of predictions, at most top_k
+
+        Returns:
+            list: (artist_id, probability) tuples ordered by probability
+        """
+        return self.artists.predict(artist_id, k)
+
+    def predict_batch(self, histories: list, k: int = 10) -> list:
+        """
+        Predict the next tracks of multiple listening histories, only the last track of a history is used.
+
+        Args:
+            histories (list): Sequences of Spotify track ids, oldest first
+            k (int): Number of predictions per history
+
+        Returns:
+            list: A list of (track_id, probability) tuples per history
+        """
+        return [self.predict_next(history[-1], k) if history else [] for history in histories]
+
+    def save(self, path: str) -> None:
+        """
+        Save the model atomically, an interrupted save keeps the previous file.
+
+        Args:
+            path (str): The path of the model file
+        """
+        file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.part')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as file:
+                pickle.dump(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> 'NextSongModel':
+        """
+        Load a saved model, or create an empty one if there is no model file yet.
+
+        Args:
+            path (str): The path of the model file
+            **kwargs: Arguments of a newly created model
+
+        Returns:
+            NextSongModel: The model
+        """
+        if not os.path.exists(path):
+            return cls(**kwargs)
+        with open(path, 'rb') as file:
+            return pickle.load(file)
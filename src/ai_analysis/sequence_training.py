@@ -0,0 +1,241 @@
+import argparse
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import optuna
+import tensorflow as tf
+from tensorflow.keras import callbacks, layers, models
+
+from ai_analysis.sequence_windows import build_windows
+from columnar_export import EXPORT_PATH, export_columns, load_columns, load_vocabulary
+from database_handler import Database
+from logger import LoggerWrapper
+
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'sequence_model')
+
+log = LoggerWrapper()
+
+
+def _dataset(windows: np.ndarray, indexes: np.ndarray, batch_size: int, shuffle: bool, seed: int = 42) -> tf.data.Dataset:
+    """
+    Stream batches of windows, only the windows of the current batch are copied out of the sliding window view.
+
+    Args:
+        windows (np.ndarray): The (n, window + 1) windows
+        indexes (np.ndarray): The windows of the dataset
+        batch_size (int): Number of windows per batch
+        shuffle (bool): Shuffle the windows anew on every epoch
+
+    Returns:
+        tf.data.Dataset: Batches of (inputs, targets), prefetched while the previous batch is trained on
+    """
+    rng = np.random.default_rng(seed)
+    window = windows.shape[1] - 1
+
+    def generator():
+        order = rng.permutation(indexes) if shuffle else indexes
+        for start in range(0, len(order), batch_size):
+            batch = windows[order[start:start + batch_size]]
+            yield batch[:, :-1], batch[:, -1]
+
+    signature = (tf.TensorSpec(shape=(None, window), dtype=tf.int32), tf.TensorSpec(shape=(None,), dtype=tf.int32))
+    return tf.data.Dataset.from_generator(generator, output_signature=signature).prefetch(tf.data.AUTOTUNE)
+
+
+def build_model(n_classes: int, window: int, embedding_dim: int, units: int, dropout: float, learning_rate: float) -> models.Model:
+    """
+    Build a recurrent model predicting the class of the next track from the classes of the previous ones.
+
+    Returns:
+        models.Model: The compiled model
+    """
+    model = models.Sequential([
+        layers.Input(shape=(window,), dtype='int32'),
+        layers.Embedding(n_classes, embedding_dim),
+        layers.GRU(units),
+        layers.Dropout(dropout),
+        layers.Dense(n_classes, activation='softmax'),
+    ])
+    model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate),
+                  loss='sparse_categorical_crossentropy',
+                  metrics=[tf.keras.metrics.SparseTopKCategoricalAccuracy(k=10, name='top_10_accuracy')])
+    return model
+
+
+class _PruningCallback(callbacks.Callback):
+    """Reports the validation loss of every epoch to optuna and stops unpromising trials"""
+
+    def __init__(self, trial: optuna.Trial):
+        super().__init__()
+        self.trial = trial
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.trial.report(logs['val_loss'], epoch)
+        if self.trial.should_prune():
+            raise optuna.TrialPruned()
+
+
+def train(db: Database, output_path: str = MODEL_PATH, export_path: str = EXPORT_PATH, window: int = 10, n_trials: int = 20,
+          n_jobs: int = 2, epochs: int = 10, batch_size: int = 256, min_count: int = 2) -> optuna.Study:
+    """
+    Train the next track model on the play history with a hyperparameter search.
+    The columnar export is brought up to date and memory mapped, the trials run in n_jobs threads sharing the CPU cores,
+    and the best checkpoint of the best trial is kept as model.keras next to its vocabulary and meta data.
+
+    Args:
+        db (Database): The database holding the play history
+        output_path (str): The folder the best model is saved in
+        export_path (str): The folder of the columnar export
+        window (int): Number of plays the prediction is based on
+        n_trials (int): Number of hyperparameter sets tried
+        n_jobs (int): Number of trials trained at once
+        epochs (int): Maximal number of epochs per trial
+        batch_size (int): Number of windows per batch
+        min_count (int): Minimal number of plays of a track to be predicted
+
+    Returns:
+        optuna.Study: The finished study, None if the history is too short
+    """
+    export_columns(db, export_path)
+    columns = load_columns(export_path)
+
+    start = time.perf_counter()
+    windows, indexes, keys = build_windows(np.asarray(columns['played_at']), np.asarray(columns['track']), window,
+                                           min_count=min_count)
+    build_time = time.perf_counter() - start
+    log.info(f"Built {len(indexes)} windows of {len(keys)} classes from {len(columns['track'])} plays in {build_time:.2f}s "
+             f"({len(indexes) / max(build_time, 1e-9):.0f} samples/s)")
+
+    if len(indexes) < 10:
+        log.error(f"Only {len(indexes)} training windows, the play history is too short to train on")
+        return None
+
+    # The newest windows validate the model, like predicting the next song would
+    split = int(len(indexes) * 0.9)
+    train_indexes, validation_indexes = indexes[:split], indexes[split:]
+
+    # The trials share the cores instead of each one using all of them
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(max(1, (os.cpu_count() or 1) // n_jobs))
+    except RuntimeError:
+        log.warning("TensorFlow is already initialized, the number of threads per trial is unchanged")
+
+    checkpoint_path = os.path.join(output_path, 'trials')
+    Path(checkpoint_path).mkdir(parents=True, exist_ok=True)
+    report_lock = threading.Lock()
+
+    def objective(trial: optuna.Trial) -> float:
+        model = build_model(len(keys), window,
+                            embedding_dim=trial.suggest_int('embedding_dim', 32, 256, log=True),
+                            units=trial.suggest_int('units', 32, 256, log=True),
+                            dropout=trial.suggest_float('dropout', 0.0, 0.5),
+                            learning_rate=trial.suggest_float('learning_rate', 1e-4, 1e-2, log=True))
+        trial_path = os.path.join(checkpoint_path, f'trial_{trial.number}.keras')
+        trial.set_user_attr('checkpoint', trial_path)
+
+        fit_start = time.perf_counter()
+        history = model.fit(_dataset(windows, train_indexes, batch_size, shuffle=True, seed=trial.number),
+                            validation_data=_dataset(windows, validation_indexes, batch_size, shuffle=False),
+                            epochs=epochs, verbose=0,
+                            callbacks=[callbacks.EarlyStopping(patience=2),
+                                       callbacks.ModelCheckpoint(trial_path, save_best_only=True),
+                                       _PruningCallback(trial)])
+        fit_time = time.perf_counter() - fit_start
+        n_epochs = len(history.history['loss'])
+
+        with report_lock:
+            log.info(f"Trial {trial.number} trained {n_epochs} epochs in {fit_time:.1f}s "
+                     f"({len(train_indexes) * n_epochs / fit_time:.0f} samples/s), "
+                     f"validation loss {min(history.history['val_loss']):.4f}, "
+                     f"top 10 accuracy {max(history.history['val_top_10_accuracy']):.3f}")
+        return min(history.history['val_loss'])
+
+    study = optuna.create_study(direction='minimize', pruner=optuna.pruners.MedianPruner(n_warmup_steps=1))
+    study.optimize(objective, n_trials=n_trials, n_jobs=n_jobs)
+
+    best_trial = study.best_trial
+    os.replace(best_trial.user_attrs['checkpoint'], os.path.join(output_path, 'model.keras'))
+    for trial in study.trials:
+        if os.path.exists(trial.user_attrs.get('checkpoint', '')):
+            os.remove(trial.user_attrs['checkpoint'])
+
+    # Line n of the vocabulary holds the Spotify id of class n, class 0 has none
+    track_ids = load_vocabulary(export_path)
+    with open(os.path.join(output_path, 'vocabulary.txt'), 'w') as file:
+        file.write(''.join(f"{track_ids[key] if key >= 0 else ''}\n" for key in keys))
+    with open(os.path.join(output_path, 'meta.json'), 'w') as file:
+        json.dump({'window': window, 'params': best_trial.params, 'validation_loss': best_trial.value,
+                   'n_classes': len(keys), 'n_samples': len(indexes),
+                   'trained_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}, file, indent=4)
+
+    log.info(f"Best trial {best_trial.number} with validation loss {best_trial.value:.4f}: {best_trial.params}")
+    return study
+
+
+class SequencePredictor:
+    """
+    Predicts the next tracks with a model saved by train. The model and its vocabulary are loaded once,
+    predict_batch runs one forward pass for a whole batch of histories.
+    """
+
+    def __init__(self, model_path: str = MODEL_PATH):
+        """
+        Args:
+            model_path (str): The folder train saved the model in
+        """
+        self.model = tf.keras.models.load_model(os.path.join(model_path, 'model.keras'))
+        with open(os.path.join(model_path, 'meta.json'), 'r') as file:
+            self.window = json.load(file)['window']
+        with open(os.path.join(model_path, 'vocabulary.txt'), 'r') as file:
+            self.track_ids = [line.rstrip('\n') for line in file]
+        self.classes = {track_id: i for i, track_id in enumerate(self.track_ids) if track_id}
+
+    def predict_batch(self, histories: list, k: int = 10) -> list:
+        """
+        Predict the next tracks of multiple listening histories.
+        Histories shorter than the window are padded with class 0 like rare tracks, longer ones are cut to the last window plays.
+
+        Args:
+            histories (list): Sequences of Spotify track ids, oldest first
+            k (int): Number of predictions per history
+
+        Returns:
+            list: A list of (track_id, probability) tuples per history, ordered by probability
+        """
+        inputs = np.zeros((len(histories), self.window), dtype=np.int32)
+        for row, history in enumerate(histories):
+            classes = [self.classes.get(track_id, 0) for track_id in history[-self.window:]]
+            if classes:
+                inputs[row, -len(classes):] = classes
+
+        probabilities = self.model(inputs, training=False).numpy()
+        # Class 0 is not a track
+        probabilities[:, 0] = 0
+        k = min(k, probabilities.shape[1] - 1)
+        top = np.argpartition(-probabilities, k, axis=1)[:, :k]
+        top = np.take_along_axis(top, np.argsort(-np.take_along_axis(probabilities, top, axis=1), axis=1), axis=1)
+        return [[(self.track_ids[i], float(probabilities[row, i])) for i in top[row]] for row in range(len(histories))]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train the next track model on the scraped play history. "
+                                                 "Run it from the src folder with python -m ai_analysis.sequence_training")
+    parser.add_argument('--export', type=str, choices=['TEST', 'PRODUCTION'], default='PRODUCTION',
+                        help="The database of the runtime export to train on.")
+    parser.add_argument('--window', type=int, default=10, help="Number of plays the prediction is based on")
+    parser.add_argument('--trials', type=int, default=20, help="Number of hyperparameter sets tried")
+    parser.add_argument('--jobs', type=int, default=2, help="Number of trials trained in parallel")
+    parser.add_argument('--epochs', type=int, default=10, help="Maximal number of epochs per trial")
+    parser.add_argument('--batch-size', type=int, default=256, help="Number of windows per batch")
+    parser.add_argument('--min-count', type=int, default=2, help="Minimal number of plays of a track to be predicted")
+    args = parser.parse_args()
+
+    data_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data')
+    db = Database(os.path.join(data_path, f'spotify_scrape_{args.export}.db'))
+    train(db, os.path.join(data_path, f'sequence_model_{args.export}'), os.path.join(data_path, f'columnar_{args.export}'),
+          args.window, args.trials, args.jobs, args.epochs, args.batch_size, args.min_count)
+    db.close(__name__)
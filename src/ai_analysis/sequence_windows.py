@@ -0,0 +1,46 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from ai_analysis.next_song import SESSION_GAP_SECONDS
+
+
+def build_windows(played_at: np.ndarray, tracks: np.ndarray, window: int, session_gap: float = SESSION_GAP_SECONDS,
+                  min_count: int = 2) -> tuple:
+    """
+    Build the training windows of the play history without a python loop over the plays.
+    The plays are sorted by time and the tracks are mapped to dense classes, class 0 stands for rare and missing tracks.
+    A window holds window plays followed by the play to predict, windows spanning a session break,
+    containing a missing track or predicting a rare track are dropped.
+
+    Args:
+        played_at (np.ndarray): int64 unix milliseconds of every play
+        tracks (np.ndarray): int32 id dictionary key of the track of every play, -1 for missing tracks
+        window (int): Number of plays the prediction is based on
+        session_gap (float): Longest gap in seconds between two plays of the same session
+        min_count (int): Minimal number of plays of a track to get its own class
+
+    Returns:
+        tuple: The windows as a read only (n, window + 1) view on the class sequence, the indexes of the valid windows
+            and the id dictionary key of every class, -1 for class 0
+    """
+    order = np.argsort(played_at, kind='stable')
+    played_at = played_at[order]
+    tracks = tracks[order]
+
+    keys, counts = np.unique(tracks[tracks >= 0], return_counts=True)
+    keys = keys[counts >= min_count]
+    # The lookup is one longer than the largest key, so missing tracks (-1) index its last entry, which is class 0
+    lookup = np.zeros(max(int(tracks.max(initial=-1)), 0) + 2, dtype=np.int32)
+    lookup[keys] = np.arange(1, len(keys) + 1, dtype=np.int32)
+    sequence = lookup[tracks]
+
+    if len(sequence) <= window:
+        return np.empty((0, window + 1), dtype=np.int32), np.empty(0, dtype=np.int64), np.concatenate([[-1], keys])
+
+    sessions = np.concatenate([[0], np.cumsum(np.diff(played_at) > session_gap * 1000)])
+    windows = sliding_window_view(sequence, window + 1)
+    session_windows = sliding_window_view(sessions, window + 1)
+    missing_windows = sliding_window_view(tracks < 0, window + 1)
+
+    valid = (session_windows[:, 0] == session_windows[:, -1]) & ~missing_windows.any(axis=1) & (windows[:, -1] != 0)
+    return windows, np.flatnonzero(valid), np.concatenate([[-1], keys])
@@ -1,7 +1,61 @@
 import re
-from typing import Optional
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterable, Optional
 
-import requests
+from database_handler import Database, Table
+from http_client import HttpClient, RequestScheduler
+from logger import LoggerWrapper
+
+EMBED_URL = "https://open.spotify.com/embed/track"
+PREVIEW_PATTERN = re.compile(rb'"audioPreview":\s*{\s*"url":\s*"([^"]+)"')
+# Bytes of the previous chunk kept when scanning the next one, longer than any match of PREVIEW_PATTERN
+PREVIEW_PATTERN_OVERLAP = 2048
+
+log = LoggerWrapper()
+
+_client = None
+
+
+def _get_client() -> HttpClient:
+    global _client
+    if _client is None:
+        _client = HttpClient()
+    return _client
+
+
+def _scan_preview_url(client: HttpClient, spotify_track_id: str, chunk_size: int = 16384) -> Optional[str]:
+    """
+    Stream the embed page of a track and scan it chunk by chunk for the preview URL.
+    The download stops as soon as the URL is found, so the full page is never buffered.
+    Tracks without an embed page are answered with 404 and have no preview.
+
+    Args:
+        client (HttpClient): The client used to download the page
+        spotify_track_id (str): The Spotify track ID
+        chunk_size (int): Number of bytes read at once
+
+    Returns:
+        Optional[str]: The preview URL if found, else None
+
+    Raises:
+        requests.exceptions.RequestException: If the page could not be downloaded
+    """
+    embed_url = f"{EMBED_URL}/{spotify_track_id}"
+    with client.get(embed_url, stream=True) as response:
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+
+        tail = b''
+        for chunk in response.iter_content(chunk_size):
+            buffer = tail + chunk
+            match = PREVIEW_PATTERN.search(buffer)
+            if match:
+                return match.group(1).decode('utf-8')
+            tail = buffer[-PREVIEW_PATTERN_OVERLAP:]
+
+    return None
 
 
 def get_spotify_preview_url(spotify_track_id: str) -> Optional[str]:
@@ -15,14 +69,50 @@ def get_spotify_preview_url(spotify_track_id: str) -> Optional[str]:
         Optional[str]: The preview URL if found, else None
     """
     try:
-        embed_url = f"https://open.spotify.com/embed/track/{spotify_track_id}"
-        response = requests.get(embed_url)
-        response.raise_for_status()
-
-        html = response.text
-        match = re.search(r'"audioPreview":\s*{\s*"url":\s*"([^"]+)"', html)
-        return match.group(1) if match else None
+        return _scan_preview_url(_get_client(), spotify_track_id)
 
     except Exception as e:
-        print(f"Failed to fetch Spotify preview URL: {e}")
+        log.error(f"Failed to fetch Spotify preview URL: {e}")
         return None
+
+
+def resolve_preview_urls(spotify_track_ids: Iterable[str], db: Database, max_workers: int = 16,
+                         client: Optional[HttpClient] = None) -> dict:
+    """
+    Resolve the preview URLs of many tracks, downloading the embed pages concurrently.
+    Results are saved in the preview_url table, tracks without a preview or embed page are saved without a URL,
+    so tracks resolved in an earlier run are not downloaded again. Tracks whose page failed to download are retried next run.
+
+    Args:
+        spotify_track_ids (Iterable[str]): The Spotify track IDs
+        db (Database): The database holding the preview_url table
+        max_workers (int): Maximal number of pages downloaded at once
+        client (Optional[HttpClient]): The client used to download the pages, by default a client pooling max_workers connections
+
+    Returns:
+        dict: Mapping of every resolved track ID to its preview URL, None for tracks without a preview
+    """
+    spotify_track_ids = list(dict.fromkeys(spotify_track_ids))
+    preview_urls = dict(db.read_rows_by_ids(Table.PREVIEW_URL, 'track_id', spotify_track_ids, 'track_id, preview_url'))
+    missing_track_ids = [track_id for track_id in spotify_track_ids if track_id not in preview_urls]
+
+    if not missing_track_ids:
+        return preview_urls
+
+    if client is None:
+        client = HttpClient(pool_size=max_workers, scheduler=RequestScheduler(rate=20, max_rate=50, burst=max_workers))
+
+    # The pages are downloaded in the worker threads, the results are written from this thread only
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, db.write_buffer(Table.PREVIEW_URL, flush_size=500) as buffer:
+        futures = {executor.submit(_scan_preview_url, client, track_id): track_id for track_id in missing_track_ids}
+        for future in as_completed(futures):
+            track_id = futures[future]
+            try:
+                preview_url = future.result()
+            except Exception as e:
+                log.error(f"Failed to fetch Spotify preview URL of {track_id}: {e}")
+                continue
+            preview_urls[track_id] = preview_url
+            buffer.add((track_id, preview_url, time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())))
+
+    return preview_urls
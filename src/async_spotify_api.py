@@ -0,0 +1,248 @@
+import asyncio
+import base64
+import re
+import time
+from typing import Union
+
+import aiohttp
+
+from http_client import RequestScheduler, get_client
+from logger import LoggerWrapper
+from response_cache import get_cache
+
+API_URL = "https://api.spotify.com/v1"
+TOKEN_URL = "https://accounts.spotify.com/api/token"
+EMBED_URL = "https://open.spotify.com/embed/track"
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+log = LoggerWrapper()
+
+
+class AsyncSpotifyClient:
+    """
+    An asyncio client for the endpoints of spotify_api, auth and spotify_preview.
+    All requests share one pooled aiohttp session and the number of requests in flight is bounded by a semaphore.
+    The request rate is limited by the RequestScheduler of the shared http client, so the synchronous and the asyncio
+    requests pause together when the api throttles either of them.
+    Use it as an async context manager, leaving the block closes the pooled connections.
+    """
+
+    def __init__(self, max_in_flight: int = 10, timeout: float = 10, max_retries: int = 5, backoff: float = 1,
+                 max_backoff: float = 60, api_url: str = API_URL, scheduler: RequestScheduler = None):
+        """
+        :param max_in_flight: int maximal number of concurrent requests and pooled connections
+        :param timeout: float total timeout of a request in seconds
+        :param max_retries: int number of retries of throttled or failed GET requests
+        :param backoff: float seconds waited before the first retry, doubled on every further retry
+        :param max_backoff: float maximal seconds waited before a retry
+        :param api_url: str base url of the web api
+        :param scheduler: RequestScheduler limiting the request rate, the one of the shared http client if not given
+        """
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.api_url = api_url
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.scheduler = scheduler or get_client().scheduler
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_tb):
+        await self.session.close()
+
+    async def _request(self, method: str, url: str, bearer_token: str = None, as_text: bool = False, **kwargs):
+        """
+        Send a request and return its decoded body.
+        GET requests are retried on throttling, server errors and connection errors, honoring the Retry-After header.
+
+        :return: dict or str, None if the request failed
+        """
+        headers = dict(kwargs.pop('headers', None) or {})
+        if bearer_token:
+            headers['Authorization'] = f'Bearer {bearer_token}'
+
+        retries = self.max_retries if method == 'GET' else 0
+
+        async with self.semaphore:
+            for attempt in range(retries + 1):
+                backoff = min(self.max_backoff, self.backoff * 2 ** attempt)
+                await self.scheduler.acquire_async()
+                log.debug(f"{method} Request: {url}")
+
+                try:
+                    async with self.session.request(method, url, headers=headers, **kwargs) as response:
+                        if response.status in RETRY_STATUS_CODES:
+                            try:
+                                backoff = float(response.headers['Retry-After'])
+                            except (KeyError, ValueError):
+                                pass
+                        if response.status == 429:
+                            # Also on the last attempt, so the other requests pause until the api accepts requests again
+                            self.scheduler.throttle(backoff)
+
+                        if response.status in RETRY_STATUS_CODES and attempt < retries:
+                            if response.status != 429:
+                                log.warning(f"{method} {url} returned {response.status}. Retrying in {backoff:.1f}s")
+                                await asyncio.sleep(backoff)
+                            continue
+
+                        if response.status < 400:
+                            self.scheduler.success()
+                        if response.status != 200:
+                            log.error(f"Error in {method} {url} {response.status}: {await response.text()}")
+                            return None
+
+                        if as_text:
+                            return await response.text()
+                        return await response.json()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt == retries:
+                        log.error(f"Error in {method} {url}: {e}")
+                        return None
+                    log.warning(f"{method} {url} failed: {e}. Retrying in {backoff:.1f}s")
+                    await asyncio.sleep(backoff)
+
+        return None
+
+    async def get_json(self, url: str, bearer_token: str = None) -> Union[dict, None]:
+        """
+        This function sends a GET request and returns the json response
+
+        :param url: str
+        :param bearer_token: str
+        :return: dict
+        """
+        return await self._request('GET', url, bearer_token=bearer_token)
+
+    async def get_last_played_track(self, bearer_token: str, url: str = f"{API_URL}/me/player/recently-played?limit=50") -> Union[dict, None]:
+        """
+        This function returns the last played track based on the limit size
+
+        :param bearer_token: str
+        :param url: str
+        :return: dict
+        """
+        return await self.get_json(url, bearer_token)
+
+    async def _get_single(self, api_type: str, id: str, bearer_token: str) -> Union[dict, None]:
+        cached_response = get_cache().get(api_type, id)
+        if cached_response is not None:
+            return cached_response
+
+        response_json = await self.get_json(f"{self.api_url}/{api_type}/{id}", bearer_token)
+        if response_json is not None:
+            get_cache().put(api_type, id, response_json)
+        return response_json
+
+    async def get_track_information(self, track_id: str, bearer_token: str) -> Union[dict, None]:
+        """
+        This function returns the track information based on the track id
+
+        :param track_id: str
+        :param bearer_token: str
+        :return: dict
+        """
+        return await self._get_single('tracks', track_id, bearer_token)
+
+    async def get_artist_information(self, artist_id: str, bearer_token: str) -> Union[dict, None]:
+        """
+        This function returns the artist information based on the artist id
+
+        :param artist_id: str
+        :param bearer_token: str
+        :return: dict
+        """
+        return await self._get_single('artists', artist_id, bearer_token)
+
+    async def get_album_information(self, album_id: str, bearer_token: str) -> Union[dict, None]:
+        """
+        This function returns the album information based on the album id
+
+        :param album_id: str
+        :param bearer_token: str
+        :return: dict
+        """
+        return await self._get_single('albums', album_id, bearer_token)
+
+    async def get_multiple_field_information(self, bearer_token: str, api_type: str, limit: int, *ids) -> Union[dict, None]:
+        """
+        This function returns the information of multiple ids of one endpoint, only the cache misses hit the api
+
+        :param bearer_token: str
+        :param api_type: str
+        :param limit: int
+        :param *ids: str
+        :return: dict
+        """
+        if len(ids) > limit:
+            log.error(f'exceeding the limit if ids {limit} for endpoint {api_type}')
+            return None
+
+        response_key = api_type.replace('-', '_')
+        cached_responses = get_cache().get_many(api_type, ids)
+        missing_ids = [id for id in ids if id not in cached_responses]
+
+        if not missing_ids:
+            return {response_key: list(cached_responses.values())}
+
+        response_json = await self.get_json(f"{self.api_url}/{api_type}?ids={','.join(missing_ids)}", bearer_token)
+        if response_json is None:
+            return None
+
+        entries = response_json.get(response_key) or []
+        get_cache().put_many(api_type, {entry['id']: entry for entry in entries if entry})
+        response_json[response_key] = list(cached_responses.values()) + entries
+        return response_json
+
+    async def request_token(self, client_id: str, client_secret: str, grant_type: str = "client_credentials") -> Union[tuple, None]:
+        """
+        This function requests a token from the token endpoint using the client credentials
+
+        :return: tuple access_token, expires_at or None
+        """
+        auth_header = base64.b64encode(f"{client_id}:{client_secret}".encode('utf-8')).decode('utf-8')
+        headers = {
+            "Authorization": f"Basic {auth_header}",
+            "Content-Type": "application/x-www-form-urlencoded"
+        }
+
+        response_json = await self._request('POST', TOKEN_URL, headers=headers, data={"grant_type": grant_type})
+        if response_json is None:
+            return None
+        return response_json.get('access_token'), time.time() + response_json.get('expires_in', 3600)
+
+    async def get_spotify_preview_url(self, spotify_track_id: str) -> Union[str, None]:
+        """
+        This function returns the preview url of a track using the embed page workaround
+
+        :param spotify_track_id: str
+        :return: str or None if the track has no preview
+        """
+        html = await self._request('GET', f"{EMBED_URL}/{spotify_track_id}", as_text=True)
+        if html is None:
+            return None
+        match = re.search(r'"audioPreview":\s*{\s*"url":\s*"([^"]+)"', html)
+        return match.group(1) if match else None
+
+
+async def gather_or_cancel(*coroutines) -> list:
+    """
+    Run the coroutines concurrently and return their results in order.
+    If one of them raises or the caller is cancelled, all coroutines still running are cancelled.
+
+    :return: list of results
+    """
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
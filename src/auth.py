@@ -1,13 +1,17 @@
 import base64
 import json
 import os
+import tempfile
+import threading
 import time
+from functools import lru_cache
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from urllib.parse import parse_qs, urlencode, urlparse
 
 import dotenv
 import requests
 
+from http_client import get_client
 from logger import LoggerWrapper
 
 TOKEN_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'tokens.json')
@@ -15,12 +19,122 @@ TOKEN_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
 log = LoggerWrapper()
 
 
+class TokenManager:
+    """
+    A class keeping the access tokens in memory per grant type and scope.
+    Every token is refreshed on a background timer shortly before it expires, so callers never wait on the token endpoint
+    except for the very first request of a grant type and scope.
+    """
+
+    def __init__(self, refresh_margin: float = 300, retry_interval: float = 30):
+        """
+        :param refresh_margin: float seconds before the expiry at which a token is refreshed
+        :param retry_interval: float seconds after which a failed background refresh is retried
+        """
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self.tokens = {}
+        self.timers = {}
+        self.fetch_locks = {}
+        self.lock = threading.Lock()
+
+    def get_token(self, grant_type: str, scope: str = None) -> str:
+        """
+        Return a valid access token, fetching it only if none is cached yet or the background refresh failed
+
+        :param grant_type: str
+        :param scope: str
+        :return: str
+        """
+        key = (grant_type, scope)
+        token = self._cached_token(key)
+        if token is not None:
+            return token
+
+        # Threads asking for the same token at once wait for a single fetch instead of each requesting one
+        with self._fetch_lock(key):
+            token = self._cached_token(key)
+            if token is not None:
+                return token
+            return self._refresh(key, background=False)
+
+    def _cached_token(self, key: tuple) -> str:
+        """Return the cached access token if it is still valid, otherwise None"""
+        with self.lock:
+            token = self.tokens.get(key)
+        if token and time.time() < token[1]:
+            return token[0]
+        return None
+
+    def _fetch_lock(self, key: tuple) -> threading.Lock:
+        """Return the lock serializing the fetches of a token"""
+        with self.lock:
+            return self.fetch_locks.setdefault(key, threading.Lock())
+
+    def _refresh(self, key: tuple, background: bool) -> str:
+        """Fetch a new token, cache it and schedule its next refresh"""
+        grant_type, scope = key
+
+        if grant_type == 'authorization_code':
+            token = _refresh_user_token(scope) if background else _authenticate_user(scope)
+        else:
+            token = _request_simple_token(grant_type)
+
+        if token is None:
+            if background:
+                self._schedule(key, self.retry_interval)
+            return None
+
+        access_token, expires_at = token
+        with self.lock:
+            self.tokens[key] = (access_token, expires_at)
+        self._schedule(key, expires_at - time.time() - self.refresh_margin)
+        return access_token
+
+    def _background_refresh(self, key: tuple) -> None:
+        try:
+            log.debug(f"Refreshing token for grant type {key[0]} and scope {key[1]} in the background")
+            with self._fetch_lock(key):
+                self._refresh(key, background=True)
+        except Exception as e:
+            log.error(f"Error refreshing token in the background: {e}")
+            self._schedule(key, self.retry_interval)
+
+    def _schedule(self, key: tuple, delay: float) -> None:
+        """Replace the refresh timer of a token"""
+        timer = threading.Timer(max(delay, 0.0), self._background_refresh, args=(key,))
+        timer.daemon = True
+        with self.lock:
+            previous = self.timers.get(key)
+            if previous is not None:
+                previous.cancel()
+            self.timers[key] = timer
+        timer.start()
+
+    def stop(self) -> None:
+        """Cancel all background refreshes"""
+        with self.lock:
+            for timer in self.timers.values():
+                timer.cancel()
+            self.timers.clear()
+
+
 def simple_authenticate(grant_type: str = "client_credentials") -> str:
     """
     This function authenticates the user and returns the access token
 
     :return: str
     """
+    return _token_manager.get_token(grant_type)
+
+
+def _request_simple_token(grant_type: str) -> tuple:
+    """
+    This function requests a token from the token endpoint using the client credentials
+
+    :param grant_type: str
+    :return: tuple access_token, expires_at or None
+    """
     spotify_client_id, spotify_client_secret, spotify_redirect_uri = _read_env_file()
     token_url = "https://accounts.spotify.com/api/token"
     auth_value = f"{spotify_client_id}:{spotify_client_secret}"
@@ -36,16 +150,19 @@ def simple_authenticate(grant_type: str = "client_credentials") -> str:
     }
 
     try:
-        response = requests.post(token_url, headers=headers, data=data)
+        response = get_client().post(token_url, headers=headers, data=data)
     except requests.exceptions.RequestException as e:
         log.error(f"Error authenticating: {e}")
         return None
 
     if response.status_code == 200:
-        access_token = response.json().get('access_token')
-        return access_token
+        response_data = response.json()
+        access_token = response_data.get('access_token')
+        expires_at = time.time() + response_data.get('expires_in', 3600)
+        return access_token, expires_at
     else:
         log.error(f"Error authenticating {response.status_code}: {response.text}")
+        return None
 
 
 def authenticate(scope: str) -> str:
@@ -55,18 +172,27 @@ def authenticate(scope: str) -> str:
     :param scope: str
     :return: str
     """
+    return _token_manager.get_token('authorization_code', scope)
+
+
+def _authenticate_user(scope: str) -> tuple:
+    """
+    This function loads the tokens of the scope from the tokens file, refreshing them if they expired,
+    or runs the authorization code flow if there are none
+
+    :param scope: str
+    :return: tuple access_token, expires_at
+    """
     spotify_client_id, spotify_client_secret, spotify_redirect_uri = _read_env_file()
 
     tokens = _load_tokens(scope)
     if tokens:
         access_token, refresh_token, expires_at = tokens
         if time.time() < expires_at:
-            return access_token
+            return access_token, expires_at
         else:
             log.info(f"Token for scope {scope} expired, refreshing...")
-            access_token, expires_at = _refresh_access_token(refresh_token, spotify_client_id, spotify_client_secret)
-            _refresh_tokens_file(access_token, scope, expires_at)
-            return access_token
+            return _refresh_user_token(scope)
 
     auth_url = _get_authorization_url(spotify_client_id, spotify_redirect_uri, scope)
     print(f'Please go to the following URL to authorize the app: {auth_url}')
@@ -78,7 +204,31 @@ def authenticate(scope: str) -> str:
 
     _save_tokens(access_token, refresh_token, scope, expires_at)
 
-    return access_token
+    return access_token, expires_at
+
+
+def _refresh_user_token(scope: str) -> tuple:
+    """
+    This function refreshes the access token of the scope with the refresh token saved in the tokens file
+
+    :param scope: str
+    :return: tuple access_token, expires_at or None
+    """
+    spotify_client_id, spotify_client_secret, spotify_redirect_uri = _read_env_file()
+
+    tokens = _load_tokens(scope)
+    if not tokens:
+        log.error(f"Error: No tokens saved for scope '{scope}', can not refresh the access token.")
+        return None
+
+    access_token, refresh_token, expires_at = tokens
+    token = _refresh_access_token(refresh_token, spotify_client_id, spotify_client_secret)
+    if token is None:
+        return None
+
+    access_token, expires_at = token
+    _refresh_tokens_file(access_token, scope, expires_at)
+    return access_token, expires_at
 
 
 def _get_authorization_url(client_id: str, redirect_uri: str, scope: str) -> str:
@@ -102,9 +252,11 @@ def _get_authorization_url(client_id: str, redirect_uri: str, scope: str) -> str
     return auth_url
 
 
+@lru_cache(maxsize=1)
 def _read_env_file() -> tuple:
     """
-    This function reads the .env file and returns the client_id, client_secret and redirect_uri
+    This function reads the .env file and returns the client_id, client_secret and redirect_uri.
+    The file is only read once per process.
 
     :return: tuple
     """
@@ -170,7 +322,7 @@ def _exchange_code_for_token(code: str, redirect_uri: str, client_id: str, clien
     }
 
     try:
-        response = requests.post(token_url, data=data, headers=headers)
+        response = get_client().post(token_url, data=data, headers=headers)
     except requests.exceptions.RequestException as e:
         log.error(f"Error exchanging code for token: {e}")
         return None
@@ -209,7 +361,7 @@ def _refresh_access_token(refresh_token: str, client_id: str, client_secret: str
     }
 
     try:
-        response = requests.post(token_url, data=data, headers=headers)
+        response = get_client().post(token_url, data=data, headers=headers)
     except requests.exceptions.RequestException as e:
         log.error(f"Error refreshing access token: {e}")
         return None
@@ -255,8 +407,7 @@ def _save_tokens(access_token: str, refresh_token: str, scope: str, expires_at)
             'expires_at': expires_at
             },
         }
-    with open(TOKEN_FILE_PATH, 'w') as f:
-        json.dump(tokens, f)
+    _write_tokens_file(tokens)
 
 
 def _refresh_tokens_file(access_token: str, scope: str, expires_at) -> None:
@@ -272,7 +423,30 @@ def _refresh_tokens_file(access_token: str, scope: str, expires_at) -> None:
     if scope in tokens and 'refresh_token' in tokens[scope]:
         tokens[scope]['access_token'] = access_token
         tokens[scope]['expires_at'] = expires_at
-        with open(TOKEN_FILE_PATH, 'w') as file:
-            json.dump(tokens, file, indent=4)
+        _write_tokens_file(tokens, indent=4)
     else:
         log.error(f"Error: Scope '{scope}' or refresh_token not found in the tokens file.")
+
+
+def _write_tokens_file(tokens: dict, indent: int = None) -> None:
+    """
+    Writes the tokens file atomically: the tokens are written to a temporary file which then replaces the tokens file,
+    so a crash while writing never leaves a truncated tokens file behind.
+
+    :param tokens: dict
+    :param indent: int
+    """
+    token_folder_path = os.path.dirname(os.path.abspath(TOKEN_FILE_PATH))
+    file_descriptor, temp_path = tempfile.mkstemp(dir=token_folder_path, prefix='.tokens-', suffix='.json')
+    try:
+        with os.fdopen(file_descriptor, 'w') as file:
+            json.dump(tokens, file, indent=indent)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, TOKEN_FILE_PATH)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+_token_manager = TokenManager()
@@ -0,0 +1,347 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import statistics
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from ai_analysis.next_song import NextSongModel
+from async_spotify_api import AsyncSpotifyClient
+from database_handler import PROFILES, Database, Table
+from http_client import HttpClient, RequestScheduler
+
+
+def _generate_plays(n_rows: int) -> list:
+    """
+    Generate synthetic recently played rows with unique timestamps.
+
+    :param n_rows: int
+    :return: list of row tuples
+    """
+    return [(f"2024-01-01T00:00:00.{i:09d}Z", f"track{i % 5000:017d}", f"artist{i % 800:016d}", f"album{i % 1500:017d}")
+            for i in range(n_rows)]
+
+
+def _report(name: str, n_rows: int, seconds: float) -> None:
+    print(f"{name:<24} {n_rows:>9} rows {seconds:>9.3f} s {n_rows / seconds:>12.0f} rows/s")
+
+
+def benchmark_inserts(n_rows: int, max_rollup_slowdown: float) -> bool:
+    """
+    Compare the per row insert path with the batched insert path of the Database class
+    and check the cost of counting the plays in the rollups against inserting the bare plays.
+
+    :param n_rows: int number of rows to insert with each method
+    :param max_rollup_slowdown: float largest accepted ratio of the batched insert time with and without the rollups
+    :return: bool whether the rollups stay within max_rollup_slowdown
+    """
+    rows = _generate_plays(n_rows)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'per_row.db'))
+        start = time.perf_counter()
+        for row in rows:
+            db.add_row(Table.RECENTLY_PLAYED, row)
+        _report('add_row', n_rows, time.perf_counter() - start)
+        db.close(__name__)
+
+        db = Database(os.path.join(tmp_dir, 'add_rows.db'))
+        start = time.perf_counter()
+        db.add_rows(Table.RECENTLY_PLAYED, rows)
+        _report('add_rows', n_rows, time.perf_counter() - start)
+        db.close(__name__)
+
+        db = Database(os.path.join(tmp_dir, 'write_buffer.db'))
+        start = time.perf_counter()
+        with db.write_buffer(Table.RECENTLY_PLAYED, flush_size=1000) as buffer:
+            for row in rows:
+                buffer.add(row)
+        _report('write_buffer(1000)', n_rows, time.perf_counter() - start)
+        db.close(__name__)
+
+        # The same plays written straight into the plays table, without the rollups add_rows counts them in
+        db = Database(os.path.join(tmp_dir, 'bare.db'))
+        plays = db._encode_plays(rows)
+        start = time.perf_counter()
+        with db.transaction():
+            db.cursor.executemany(f"INSERT INTO {Table.PLAYS.value} VALUES (?, ?, ?, ?)", plays)
+        bare_seconds = time.perf_counter() - start
+        _report('plays without rollups', n_rows, bare_seconds)
+        db.close(__name__)
+
+        db = Database(os.path.join(tmp_dir, 'rollups.db'))
+        plays = db._encode_plays(rows)
+        start = time.perf_counter()
+        db.add_rows(Table.PLAYS, plays)
+        rollup_seconds = time.perf_counter() - start
+        _report('plays with rollups', n_rows, rollup_seconds)
+        db.close(__name__)
+
+    slowdown = rollup_seconds / bare_seconds
+    print(f"{'rollup slowdown':<24} {slowdown:>9.2f} x, at most {max_rollup_slowdown:.2f} x accepted")
+    return slowdown <= max_rollup_slowdown
+
+
+def _generate_information(plays: list) -> dict:
+    """Generate a row of track, artist and album information for every id referenced by the plays"""
+    return {
+        Table.TRACK_INFORMATION: [(track_id, 'title', 180000, False, 50) for track_id in {row[1] for row in plays}],
+        Table.ARTIST_INFORMATION: [(artist_id, 'artist', 1000, 'pop', 50) for artist_id in {row[2] for row in plays}],
+        Table.ALBUM_INFORMATION: [(album_id, 'album', 'album', 12, '2024-01-01', 'label') for album_id in {row[3] for row in plays}],
+    }
+
+
+def benchmark_profiles(n_rows: int, n_single_rows: int) -> None:
+    """
+    Compare the insert and join throughput of the database profiles.
+    The single row commits show the cost of syncing every commit. While they are written a second thread
+    reads the overview through its read connection, which only waits for the writer in the rollback journal mode.
+
+    :param n_rows: int number of plays inserted in batches before the joins
+    :param n_single_rows: int number of plays inserted with a commit each
+    """
+    plays = _generate_plays(n_rows + n_single_rows)
+    information = _generate_information(plays)
+
+    for profile in PROFILES:
+        print(f"Profile {profile}")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = Database(os.path.join(tmp_dir, f'{profile}.db'), profile)
+
+            start = time.perf_counter()
+            with db.write_buffer(Table.RECENTLY_PLAYED, flush_size=1000) as buffer:
+                for row in plays[:n_rows]:
+                    buffer.add(row)
+            _report('write_buffer(1000)', n_rows, time.perf_counter() - start)
+            for table, rows in information.items():
+                db.add_rows(table, rows)
+
+            start = time.perf_counter()
+            n_joined = len(db.get_total_overview())
+            _report('overview join', n_joined, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            n_missing = sum(1 for _ in db.iter_missing_ids(Table.TRACK_INFORMATION, 'track_id'))
+            print(f"{'missing ids anti join':<24} {n_missing:>9} ids  {time.perf_counter() - start:>8.3f} s")
+
+            stop = threading.Event()
+            latencies = []
+
+            def read_overview():
+                while True:
+                    read_start = time.perf_counter()
+                    db.get_total_overview()
+                    latencies.append(time.perf_counter() - read_start)
+                    if stop.is_set():
+                        return
+
+            reader = threading.Thread(target=read_overview)
+            reader.start()
+            start = time.perf_counter()
+            for row in plays[n_rows:]:
+                db.add_row(Table.RECENTLY_PLAYED, row)
+            _report('add_row while reading', n_single_rows, time.perf_counter() - start)
+            stop.set()
+            reader.join()
+            _report_latency('overview while writing', latencies)
+
+            db.close(__name__)
+
+
+def benchmark_next_song(n_rows: int, n_predictions: int) -> None:
+    """
+    Measure the full build and an incremental update of the next song model and the latency of its predictions.
+
+    :param n_rows: int number of synthetic plays the model is built from
+    :param n_predictions: int number of predict_next calls
+    """
+    # One play every three minutes with a session break every 40 plays
+    plays = [(time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(1704067200 + i * 180 + i // 40 * 3600)), *row[1:])
+             for i, row in enumerate(_generate_plays(n_rows))]
+    n_update = max(1, n_rows // 100)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, 'next_song.db'))
+        db.add_rows(Table.RECENTLY_PLAYED, plays[:-n_update])
+        model = NextSongModel()
+
+        start = time.perf_counter()
+        model.update(db)
+        _report('full build', n_rows - n_update, time.perf_counter() - start)
+
+        db.add_rows(Table.RECENTLY_PLAYED, plays[-n_update:])
+        start = time.perf_counter()
+        model.update(db)
+        _report('incremental update', n_update, time.perf_counter() - start)
+
+        track_ids = [row[1] for row in plays[:n_predictions]]
+        latencies = []
+        for track_id in track_ids:
+            start = time.perf_counter()
+            model.predict_next(track_id)
+            latencies.append(time.perf_counter() - start)
+        _report_latency('predict_next', latencies)
+        db.close(__name__)
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """Answers every GET with a small json body over a keep-alive HTTP/1.1 connection"""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    body = json.dumps({'tracks': [{'id': 'stub'}]}).encode('utf-8')
+    delay = 0.0
+
+    def do_GET(self):
+        if self.delay:
+            time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _start_stub_server(delay: float = 0.0) -> ThreadingHTTPServer:
+    """Start the stub http server on a free local port in a background thread, answering after delay seconds"""
+    handler = type('_DelayedStubHandler', (_StubHandler,), {'delay': delay})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _report_latency(name: str, latencies: list) -> None:
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies) * 1000
+    # Nearest rank, the smallest latency at least 99% of the requests did not exceed
+    p99 = latencies[min(len(latencies) - 1, math.ceil(0.99 * len(latencies)) - 1)] * 1000
+    print(f"{name:<24} {len(latencies):>6} requests  p50 {p50:>7.3f} ms  p99 {p99:>7.3f} ms  total {sum(latencies):>7.3f} s")
+
+
+def benchmark_http(n_requests: int) -> None:
+    """
+    Compare the per request latency of bare requests.get calls with the pooled HttpClient
+    against a local stub server. Without TLS this only measures the saved TCP handshakes,
+    against the Spotify api the TLS handshake saved per request is considerably larger.
+
+    :param n_requests: int number of requests sent with each method
+    """
+    server = _start_stub_server()
+    url = f"http://127.0.0.1:{server.server_address[1]}/v1/tracks?ids=stub"
+
+    latencies = []
+    for _ in range(n_requests):
+        start = time.perf_counter()
+        requests.get(url, headers={'Authorization': 'Bearer stub'}).json()
+        latencies.append(time.perf_counter() - start)
+    _report_latency('requests.get', latencies)
+
+    # The stub server never throttles, so the client is not rate limited
+    client = HttpClient(bearer_token='stub', scheduler=RequestScheduler(rate=1e9, max_rate=1e9, burst=n_requests))
+    latencies = []
+    for _ in range(n_requests):
+        start = time.perf_counter()
+        client.get(url).json()
+        latencies.append(time.perf_counter() - start)
+    _report_latency('HttpClient.get', latencies)
+
+    client.close()
+    server.shutdown()
+    server.server_close()
+
+
+async def _fetch_all_async(url: str, n_requests: int, concurrency: int) -> list:
+    """Send n_requests GET requests with the asyncio client and return their latencies"""
+    async def timed_get(client: AsyncSpotifyClient) -> float:
+        start = time.perf_counter()
+        await client.get_json(url, 'stub')
+        return time.perf_counter() - start
+
+    # The stub server never throttles, so the client is not rate limited
+    scheduler = RequestScheduler(rate=1e9, max_rate=1e9, burst=n_requests)
+    async with AsyncSpotifyClient(max_in_flight=concurrency, scheduler=scheduler) as client:
+        return await asyncio.gather(*(timed_get(client) for _ in range(n_requests)))
+
+
+def benchmark_async_http(n_requests: int, concurrency: int, delay: float) -> None:
+    """
+    Compare the synchronous client with the asyncio client against a local stub server
+    which answers every request after delay seconds, emulating the network round trip to the api.
+    The latencies of the asyncio client include the time a request waits for a free slot of the semaphore.
+
+    :param n_requests: int number of requests sent with each client
+    :param concurrency: int maximal number of requests in flight of the asyncio client
+    :param delay: float seconds the stub server waits before answering
+    """
+    server = _start_stub_server(delay)
+    url = f"http://127.0.0.1:{server.server_address[1]}/v1/tracks?ids=stub"
+
+    client = HttpClient(bearer_token='stub', scheduler=RequestScheduler(rate=1e9, max_rate=1e9, burst=n_requests))
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(n_requests):
+        request_start = time.perf_counter()
+        client.get(url).json()
+        latencies.append(time.perf_counter() - request_start)
+    wall_time = time.perf_counter() - start
+    _report_latency('HttpClient.get', latencies)
+    print(f"{'':<24} {n_requests / wall_time:>6.0f} requests/s")
+    client.close()
+
+    start = time.perf_counter()
+    latencies = asyncio.run(_fetch_all_async(url, n_requests, concurrency))
+    wall_time = time.perf_counter() - start
+    _report_latency(f'AsyncSpotifyClient({concurrency})', latencies)
+    print(f"{'':<24} {n_requests / wall_time:>6.0f} requests/s")
+
+    server.shutdown()
+    server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Micro benchmarks for the predictify storage and network layers.")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    insert_parser = subparsers.add_parser('insert', help="Compare per row inserts with batched inserts")
+    insert_parser.add_argument('--rows', type=int, default=5000, help="Number of rows to insert")
+    insert_parser.add_argument('--max-rollup-slowdown', type=float, default=2.5,
+                               help="Fail if counting the plays in the rollups slows the batched insert down more than this factor")
+
+    profile_parser = subparsers.add_parser('sqlite-profile', help="Compare the insert and join throughput of the database profiles")
+    profile_parser.add_argument('--rows', type=int, default=100000, help="Number of rows inserted in batches")
+    profile_parser.add_argument('--single-rows', type=int, default=1000, help="Number of rows inserted with a commit each")
+
+    next_song_parser = subparsers.add_parser('next-song', help="Measure the build, update and prediction time of the next song model")
+    next_song_parser.add_argument('--rows', type=int, default=100000, help="Number of plays the model is built from")
+    next_song_parser.add_argument('--predictions', type=int, default=10000, help="Number of predictions")
+
+    http_parser = subparsers.add_parser('http', help="Compare bare requests with the pooled http client")
+    http_parser.add_argument('--requests', type=int, default=500, help="Number of requests to send")
+
+    async_http_parser = subparsers.add_parser('async-http', help="Compare the synchronous client with the asyncio client")
+    async_http_parser.add_argument('--requests', type=int, default=200, help="Number of requests to send")
+    async_http_parser.add_argument('--concurrency', type=int, default=20, help="Requests in flight of the asyncio client")
+    async_http_parser.add_argument('--delay', type=float, default=0.02, help="Seconds the stub server waits before answering")
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'insert':
+        if not benchmark_inserts(args.rows, args.max_rollup_slowdown):
+            raise SystemExit("The rollups slow the batched insert down too much")
+    elif args.benchmark == 'sqlite-profile':
+        benchmark_profiles(args.rows, args.single_rows)
+    elif args.benchmark == 'next-song':
+        benchmark_next_song(args.rows, args.predictions)
+    elif args.benchmark == 'http':
+        benchmark_http(args.requests)
+    elif args.benchmark == 'async-http':
+        benchmark_async_http(args.requests, args.concurrency, args.delay)
@@ -0,0 +1,195 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from database_handler import Database, Table
+from logger import LoggerWrapper
+
+EXPORT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'columnar')
+
+# Name and dtype of every exported column, each is stored as a raw little endian array in <name>.bin
+COLUMNS = {
+    'played_at': np.dtype('<i8'),
+    'track': np.dtype('<i4'),
+    'artist': np.dtype('<i4'),
+    'album': np.dtype('<i4'),
+    'duration_ms': np.dtype('<i4'),
+}
+
+log = LoggerWrapper()
+
+
+def _read_meta(export_path: str) -> dict:
+    """
+    Read the meta data of an export, the number of rows in it is only advanced after all columns are written.
+
+    :param export_path: str
+    :return: dict
+    """
+    meta_path = os.path.join(export_path, 'meta.json')
+    if not os.path.exists(meta_path):
+        return {'n_rows': 0, 'last_rowid': 0, 'vocabulary_size': 0}
+    with open(meta_path, 'r') as file:
+        return json.load(file)
+
+
+def _write_meta(export_path: str, meta: dict) -> None:
+    """Replace the meta data atomically, which commits the rows appended since the last write"""
+    meta_path = os.path.join(export_path, 'meta.json')
+    temp_path = f'{meta_path}.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(meta, file, indent=4)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, meta_path)
+
+
+def load_vocabulary(export_path: str = EXPORT_PATH) -> list:
+    """
+    Load the Spotify ids of the track, artist and album columns, the code of an id is its index in the list.
+    The codes are the keys of the id dictionary of the database, shared by tracks, artists and albums.
+
+    :param export_path: str
+    :return: list of str
+    """
+    vocabulary_size = _read_meta(export_path)['vocabulary_size']
+    if not vocabulary_size:
+        return []
+    with open(os.path.join(export_path, 'ids.txt'), 'r') as file:
+        return [line.rstrip('\n') for _, line in zip(range(vocabulary_size), file)]
+
+
+def load_columns(export_path: str = EXPORT_PATH) -> dict:
+    """
+    Memory map the exported columns without copying them
+
+    :param export_path: str
+    :return: dict mapping column names to read only numpy arrays
+    """
+    n_rows = _read_meta(export_path)['n_rows']
+    columns = {}
+    for name, dtype in COLUMNS.items():
+        if n_rows == 0:
+            columns[name] = np.empty(0, dtype=dtype)
+        else:
+            columns[name] = np.memmap(os.path.join(export_path, f'{name}.bin'), dtype=dtype, mode='r', shape=(n_rows,))
+    return columns
+
+
+def _timestamps_to_epoch_ms(timestamps: list) -> np.ndarray:
+    """
+    Convert ISO 8601 UTC timestamps, with or without fractional seconds, to unix milliseconds
+
+    :param timestamps: list of str
+    :return: numpy int64 array
+    """
+    return np.array([timestamp.rstrip('Z') for timestamp in timestamps], dtype='datetime64[ms]').astype(np.int64)
+
+
+def _encode(keys: tuple) -> np.ndarray:
+    """
+    Convert id dictionary keys to int32 codes, missing ids are encoded as -1
+
+    :return: numpy int32 array
+    """
+    return np.array([-1 if key is None else key for key in keys], dtype=np.int32)
+
+
+def _fill_missing_durations(db: Database, export_path: str, n_rows: int) -> int:
+    """
+    Fill in the duration of exported plays whose track information was not scraped yet when they were exported
+
+    :param db: Database
+    :param export_path: str
+    :param n_rows: int number of exported plays
+    :return: int number of filled in plays
+    """
+    if n_rows == 0:
+        return 0
+
+    durations = np.memmap(os.path.join(export_path, 'duration_ms.bin'), dtype=COLUMNS['duration_ms'], mode='r+', shape=(n_rows,))
+    tracks = np.memmap(os.path.join(export_path, 'track.bin'), dtype=COLUMNS['track'], mode='r', shape=(n_rows,))
+    missing = np.flatnonzero((durations == -1) & (tracks >= 0))
+    if len(missing) == 0:
+        return 0
+
+    track_keys = np.unique(tracks[missing])
+    key_by_id = {db.ids.ids[key]: key for key in track_keys.tolist() if key < len(db.ids)}
+    duration_by_key = np.full(int(track_keys[-1]) + 1, -1, dtype=np.int32)
+    for track_id, duration in db.read_rows_by_ids(Table.TRACK_INFORMATION, 'track_id', key_by_id, 'track_id, duration_ms'):
+        if duration is not None:
+            duration_by_key[key_by_id[track_id]] = duration
+
+    filled = duration_by_key[tracks[missing]]
+    durations[missing] = filled
+    durations.flush()
+    return int(np.count_nonzero(filled >= 0))
+
+
+def export_columns(db: Database, export_path: str = EXPORT_PATH, chunk_size: int = 100000) -> int:
+    """
+    Append all plays inserted since the last export to the columnar export.
+    The plays are streamed from the database in chunks and written as typed columns: timestamps as int64 unix milliseconds
+    and the track, artist and album ids as int32 codes, which are their keys in the id dictionary of the database.
+    The dictionary only ever grows, so the vocabulary is appended to as well and codes stay stable between exports.
+    The rows are in insertion order, which is chronological for plays added by the scraper.
+    Plays of tracks without track information are exported with a duration of -1, which later exports fill in.
+
+    :param db: Database
+    :param export_path: str folder of the export
+    :param chunk_size: int number of plays converted at once
+    :return: int number of appended plays
+    """
+    Path(export_path).mkdir(parents=True, exist_ok=True)
+    meta = _read_meta(export_path)
+
+    # Drop data of an export which crashed before its meta data was written
+    for name, dtype in COLUMNS.items():
+        column_path = os.path.join(export_path, f'{name}.bin')
+        with open(column_path, 'ab') as file:
+            file.truncate(meta['n_rows'] * dtype.itemsize)
+
+    vocabulary_path = os.path.join(export_path, 'ids.txt')
+    with open(vocabulary_path, 'a') as file:
+        file.truncate(sum(len(spotify_id or '') + 1 for spotify_id in db.ids.ids[:meta['vocabulary_size']]))
+
+    n_filled = _fill_missing_durations(db, export_path, meta['n_rows'])
+    if n_filled:
+        log.info(f"Filled in the duration of {n_filled} exported plays")
+
+    n_appended = 0
+    for rows in db.iter_play_history(meta['last_rowid'], chunk_size):
+        rowids, played_at, track_keys, artist_keys, album_keys, durations = zip(*rows)
+
+        arrays = {
+            'played_at': _timestamps_to_epoch_ms(played_at),
+            'track': _encode(track_keys),
+            'artist': _encode(artist_keys),
+            'album': _encode(album_keys),
+            'duration_ms': np.array([-1 if duration is None else duration for duration in durations], dtype=np.int32),
+        }
+
+        for name, dtype in COLUMNS.items():
+            with open(os.path.join(export_path, f'{name}.bin'), 'ab') as file:
+                file.write(arrays[name].astype(dtype, copy=False).tobytes())
+                file.flush()
+                os.fsync(file.fileno())
+
+        # Ids without a key column referencing them are written as well, so the line of an id always equals its key
+        new_ids = db.ids.ids[meta['vocabulary_size']:]
+        if new_ids:
+            with open(vocabulary_path, 'a') as file:
+                file.write(''.join(f"{spotify_id or ''}\n" for spotify_id in new_ids))
+                file.flush()
+                os.fsync(file.fileno())
+
+        n_appended += len(rows)
+        meta['n_rows'] += len(rows)
+        meta['last_rowid'] = rowids[-1]
+        meta['vocabulary_size'] += len(new_ids)
+        _write_meta(export_path, meta)
+
+    log.info(f"Appended {n_appended} plays to the columnar export, {meta['n_rows']} plays in total")
+    return n_appended
@@ -1,6 +1,11 @@
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from enum import Enum
+from pathlib import Path
 
+from id_dictionary import ID_DICTIONARY_TABLE, IdDictionary
 from logger import LoggerWrapper
 
 # DATABASE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'spotify_scraped.db')
@@ -14,6 +19,59 @@ class Table(Enum):
     ALBUM_INFORMATION = "album_information"
     TRACK_ATTRIBUTES = "track_attributes"
     RECENTLY_PLAYED = "recently_played"
+    PLAYS = "plays"
+    ID_DICTIONARY = ID_DICTIONARY_TABLE
+    SCRAPE_STATE = "scrape_state"
+    PREVIEW_URL = "preview_url"
+    PREVIEW_FILE = "preview_file"
+    AUDIO_FEATURES = "audio_features"
+    PLAY_ROLLUP = "play_rollup"
+    PLAY_TOTALS = "play_totals"
+    PLAY_EVENTS = "play_events"
+    IMPORT_CHECKPOINT = "import_checkpoint"
+    TRACK_MAPPING = "track_mapping"
+
+
+# PRAGMA settings applied to every connection of a Database, keyed by profile name
+PROFILES = {
+    # The SQLite defaults: a rollback journal, a full sync on every commit and a 2 MB page cache
+    'default': {},
+    # A write ahead log, which lets readers run while the scraper writes and is only synced at checkpoints,
+    # a 64 MB page cache, the first 256 MB of the file memory mapped and temporary tables kept in memory
+    'performance': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -65536,
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY',
+    },
+}
+# Key of the scrape state holding the unix time of the last Database.optimize run
+OPTIMIZE_STATE_KEY = "last_optimize"
+# Key of the scrape state set once the track mapping is filled from the plays saved before it existed
+TRACK_MAPPING_BACKFILL_STATE_KEY = "track_mapping_backfilled"
+
+# SQL expression of the bucket a play falls into for every rollup period, weeks start on monday
+ROLLUP_PERIODS = {
+    'day': "substr({played_at}, 1, 10)",
+    'week': "date({played_at}, '-6 days', 'weekday 1')",
+    'month': "substr({played_at}, 1, 7)",
+}
+
+# Integer key column in the plays table of every id column of recently_played
+PLAY_KEY_FIELDS = {'track_id': 'track_key', 'artist_id': 'artist_key', 'album_id': 'album_key'}
+
+# recently_played resolves the keys of the plays table back to Spotify ids, so reading code sees the original schema
+RECENTLY_PLAYED_VIEW_QUERY = f'''
+SELECT p.played_at AS played_at,
+       t.spotify_id AS track_id,
+       ar.spotify_id AS artist_id,
+       al.spotify_id AS album_id
+FROM {Table.PLAYS.value} p
+LEFT JOIN {Table.ID_DICTIONARY.value} t ON t.id_key = p.track_key
+LEFT JOIN {Table.ID_DICTIONARY.value} ar ON ar.id_key = p.artist_key
+LEFT JOIN {Table.ID_DICTIONARY.value} al ON al.id_key = p.album_key
+'''
 
 
 class Database:
@@ -21,12 +79,65 @@ class Database:
     A class to handle the database connection and operations
     """
 
-    def __init__(self, db_name: str):
-        """Initialize the connection to the database"""
+    def __init__(self, db_name: str, profile: str = 'default'):
+        """
+        Initialize the connection to the database
+
+        :param db_name: str path of the database file
+        :param profile: str name of the PRAGMA settings in PROFILES applied to all connections
+        """
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown database profile {profile}, choose one of {', '.join(PROFILES)}")
         self.db_name = db_name
-        self.conn = sqlite3.connect(db_name)
+        self.profile = profile
+        self.conn = self._connect()
         self.cursor = self.conn.cursor()
+        # The writing connection can only be used by the thread which opened it
+        self._writer_thread = threading.get_ident()
+        self._readers = threading.local()
+        self._read_connections = []
+        self._read_connections_lock = threading.Lock()
+        self._transaction_depth = 0
         self.create_tables()
+        self.ids = IdDictionary(self.conn)
+        self._migrate_recently_played()
+        self._backfill_rollups()
+        self._backfill_play_totals()
+        self._backfill_track_mapping()
+
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        """Open a connection to the database with the PRAGMA settings of the profile"""
+        if read_only:
+            conn = sqlite3.connect(f'{Path(self.db_name).absolute().as_uri()}?mode=ro', uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.db_name)
+
+        for pragma, value in PROFILES[self.profile].items():
+            # The journal mode is saved in the database file by the writing connection
+            if read_only and pragma == 'journal_mode':
+                continue
+            conn.execute(f"PRAGMA {pragma} = {value}")
+        return conn
+
+    def read_connection(self) -> sqlite3.Connection:
+        """
+        Return the read only connection of the calling thread, opened on first use.
+        It only sees committed writes, in WAL mode its queries neither block nor are blocked by the writing connection,
+        so analytics queries can run while the scraper writes.
+        Inside a transaction the writing thread reads from the writing connection, so it sees its own uncommitted writes.
+        """
+        if self.db_name == ':memory:':
+            return self.conn
+        if self.conn.in_transaction and threading.get_ident() == self._writer_thread:
+            return self.conn
+
+        conn = getattr(self._readers, 'conn', None)
+        if conn is None:
+            conn = self._connect(read_only=True)
+            self._readers.conn = conn
+            with self._read_connections_lock:
+                self._read_connections.append(conn)
+        return conn
 
     def create_tables(self):
         """Create the tables in the database"""
@@ -81,69 +192,776 @@ class Database:
         ''')
 
         self.cursor.execute(f'''
-        CREATE TABLE IF NOT EXISTS {Table.RECENTLY_PLAYED.value} (
+        CREATE TABLE IF NOT EXISTS {Table.ID_DICTIONARY.value} (
+            id_key INTEGER PRIMARY KEY,
+            spotify_id TEXT NOT NULL UNIQUE
+        );
+        ''')
+
+        # Plays reference tracks, artists and albums by their integer key in the id dictionary
+        self.cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {Table.PLAYS.value} (
             played_at TIMESTAMP PRIMARY KEY,
-            track_id TEXT,
-            artist_id TEXT,
-            album_id TEXT,
-            FOREIGN KEY (track_id) REFERENCES {Table.TRACK_INFORMATION.value}(track_id),
-            FOREIGN KEY (artist_id) REFERENCES {Table.ARTIST_INFORMATION.value}(artist_id),
-            FOREIGN KEY (album_id) REFERENCES {Table.ALBUM_INFORMATION.value}(album_id),
-            FOREIGN KEY (track_id) REFERENCES {Table.TRACK_ATTRIBUTES.value}(track_id)
+            track_key INTEGER,
+            artist_key INTEGER,
+            album_key INTEGER,
+            FOREIGN KEY (track_key) REFERENCES {Table.ID_DICTIONARY.value}(id_key),
+            FOREIGN KEY (artist_key) REFERENCES {Table.ID_DICTIONARY.value}(id_key),
+            FOREIGN KEY (album_key) REFERENCES {Table.ID_DICTIONARY.value}(id_key)
+        );
+        ''')
+
+        self.cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {Table.SCRAPE_STATE.value} (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        ''')
+
+        self.cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {Table.PREVIEW_URL.value} (
+            track_id TEXT PRIMARY KEY,
+            preview_url TEXT,
+            resolved_at TIMESTAMP
+        );
+        ''')
+
+        self.cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {Table.PREVIEW_FILE.value} (
+            preview_url TEXT PRIMARY KEY,
+            content_hash TEXT
+        );
+        ''')
+
+        self.cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {Table.AUDIO_FEATURES.value} (
+            track_id TEXT PRIMARY KEY,
+            content_hash TEXT,
+            features BLOB,
+            extracted_at TIMESTAMP
+        );
+        ''')
+
+        # Indexes for the anti joins finding ids which are played but have no information saved yet
+        for key_field in PLAY_KEY_FIELDS.values():
+            self.cursor.execute(f'''
+            CREATE INDEX IF NOT EXISTS idx_{Table.PLAYS.value}_{key_field}
+            ON {Table.PLAYS.value} ({key_field});
+            ''')
+
+        # Databases created before the id dictionary still hold a recently_played table, it is migrated on open
+        self._create_recently_played_view()
+
+        # The gdpr fields of a play, the reasons and the platform are play_events.PlayReason and Platform values
+        # and flags holds the play_events.PlayFlag bits, without rowid the timestamp is only stored once
+        self.cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {Table.PLAY_EVENTS.value} (
+            played_at TIMESTAMP PRIMARY KEY,
+            ms_played INTEGER,
+            conn_country TEXT,
+            platform INTEGER,
+            reason_start INTEGER,
+            reason_end INTEGER,
+            flags INTEGER
+        ) WITHOUT ROWID;
+        ''')
+
+        # Byte offset in every gdpr file up to which its plays are imported, the end of the last imported item.
+        # The size and modification time of the file tell whether the offset is still valid
+        self.cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {Table.IMPORT_CHECKPOINT.value} (
+            file_name TEXT PRIMARY KEY,
+            byte_offset INTEGER,
+            file_size INTEGER,
+            modified_ns INTEGER,
+            updated_at TIMESTAMP
         );
         ''')
 
+        # Album and artist ids of every track, filled from the plays and all api responses containing a track,
+        # so the gdpr import only requests the tracks never seen before
+        self.cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {Table.TRACK_MAPPING.value} (
+            track_id TEXT PRIMARY KEY,
+            artist_id TEXT,
+            album_id TEXT
+        ) WITHOUT ROWID;
+        ''')
+
+        # Play counts per period bucket and played track, missing keys are stored as -1 since they are part of the key
+        self.cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {Table.PLAY_ROLLUP.value} (
+            period TEXT,
+            bucket TEXT,
+            track_key INTEGER,
+            artist_key INTEGER,
+            album_key INTEGER,
+            play_count INTEGER,
+            PRIMARY KEY (period, bucket, track_key, artist_key, album_key)
+        ) WITHOUT ROWID;
+        ''')
+
+        # Play count and listened time per period bucket, so the totals are read without aggregating the rollup
+        self.cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {Table.PLAY_TOTALS.value} (
+            period TEXT,
+            bucket TEXT,
+            play_count INTEGER,
+            estimated_ms INTEGER,
+            PRIMARY KEY (period, bucket)
+        ) WITHOUT ROWID;
+        ''')
+
+        # The plays of a track counted before its track information was saved get their duration added to the totals,
+        # they are found through the track key index of the plays
+        updates = ''.join(f'''
+            UPDATE {Table.PLAY_TOTALS.value}
+            SET estimated_ms = estimated_ms + NEW.duration_ms * p.play_count
+            FROM (
+                SELECT {bucket.format(played_at='played_at')} AS bucket, COUNT(*) AS play_count
+                FROM {Table.PLAYS.value}
+                WHERE track_key = (SELECT id_key FROM {Table.ID_DICTIONARY.value} WHERE spotify_id = NEW.track_id)
+                GROUP BY 1
+            ) p
+            WHERE {Table.PLAY_TOTALS.value}.period = '{period}' AND {Table.PLAY_TOTALS.value}.bucket = p.bucket;'''
+                          for period, bucket in ROLLUP_PERIODS.items())
+        self.cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {Table.PLAY_TOTALS.value}_duration AFTER INSERT ON {Table.TRACK_INFORMATION.value}
+        WHEN NEW.duration_ms IS NOT NULL
+        BEGIN{updates}
+        END;
+        ''')
+
         # Commit the changes
         self.conn.commit()
         log.debug("Initialised tables")
 
+    def _create_recently_played_view(self):
+        """Create the recently_played view, a no-op while an unmigrated recently_played table exists"""
+        self.cursor.execute(f'''
+        CREATE VIEW IF NOT EXISTS {Table.RECENTLY_PLAYED.value} AS
+        {RECENTLY_PLAYED_VIEW_QUERY}
+        ''')
+
+    def _migrate_recently_played(self, chunk_size: int = 100000):
+        """
+        Move the plays of a recently_played table, created before the id dictionary, into the plays table
+        and replace the table by the view. The migration runs in one transaction, an interrupted migration is rolled back.
+        """
+        row = self.cursor.execute("SELECT type FROM sqlite_master WHERE name = ?", (Table.RECENTLY_PLAYED.value,)).fetchone()
+        if row is None or row[0] != 'table':
+            return
+
+        log.info("Migrating recently_played to integer keys...")
+        n_migrated = 0
+        with self.transaction():
+            cursor = self.conn.execute(f"SELECT played_at, track_id, artist_id, album_id FROM {Table.RECENTLY_PLAYED.value} ORDER BY rowid")
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                self.cursor.executemany(f"INSERT OR IGNORE INTO {Table.PLAYS.value} VALUES (?, ?, ?, ?)", self._encode_plays(rows))
+                n_migrated += len(rows)
+
+            # Dropping the table drops its indexes as well
+            self.cursor.execute(f"DROP TABLE {Table.RECENTLY_PLAYED.value}")
+            self._create_recently_played_view()
+        log.info(f"Migrated {n_migrated} plays, {len(self.ids)} ids in the id dictionary")
+
+    def _last_play_rowid(self) -> int:
+        """Return the largest rowid of the plays, the plays inserted afterwards get larger rowids"""
+        return self.cursor.execute(f"SELECT IFNULL(MAX(rowid), 0) FROM {Table.PLAYS.value}").fetchone()[0]
+
+    def _add_to_rollups(self, last_rowid: int) -> None:
+        """
+        Count the plays inserted after last_rowid in the rollups and the totals, inside the transaction inserting them.
+        The plays are aggregated once per day, the buckets of every period are summed up from these counts.
+        The duration is added to the totals if the track information is saved already, otherwise once it is saved.
+
+        :param last_rowid: int largest rowid of the plays before the insert
+        """
+        # Missing keys are stored as -1 since they are part of the key of the rollup
+        self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS new_play_counts (day TEXT, track_key INTEGER, artist_key INTEGER, "
+                            "album_key INTEGER, play_count INTEGER)")
+        self.cursor.execute("DELETE FROM temp.new_play_counts")
+        self.cursor.execute(f'''
+        INSERT INTO temp.new_play_counts
+        SELECT {ROLLUP_PERIODS['day'].format(played_at='played_at')},
+               IFNULL(track_key, -1), IFNULL(artist_key, -1), IFNULL(album_key, -1), COUNT(*)
+        FROM {Table.PLAYS.value}
+        WHERE rowid > ?
+        GROUP BY 1, 2, 3, 4
+        ''', (last_rowid,))
+
+        for period, bucket in ROLLUP_PERIODS.items():
+            # The daily counts are unique already, the other periods sum up the days of their buckets
+            play_count, group_by = ('play_count', '') if period == 'day' else ('SUM(play_count)', 'GROUP BY 2, 3, 4, 5')
+            self.cursor.execute(f'''
+            INSERT INTO {Table.PLAY_ROLLUP.value}
+            SELECT '{period}', {bucket.format(played_at='day')}, track_key, artist_key, album_key, {play_count}
+            FROM temp.new_play_counts
+            WHERE true
+            {group_by}
+            ON CONFLICT DO UPDATE SET play_count = play_count + excluded.play_count
+            ''')
+            self.cursor.execute(f'''
+            INSERT INTO {Table.PLAY_TOTALS.value}
+            SELECT '{period}', {bucket.format(played_at='n.day')}, SUM(n.play_count), SUM(n.play_count * IFNULL(ti.duration_ms, 0))
+            FROM temp.new_play_counts n
+            LEFT JOIN {Table.ID_DICTIONARY.value} t ON t.id_key = n.track_key
+            LEFT JOIN {Table.TRACK_INFORMATION.value} ti ON ti.track_id = t.spotify_id
+            WHERE true
+            GROUP BY 2
+            ON CONFLICT DO UPDATE SET play_count = play_count + excluded.play_count, estimated_ms = estimated_ms + excluded.estimated_ms
+            ''')
+
+    def _backfill_rollups(self):
+        """Aggregate the plays of a database created before the rollups, later plays are counted when they are inserted"""
+        if self.cursor.execute(f"SELECT 1 FROM {Table.PLAY_ROLLUP.value} LIMIT 1").fetchone() is not None:
+            return
+        if self.cursor.execute(f"SELECT 1 FROM {Table.PLAYS.value} LIMIT 1").fetchone() is None:
+            return
+
+        log.info("Aggregating the play history into the rollups...")
+        with self.transaction():
+            for period, bucket in ROLLUP_PERIODS.items():
+                self.cursor.execute(f'''
+                INSERT INTO {Table.PLAY_ROLLUP.value}
+                SELECT '{period}', {bucket.format(played_at='played_at')},
+                       IFNULL(track_key, -1), IFNULL(artist_key, -1), IFNULL(album_key, -1), COUNT(*)
+                FROM {Table.PLAYS.value}
+                GROUP BY 2, 3, 4, 5
+                ''')
+
+    def _backfill_play_totals(self):
+        """Aggregate the rollups of a database created before the totals, later plays are counted when they are inserted"""
+        if self.cursor.execute(f"SELECT 1 FROM {Table.PLAY_TOTALS.value} LIMIT 1").fetchone() is not None:
+            return
+        if self.cursor.execute(f"SELECT 1 FROM {Table.PLAY_ROLLUP.value} LIMIT 1").fetchone() is None:
+            return
+
+        log.info("Aggregating the rollups into the play totals...")
+        with self.transaction():
+            self.cursor.execute(f'''
+            INSERT INTO {Table.PLAY_TOTALS.value}
+            SELECT r.period, r.bucket, SUM(r.play_count), SUM(r.play_count * IFNULL(ti.duration_ms, 0))
+            FROM {Table.PLAY_ROLLUP.value} r
+            LEFT JOIN {Table.ID_DICTIONARY.value} t ON t.id_key = r.track_key
+            LEFT JOIN {Table.TRACK_INFORMATION.value} ti ON ti.track_id = t.spotify_id
+            GROUP BY r.period, r.bucket
+            ''')
+
+    def _backfill_track_mapping(self):
+        """Fill the track mapping from the plays saved before it existed, later tracks are added by the scraper and the gdpr import"""
+        if self.get_state(TRACK_MAPPING_BACKFILL_STATE_KEY) is not None:
+            return
+
+        with self.transaction():
+            self.cursor.execute(f'''
+            INSERT OR IGNORE INTO {Table.TRACK_MAPPING.value}
+            SELECT t.spotify_id, ar.spotify_id, al.spotify_id
+            FROM {Table.PLAYS.value} p
+            JOIN {Table.ID_DICTIONARY.value} t ON t.id_key = p.track_key
+            JOIN {Table.ID_DICTIONARY.value} ar ON ar.id_key = p.artist_key
+            JOIN {Table.ID_DICTIONARY.value} al ON al.id_key = p.album_key
+            ''')
+            self.set_state(TRACK_MAPPING_BACKFILL_STATE_KEY, '1')
+
+    def _encode_plays(self, rows) -> list:
+        """
+        Convert recently_played rows into plays rows by interning their ids.
+        New ids are written right away, ids whose plays fail to insert stay unused in the dictionary.
+
+        :param rows: iterable of (played_at, track_id, artist_id, album_id) tuples
+        :return: list of (played_at, track_key, artist_key, album_key) tuples
+        """
+        intern = self.ids.intern
+        plays = [(played_at, intern(track_id), intern(artist_id), intern(album_id)) for played_at, track_id, artist_id, album_id in rows]
+        with self.transaction():
+            self.ids.flush()
+        return plays
+
     def add_row(self, table: Table, values):
         """Add a new row into the specified table"""
         try:
+            if table == Table.RECENTLY_PLAYED:
+                table, values = Table.PLAYS, self._encode_plays([values])[0]
             placeholders = ', '.join(['?'] * len(values))
             query = f"INSERT INTO {table.value} VALUES ({placeholders})"
+            if table == Table.PLAYS:
+                # The play is committed together with its rollup counts
+                with self.transaction():
+                    last_rowid = self._last_play_rowid()
+                    self.cursor.execute(query, values)
+                    self._add_to_rollups(last_rowid)
+                return
             self.cursor.execute(query, values)
-            self.conn.commit()
+            if not self._transaction_depth:
+                self.conn.commit()
         except Exception as e:
             log.error(f"Error while inserting row into table {table.value}: {e}")
 
+    def add_rows(self, table: Table, rows, ignore_duplicates: bool = False) -> int:
+        """
+        Add multiple rows into the specified table using a single transaction.
+        If a row violates a constraint, the batch is retried row by row so only the offending rows are skipped.
+
+        :param table: Table
+        :param rows: iterable of value tuples
+        :param ignore_duplicates: bool silently skip rows whose key already exists (INSERT OR IGNORE)
+        :return: int number of inserted rows
+        """
+        rows = list(rows)
+        if not rows:
+            return 0
+
+        if table == Table.RECENTLY_PLAYED:
+            # recently_played is a view, the plays are written with the keys of the id dictionary
+            table, rows = Table.PLAYS, self._encode_plays(rows)
+
+        placeholders = ', '.join(['?'] * len(rows[0]))
+        conflict = " OR IGNORE" if ignore_duplicates else ""
+        query = f"INSERT{conflict} INTO {table.value} VALUES ({placeholders})"
+
+        try:
+            with self.transaction():
+                # Without an explicit begin, releasing the savepoint would commit a surrounding transaction
+                if not self.conn.in_transaction:
+                    self.cursor.execute("BEGIN")
+                # The savepoint undoes a failed batch without rolling back the rest of a surrounding transaction
+                self.cursor.execute("SAVEPOINT add_rows")
+                try:
+                    last_rowid = self._last_play_rowid() if table == Table.PLAYS else None
+                    try:
+                        self.cursor.executemany(query, rows)
+                        inserted = self.cursor.rowcount
+                    except sqlite3.IntegrityError:
+                        self.cursor.execute("ROLLBACK TO add_rows")
+                        log.debug(f"Batch insert into {table.value} hit a constraint, retrying row by row")
+                        inserted = self._add_rows_one_by_one(table, query, rows)
+                    if last_rowid is not None:
+                        # The whole batch is counted in the rollups at once
+                        self._add_to_rollups(last_rowid)
+                except Exception:
+                    self.cursor.execute("ROLLBACK TO add_rows")
+                    self.cursor.execute("RELEASE add_rows")
+                    raise
+                self.cursor.execute("RELEASE add_rows")
+            return inserted
+        except Exception as e:
+            log.error(f"Error while inserting {len(rows)} rows into table {table.value}: {e}")
+            return 0
+
+    def add_plays_with_events(self, plays: list, events: list) -> int:
+        """
+        Add plays together with their play events, the n-th event belongs to the n-th play.
+        Both are written in one savepoint, so either both rows of a play are written or neither.
+        Plays and events which already exist are skipped, unlike add_rows a failed write is raised
+        after the savepoint is rolled back, so a surrounding transaction can be rolled back as a whole.
+
+        :param plays: list of (played_at, track_id, artist_id, album_id) tuples
+        :param events: list of (played_at, ms_played, conn_country, platform, reason_start, reason_end, flags) tuples
+        :return: int number of inserted plays
+        """
+        if len(plays) != len(events):
+            raise ValueError(f"Got {len(plays)} plays but {len(events)} play events")
+        if not plays:
+            return 0
+
+        with self.transaction():
+            if not self.conn.in_transaction:
+                self.cursor.execute("BEGIN")
+            self.cursor.execute("SAVEPOINT add_plays")
+            try:
+                last_rowid = self._last_play_rowid()
+                self.cursor.executemany(f"INSERT OR IGNORE INTO {Table.PLAYS.value} VALUES (?, ?, ?, ?)", self._encode_plays(plays))
+                inserted = self.cursor.rowcount
+                self._add_to_rollups(last_rowid)
+                self.cursor.executemany(f"INSERT OR IGNORE INTO {Table.PLAY_EVENTS.value} VALUES (?, ?, ?, ?, ?, ?, ?)", events)
+            except Exception as e:
+                self.cursor.execute("ROLLBACK TO add_plays")
+                self.cursor.execute("RELEASE add_plays")
+                log.error(f"Error while inserting {len(plays)} plays with their events: {e}")
+                raise
+            self.cursor.execute("RELEASE add_plays")
+        return inserted
+
+    def _add_rows_one_by_one(self, table: Table, query: str, rows: list) -> int:
+        """
+        Insert the rows of a failed batch one by one, skipping the rows which violate a constraint.
+        Duplicates are expected when plays are polled or imported again, so they are only logged at debug level.
+
+        :return: int number of inserted rows
+        """
+        inserted = 0
+        for values in rows:
+            try:
+                self.cursor.execute(query, values)
+                inserted += 1
+            except sqlite3.IntegrityError as e:
+                log.debug(f"Skipping row of table {table.value}: {e}")
+            except Exception as e:
+                log.error(f"Error while inserting row into table {table.value}: {e}")
+        return inserted
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group all writes inside the block into one transaction which is committed on exit
+        and rolled back if an exception escapes. Nested blocks join the outermost transaction.
+        """
+        self._transaction_depth += 1
+        try:
+            yield self
+        except Exception:
+            if self._transaction_depth == 1:
+                self.conn.rollback()
+                # Ids interned inside the transaction were rolled back as well
+                self.ids.reload()
+            raise
+        else:
+            if self._transaction_depth == 1:
+                self.conn.commit()
+        finally:
+            self._transaction_depth -= 1
+
+    def write_buffer(self, table: Table, flush_size: int = 1000, ignore_duplicates: bool = False) -> 'WriteBuffer':
+        """Create a buffer which collects rows for the specified table and writes them in batches"""
+        return WriteBuffer(self, table, flush_size, ignore_duplicates)
+
     def read_all_rows(self, table: Table, column: str = "*"):
         """Read all rows from the specified table"""
         try:
-            self.cursor.execute(f"SELECT {column} FROM {table.value}")
-            rows = self.cursor.fetchall()
-            return rows
+            return self.read_connection().execute(f"SELECT {column} FROM {table.value}").fetchall()
         except Exception as e:
             log.error(f"Error while reading all rows from table {table.value}: {e}")
             return []
 
+    def get_state(self, key: str, default: str = None) -> str:
+        """Read a value persisted by the scraper, e.g. the high-water mark of the recently played polling"""
+        try:
+            row = self.cursor.execute(f"SELECT value FROM {Table.SCRAPE_STATE.value} WHERE key = ?", (key,)).fetchone()
+        except Exception as e:
+            log.error(f"Error while reading state {key}: {e}")
+            return default
+        return row[0] if row else default
+
+    def set_state(self, key: str, value: str) -> None:
+        """Persist a value of the scraper, committed with the surrounding transaction if there is one"""
+        try:
+            self.cursor.execute(f"INSERT OR REPLACE INTO {Table.SCRAPE_STATE.value} VALUES (?, ?)", (key, value))
+            if not self._transaction_depth:
+                self.conn.commit()
+        except Exception as e:
+            log.error(f"Error while saving state {key}: {e}")
+
+    def get_import_checkpoints(self) -> dict:
+        """Read the byte offsets up to which the gdpr files are imported, keyed by file name"""
+        try:
+            rows = self.cursor.execute(f"SELECT file_name, byte_offset, file_size, modified_ns FROM {Table.IMPORT_CHECKPOINT.value}")
+            return {file_name: (byte_offset, file_size, modified_ns) for file_name, byte_offset, file_size, modified_ns in rows}
+        except Exception as e:
+            log.error(f"Error while reading the import checkpoints: {e}")
+            return {}
+
+    def save_import_checkpoints(self, checkpoints: dict) -> None:
+        """
+        Persist the byte offsets up to which the gdpr files are imported, committed with the surrounding transaction if there is one
+
+        :param checkpoints: dict mapping file names to (end offset of their last imported item, file size, modification time in ns)
+        """
+        try:
+            self.cursor.executemany(f'''
+            INSERT INTO {Table.IMPORT_CHECKPOINT.value} VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (file_name) DO UPDATE SET byte_offset = excluded.byte_offset, file_size = excluded.file_size,
+                modified_ns = excluded.modified_ns, updated_at = excluded.updated_at
+            ''', [(file_name, *checkpoint) for file_name, checkpoint in checkpoints.items()])
+            if not self._transaction_depth:
+                self.conn.commit()
+        except Exception as e:
+            log.error(f"Error while saving the import checkpoints: {e}")
+
+    def add_track_mappings(self, rows) -> int:
+        """
+        Save the album and artist ids of tracks, tracks which are already mapped keep their ids
+
+        :param rows: iterable of (track_id, artist_id, album_id) tuples
+        :return: int number of newly mapped tracks
+        """
+        return self.add_rows(Table.TRACK_MAPPING, rows, ignore_duplicates=True)
+
+    def add_unknown_ids(self, table: Table, ids) -> int:
+        """
+        Save ids the api does not know as rows without information, so they are not reported as missing again
+
+        :param table: Table whose first column is the id
+        :param ids: iterable of ids
+        :return: int number of saved ids
+        """
+        n_columns = len(self.cursor.execute(f"PRAGMA table_info({table.value})").fetchall())
+        return self.add_rows(table, [(id_value, *[None] * (n_columns - 1)) for id_value in ids], ignore_duplicates=True)
+
+    def read_rows_by_ids(self, table: Table, id_field: str, ids, column: str = "*", chunk_size: int = 500) -> list:
+        """
+        Read the rows of the specified table whose id is one of the given ids
+
+        :param table: Table
+        :param id_field: str name of the id column
+        :param ids: iterable of ids
+        :param column: str columns to read
+        :param chunk_size: int number of ids looked up per query
+        :return: list of rows
+        """
+        ids = list(ids)
+        rows = []
+        try:
+            for i in range(0, len(ids), chunk_size):
+                chunk = ids[i:i + chunk_size]
+                placeholders = ', '.join(['?'] * len(chunk))
+                rows.extend(self.conn.execute(f"SELECT {column} FROM {table.value} WHERE {id_field} IN ({placeholders})", chunk))
+        except Exception as e:
+            log.error(f"Error while reading rows by id from table {table.value}: {e}")
+        return rows
+
+    def iter_play_history(self, after_rowid: int = 0, chunk_size: int = 100000):
+        """
+        Stream the play history in insertion order, joined with the duration of the tracks.
+        Tracks, artists and albums are returned as their keys in the id dictionary, see Database.ids.
+
+        :param after_rowid: int only plays inserted after this rowid are read
+        :param chunk_size: int number of rows fetched at once
+        :return: generator yielding lists of (rowid, played_at, track_key, artist_key, album_key, duration_ms) rows
+        """
+        query = f'''
+        SELECT p.rowid, p.played_at, p.track_key, p.artist_key, p.album_key, ti.duration_ms
+        FROM {Table.PLAYS.value} p
+        LEFT JOIN {Table.ID_DICTIONARY.value} d ON d.id_key = p.track_key
+        LEFT JOIN {Table.TRACK_INFORMATION.value} ti ON ti.track_id = d.spotify_id
+        WHERE p.rowid > ?
+        ORDER BY p.rowid
+        '''
+        try:
+            cursor = self.read_connection().execute(query, (after_rowid,))
+        except Exception as e:
+            log.error(f"Error while reading the play history: {e}")
+            return
+
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield rows
+
+    def iter_missing_ids(self, table: Table, id_field: str, source_table: Table = Table.RECENTLY_PLAYED):
+        """
+        Stream the distinct ids referenced in source_table which have no row in table yet.
+        The anti join runs on the indexes of both tables, only the missing ids are passed to python.
+
+        :param table: Table which should contain a row for every id
+        :param id_field: str name of the id column in both tables
+        :param source_table: Table referencing the ids
+        :return: generator yielding the missing ids
+        """
+        if source_table == Table.RECENTLY_PLAYED:
+            # The played ids are the dictionary entries referenced by the key column of the plays table
+            query = f'''
+            SELECT d.spotify_id
+            FROM {Table.ID_DICTIONARY.value} d
+            LEFT JOIN {table.value} t ON t.{id_field} = d.spotify_id
+            WHERE t.{id_field} IS NULL
+            AND EXISTS (SELECT 1 FROM {Table.PLAYS.value} p WHERE p.{PLAY_KEY_FIELDS[id_field]} = d.id_key)
+            '''
+        else:
+            query = f'''
+            SELECT DISTINCT src.{id_field}
+            FROM {source_table.value} src
+            LEFT JOIN {table.value} t ON t.{id_field} = src.{id_field}
+            WHERE t.{id_field} IS NULL AND src.{id_field} IS NOT NULL
+            '''
+        try:
+            # A separate cursor keeps the stream intact while rows are written through self.cursor
+            cursor = self.conn.execute(query)
+        except Exception as e:
+            log.error(f"Error while reading missing ids of table {table.value}: {e}")
+            return
+
+        for row in cursor:
+            yield row[0]
+
+    def optimize(self, min_interval: float = 86400) -> bool:
+        """
+        Refresh the statistics of the query planner if the last run is at least min_interval seconds ago.
+        The first run analyzes all tables, later runs use PRAGMA optimize, which only analyzes tables whose statistics are outdated.
+
+        :param min_interval: float
+        :return: bool whether the statistics were refreshed
+        """
+        last_run = float(self.get_state(OPTIMIZE_STATE_KEY, 0))
+        if time.time() - last_run < min_interval:
+            return False
+
+        start = time.perf_counter()
+        try:
+            # Analyze a sample of each index instead of the full tables
+            self.conn.execute("PRAGMA analysis_limit = 1000")
+            self.conn.execute("ANALYZE" if not last_run else "PRAGMA optimize")
+        except Exception as e:
+            log.error(f"Error while optimizing the database: {e}")
+            return False
+        self.set_state(OPTIMIZE_STATE_KEY, str(time.time()))
+        log.info(f"Optimized the database in {time.perf_counter() - start:.2f}s")
+        return True
+
     def close(self, message: str):
         """Close the database connection"""
+        with self._read_connections_lock:
+            for conn in self._read_connections:
+                conn.close()
+            self._read_connections = []
+        try:
+            self.conn.execute("PRAGMA optimize")
+        except Exception as e:
+            log.error(f"Error while optimizing the database: {e}")
         self.conn.close()
         log.info(f"Database connection closed from file: {message}")
 
+    def _rollup_query(self, period: str, select: str, key_field: str = None) -> str:
+        """
+        Build the query aggregating the rollup rows of one period between two buckets, grouped by the select columns.
+        The listened time is estimated from the track durations, which are only known once the track information is saved.
+        """
+        entity_join = f"LEFT JOIN {Table.ID_DICTIONARY.value} e ON e.id_key = r.{key_field}" if key_field else ""
+        return f'''
+        SELECT {select}, SUM(r.play_count) AS play_count, SUM(r.play_count * IFNULL(ti.duration_ms, 0)) AS estimated_ms
+        FROM {Table.PLAY_ROLLUP.value} r
+        LEFT JOIN {Table.ID_DICTIONARY.value} t ON t.id_key = r.track_key
+        LEFT JOIN {Table.TRACK_INFORMATION.value} ti ON ti.track_id = t.spotify_id
+        {entity_join}
+        WHERE r.period = '{period}' AND r.bucket >= ? AND r.bucket <= ?
+        GROUP BY {select}
+        '''
+
+    def get_play_totals(self, period: str = 'month', start: str = None, end: str = None) -> list:
+        """
+        Read the number of plays and the estimated listened time per bucket from the totals,
+        one row per bucket is read, so the cost only depends on the number of buckets.
+
+        :param period: str one of day, week and month
+        :param start: str first bucket, e.g. 2024-01-01 for days and weeks or 2024-01 for months, by default the first one
+        :param end: str last bucket, by default the last one
+        :return: list of (bucket, play_count, estimated_ms) rows ordered by bucket
+        """
+        if period not in ROLLUP_PERIODS:
+            log.error(f"Unknown rollup period {period}, choose one of {', '.join(ROLLUP_PERIODS)}")
+            return []
+        query = f'''
+        SELECT bucket, play_count, estimated_ms
+        FROM {Table.PLAY_TOTALS.value}
+        WHERE period = '{period}' AND bucket >= ? AND bucket <= ?
+        ORDER BY bucket
+        '''
+        try:
+            return self.read_connection().execute(query, (start or '', end or '~')).fetchall()
+        except Exception as e:
+            log.error(f"Error while reading the {period} play totals: {e}")
+            return []
+
+    def get_top(self, id_field: str = 'track_id', period: str = 'month', start: str = None, end: str = None,
+                limit: int = 10, per_bucket: bool = False) -> list:
+        """
+        Read the most played tracks, artists or albums between two buckets from the rollups
+
+        :param id_field: str one of track_id, artist_id and album_id
+        :param period: str one of day, week and month
+        :param start: str first bucket, by default the first one
+        :param end: str last bucket, by default the last one
+        :param limit: int number of rows, per bucket if per_bucket is set, None for all
+        :param per_bucket: bool rank every bucket on its own, e.g. for the top tracks of every month
+        :return: list of (spotify_id, play_count, estimated_ms) rows,
+                 or (bucket, spotify_id, play_count, estimated_ms) rows ordered by bucket if per_bucket is set
+        """
+        if period not in ROLLUP_PERIODS or id_field not in PLAY_KEY_FIELDS:
+            log.error(f"Unknown rollup period {period} or id field {id_field}")
+            return []
+
+        if per_bucket:
+            query = f'''
+            SELECT bucket, spotify_id, play_count, estimated_ms
+            FROM (
+                SELECT *, ROW_NUMBER() OVER (PARTITION BY bucket ORDER BY play_count DESC) AS rank
+                FROM ({self._rollup_query(period, 'r.bucket, e.spotify_id', PLAY_KEY_FIELDS[id_field])})
+            )
+            WHERE rank <= ? OR ? < 0
+            ORDER BY bucket, rank
+            '''
+        else:
+            query = f"{self._rollup_query(period, 'e.spotify_id', PLAY_KEY_FIELDS[id_field])} ORDER BY play_count DESC LIMIT ?"
+
+        # A negative limit returns all rows
+        limit = -1 if limit is None else limit
+        params = (start or '', end or '~', limit, limit) if per_bucket else (start or '', end or '~', limit)
+        try:
+            return self.read_connection().execute(query, params).fetchall()
+        except Exception as e:
+            log.error(f"Error while reading the top {id_field} of the {period} rollup: {e}")
+            return []
+
     def get_total_overview(self) -> list:
         """Retrieve a total overview of all recently played songs with full details"""
         try:
-            # Join recently_played with track_information, artist_information, and album_information
+            # Join the plays on their integer keys with the id dictionary, which leads to the information tables
             query = f'''
-            SELECT rp.played_at,
+            SELECT p.played_at,
                    ti.track_id,
                    ti.title,
                    ai.artist_id,
                    ai.artist_name,
                    al.album_id,
                    al.album_name
-            FROM {Table.RECENTLY_PLAYED.value} rp
-            JOIN {Table.TRACK_INFORMATION.value} ti ON rp.track_id = ti.track_id
-            JOIN {Table.ARTIST_INFORMATION.value} ai ON rp.artist_id = ai.artist_id
-            JOIN {Table.ALBUM_INFORMATION.value} al ON rp.album_id = al.album_id
-            ORDER BY rp.played_at DESC
+            FROM {Table.PLAYS.value} p
+            JOIN {Table.ID_DICTIONARY.value} t ON t.id_key = p.track_key
+            JOIN {Table.ID_DICTIONARY.value} ar ON ar.id_key = p.artist_key
+            JOIN {Table.ID_DICTIONARY.value} alb ON alb.id_key = p.album_key
+            JOIN {Table.TRACK_INFORMATION.value} ti ON ti.track_id = t.spotify_id
+            JOIN {Table.ARTIST_INFORMATION.value} ai ON ai.artist_id = ar.spotify_id
+            JOIN {Table.ALBUM_INFORMATION.value} al ON al.album_id = alb.spotify_id
+            ORDER BY p.played_at DESC
             '''
-            self.cursor.execute(query)
-            rows = self.cursor.fetchall()
-            return rows
+            return self.read_connection().execute(query).fetchall()
         except Exception as e:
             log.error(f"Error retrieving total overview: {e}"
                       f"\nQuery Executed: {query}")
             return []
+
+
+class WriteBuffer:
+    """
+    Collects rows for one table and writes them with Database.add_rows once flush_size rows are buffered.
+    Use it as a context manager so the remaining rows are flushed on exit.
+    """
+
+    def __init__(self, db: Database, table: Table, flush_size: int = 1000, ignore_duplicates: bool = False):
+        self.db = db
+        self.table = table
+        self.flush_size = flush_size
+        self.ignore_duplicates = ignore_duplicates
+        self.rows = []
+        self.inserted = 0
+
+    def add(self, values) -> None:
+        """Buffer a row and flush if the buffer is full"""
+        self.rows.append(values)
+        if len(self.rows) >= self.flush_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write all buffered rows in a single transaction"""
+        if self.rows:
+            self.inserted += self.db.add_rows(self.table, self.rows, self.ignore_duplicates)
+            self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.flush()
@@ -1,56 +1,378 @@
+import asyncio
+import codecs
+import heapq
 import json
 import os
-
+import re
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import islice
+
+from async_spotify_api import AsyncSpotifyClient, gather_or_cancel
 from auth import simple_authenticate
 from database_handler import Database, Table
+from id_batches import endpoint_limit, iter_id_batches
 from logger import LoggerWrapper
+from play_events import encode_flags, encode_platform, encode_reason
+from response_cache import get_cache
 from spotify_api import get_multiple_field_information
 
 # Define the absolute folder path to the folder containing the gdrp retrieved data
 folder_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'gdpr_data')
 
+# Matches the track id of a play in the raw text of a gdpr file, podcasts have no track uri
+TRACK_URI_PATTERN = re.compile(rb'"spotify_track_uri"\s*:\s*"spotify:track:([^"]+)"')
+# Number of bytes a chunk of a scanned file overlaps the previous one, longer than a matched uri
+TRACK_URI_OVERLAP = 256
+
 log = LoggerWrapper()
 
 
-def _read_gdrp_data() -> list:
+def _iter_json_array(file_path: str, chunk_size: int = 65536, offset: int = 0):
+    """
+    This function incrementally decodes the items of a top level json array.
+    Only one chunk of the file and the item currently decoded are held in memory.
+    Every item is yielded with the byte offset of its end, reading can be resumed from such an offset.
+
+    :param: file_path path to a .json file containing an array
+    :param: chunk_size number of bytes read from the file at once
+    :param: offset byte offset to resume at, the end of a previously yielded item
+    :return: generator yielding (item, end offset) tuples
+    """
+    decoder = json.JSONDecoder()
+    # The file is read as bytes and decoded here, so offsets count bytes and crlf line breaks are kept as they are
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+
+    with open(file_path, 'rb') as file:
+        def read_chunk() -> str:
+            chunk = file.read(chunk_size)
+            return text_decoder.decode(chunk, final=not chunk)
+
+        if offset:
+            file.seek(offset)
+            buffer = read_chunk()
+            position = 0
+        else:
+            buffer = read_chunk()
+            # Leading whitespace is ascii, so its length in characters is its length in bytes
+            offset = len(buffer) - len(buffer.lstrip())
+            buffer = buffer.lstrip()
+            if not buffer.startswith('['):
+                raise ValueError(f'{file_path} does not contain a json array')
+            position = 1
+            offset += 1
+        # offset is the byte offset of buffer[position], character and byte counts only differ outside of ascii
+        is_ascii = buffer.isascii()
+
+        while True:
+            start = position
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            offset += position - start
+
+            if position < len(buffer) and buffer[position] == ']':
+                return
+
+            try:
+                if position >= len(buffer):
+                    raise json.JSONDecodeError('Buffer exhausted', buffer, position)
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The next item is cut off at the end of the buffer, read more of the file and retry
+                chunk = read_chunk()
+                if not chunk:
+                    if position >= len(buffer):
+                        return
+                    raise
+                buffer = buffer[position:] + chunk
+                position = 0
+                is_ascii = buffer.isascii()
+                continue
+
+            offset += end - position if is_ascii else len(buffer[position:end].encode('utf-8'))
+            position = end
+            yield item, offset
+
+
+def _parse_gdpr_entry(entry: dict) -> dict:
     """
-    This function reads all .json files in the folder containing the gdpr data.
-    This data is then extracted into a dict and sorted by timestamp ascending.
+    This function converts a single gdpr play entry into the dict used by the export.
 
-    :return: all_songs_played: A dict with an items field containing all songs played for the user
+    :param: entry a raw entry of a gdpr streaming history file
+    :return: dict or None for podcasts and other entries without a track
     """
-    all_songs_played = []
+    # This removes all podcasts from the list
+    if entry['spotify_track_uri'] is None:
+        return None
+
+    return {
+        'timestamp': entry['ts'],
+        'id': _extract_id(entry['spotify_track_uri']),
+        'track_name': entry['master_metadata_track_name'],
+        'artist_name': entry['master_metadata_album_artist_name'],
+        'album_name': entry['master_metadata_album_album_name'],
+        'conn_country': entry['conn_country'],
+        'ms_played': entry['ms_played'],
+        # Fields only contained in the extended streaming history
+        'platform': encode_platform(entry.get('platform')),
+        'reason_start': encode_reason(entry.get('reason_start')),
+        'reason_end': encode_reason(entry.get('reason_end')),
+        'flags': encode_flags(entry.get('shuffle'), entry.get('skipped'), entry.get('offline'), entry.get('incognito_mode'))
+        }
+
+
+def _iter_gdpr_file(file_path: str, offset: int = 0):
+    """
+    This function streams all songs played from a single gdpr .json file.
+    The export files are expected to be ordered by timestamp ascending.
+    Every song played carries the name of its file and its end offset, the checkpoint of the import.
+
+    :param: file_path path to the gdpr .json file
+    :param: offset byte offset to resume at, read from the import checkpoint
+    :return: generator yielding one dict per song played
+    """
+    file_name = os.path.basename(file_path)
+    last_timestamp = ''
+    n_out_of_order = 0
     try:
-        for filename in os.listdir(folder_path):
-
-            if filename.endswith('.json'):
-                file_path = os.path.join(folder_path, filename)
-
-                with open(file_path, 'r') as file:
-                    data = json.load(file)
-
-                    for entry in data:
-                        # This removes all podcasts from the list
-                        if entry['spotify_track_uri'] is None:
-                            continue
-                        try:
-                            track = {
-                                'timestamp': entry['ts'],
-                                'id': _extract_id(entry['spotify_track_uri']),
-                                'track_name': entry['master_metadata_track_name'],
-                                'artist_name': entry['master_metadata_album_artist_name'],
-                                'album_name': entry['master_metadata_album_album_name'],
-                                'conn_country': entry['conn_country'],
-                                'ms_played': entry['ms_played']
-                                }
-                            all_songs_played.append(track)
-                        except Exception as e:
-                            log.warning(f'Missing field from gdpr data: {e}')
+        for entry, end_offset in _iter_json_array(file_path, offset=offset):
+            try:
+                track = _parse_gdpr_entry(entry)
+            except Exception as e:
+                log.warning(f'Missing field from gdpr data: {e}')
+                continue
+            if track is None:
+                continue
+
+            if track['timestamp'] < last_timestamp:
+                if not n_out_of_order:
+                    log.warning(f'{file_path} is not ordered by timestamp, the merged play history will be out of order')
+                n_out_of_order += 1
+            last_timestamp = track['timestamp']
+
+            track['file'] = file_name
+            track['offset'] = end_offset
+            yield track
+    except Exception as e:
+        log.error(f'Failed to read gdpr data from {file_path}: {e}')
+
+    if n_out_of_order:
+        log.debug(f'{n_out_of_order} plays of {file_path} are older than the play before them')
+
+
+def _gdpr_files() -> list:
+    """
+    This function lists all .json files in the folder containing the gdpr data.
+
+    :return: list of file paths
+    """
+    try:
+        return [os.path.join(folder_path, filename) for filename in sorted(os.listdir(folder_path)) if filename.endswith('.json')]
     except Exception as e:
         log.error(f'Failed to read gdpr data: {e}')
+        return []
 
-    all_songs_played = sorted(all_songs_played, key=lambda x: x['timestamp'])
-    return all_songs_played
+
+def _file_fingerprint(file_path: str) -> tuple:
+    """
+    This function identifies the state of a gdpr file, a checkpoint is only valid for the file it was saved for.
+
+    :param: file_path path to the gdpr .json file
+    :return: tuple of the file size in bytes and its modification time in ns
+    """
+    stat = os.stat(file_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _resume_offsets(db: Database, fingerprints: dict) -> dict:
+    """
+    This function reads the import checkpoints of the gdpr files which did not change since they were saved.
+    A file replaced by another export of the same name is imported from its start again.
+
+    :param: db Database
+    :param: fingerprints dict mapping file names to the fingerprint of the file now
+    :return: dict mapping file names to the byte offset their import is resumed at
+    """
+    offsets = {}
+    for file_name, (offset, *fingerprint) in db.get_import_checkpoints().items():
+        if file_name not in fingerprints:
+            continue
+        if tuple(fingerprint) != fingerprints[file_name]:
+            log.warning(f'{file_name} changed since its import checkpoint, importing it from the start')
+            continue
+        offsets[file_name] = offset
+
+    return offsets
+
+
+def _read_gdrp_data(checkpoints: dict = None):
+    """
+    This function streams all .json files in the folder containing the gdpr data.
+    As every file is already ordered by timestamp, the files are combined with a k-way heap merge
+    so the plays are yielded by timestamp ascending without sorting the whole history in memory.
+
+    :param: checkpoints dict mapping file names to the byte offset their import is resumed at
+    :return: generator yielding one dict per song played
+    """
+    checkpoints = checkpoints or {}
+    return heapq.merge(*(_iter_gdpr_file(file_path, checkpoints.get(os.path.basename(file_path), 0))
+                         for file_path in _gdpr_files()), key=lambda x: x['timestamp'])
+
+
+class _PackedStrings:
+    """
+    A compact column of strings, encoded back to back into one bytearray together with the end offset of every string.
+    A track id takes 30 bytes instead of about 80 as a str in a list, and the column pickles as two buffers.
+    None is stored as a negative end offset, -1 - the offset of the previous string.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+        self.ends = array('q')
+
+    def append(self, value: str) -> None:
+        if value is None:
+            self.ends.append(-1 - len(self.data))
+            return
+        self.data += value.encode('utf-8')
+        self.ends.append(len(self.data))
+
+    def __len__(self) -> int:
+        return len(self.ends)
+
+    def __iter__(self):
+        data = bytes(self.data)
+        start = 0
+        for end in self.ends:
+            if end < 0:
+                yield None
+                continue
+            yield data[start:end].decode('utf-8')
+            start = end
+
+
+def _parse_gdpr_file_columns(file_path: str, offset: int = 0) -> dict:
+    """
+    This function parses a single gdpr .json file into compact column arrays.
+    It is executed inside the worker processes of the parallel import, returning columns instead of
+    one dict per play keeps the result small to pickle back into the parent process.
+    The strings are packed into bytes and the numbers into typed arrays, a play takes about 100 bytes.
+
+    :param: file_path path to the gdpr .json file
+    :param: offset byte offset to resume at, read from the import checkpoint
+    :return: dict with the columns and the parse statistics of the file
+    """
+    start = time.perf_counter()
+    columns = {
+        'file_path': file_path,
+        'file': os.path.basename(file_path),
+        'timestamp': _PackedStrings(),
+        'id': _PackedStrings(),
+        'conn_country': _PackedStrings(),
+        'ms_played': array('q'),
+        'platform': array('B'),
+        'reason_start': array('B'),
+        'reason_end': array('B'),
+        'flags': array('B'),
+        'offset': array('q'),
+    }
+
+    for track in _iter_gdpr_file(file_path, offset):
+        columns['timestamp'].append(track['timestamp'])
+        columns['id'].append(track['id'])
+        columns['conn_country'].append(track['conn_country'])
+        columns['ms_played'].append(track['ms_played'] or 0)
+        columns['platform'].append(track['platform'])
+        columns['reason_start'].append(track['reason_start'])
+        columns['reason_end'].append(track['reason_end'])
+        columns['flags'].append(track['flags'])
+        columns['offset'].append(track['offset'])
+
+    columns['seconds'] = time.perf_counter() - start
+    columns['bytes'] = os.path.getsize(file_path)
+    return columns
+
+
+def _iter_columns(columns: dict):
+    """
+    This function turns the column arrays of a parsed file back into one dict per song played.
+
+    :param: columns dict returned by _parse_gdpr_file_columns
+    :return: generator yielding one dict per song played
+    """
+    file_name = columns['file']
+    for timestamp, track_id, conn_country, ms_played, platform, reason_start, reason_end, flags, offset in zip(
+            columns['timestamp'], columns['id'], columns['conn_country'], columns['ms_played'],
+            columns['platform'], columns['reason_start'], columns['reason_end'], columns['flags'], columns['offset']):
+        yield {
+            'timestamp': timestamp,
+            'id': track_id,
+            'conn_country': conn_country,
+            'ms_played': ms_played,
+            'platform': platform,
+            'reason_start': reason_start,
+            'reason_end': reason_end,
+            'flags': flags,
+            'file': file_name,
+            'offset': offset
+            }
+
+
+def _read_gdrp_data_parallel(workers: int, checkpoints: dict = None):
+    """
+    This function parses all .json files in the folder containing the gdpr data in a process pool.
+    The per file parse throughput is logged to help sizing the number of workers.
+    Unlike the streaming reader, whose memory is bounded by one chunk per file, the merge only starts once every file
+    is parsed, so all plays are held at once. They are held in compact columns of about 100 bytes per play,
+    around 100 MB for a history of a million plays, which is the price of parsing the files in parallel.
+
+    :param: workers number of worker processes
+    :param: checkpoints dict mapping file names to the byte offset their import is resumed at
+    :return: generator yielding one dict per song played, ordered by timestamp ascending
+    """
+    checkpoints = checkpoints or {}
+    all_columns = []
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_parse_gdpr_file_columns, file_path, checkpoints.get(os.path.basename(file_path), 0))
+                   for file_path in _gdpr_files()]
+        for future in as_completed(futures):
+            try:
+                columns = future.result()
+            except Exception as e:
+                log.error(f'Failed to read gdpr data: {e}')
+                continue
+
+            n_played = len(columns['timestamp'])
+            seconds = max(columns['seconds'], 1e-9)
+            log.info(f"Parsed {os.path.basename(columns['file_path'])}: {n_played} plays, "
+                     f"{columns['bytes'] / 1e6:.1f} MB in {seconds:.2f}s "
+                     f"({n_played / seconds:.0f} plays/s, {columns['bytes'] / 1e6 / seconds:.1f} MB/s)")
+            all_columns.append(columns)
+
+    total_played = sum(len(columns['timestamp']) for columns in all_columns)
+    log.info(f'Parsed {len(all_columns)} gdpr files with {workers} workers: {total_played} plays in {time.perf_counter() - start:.2f}s')
+
+    return heapq.merge(*(_iter_columns(columns) for columns in all_columns), key=lambda x: x['timestamp'])
+
+
+def _chunked(iterable, chunk_size: int):
+    """
+    This function splits an iterable into lists of at most chunk_size items.
+
+    :param: iterable any iterable
+    :param: chunk_size maximal size of a chunk
+    :return: generator yielding lists
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
 
 
 def _extract_id(spotify_id: str) -> str:
@@ -65,62 +387,160 @@ def _extract_id(spotify_id: str) -> str:
     return prefix_removed_id
 
 
-def _populate_ids(all_songs_played: list):
+def _scan_track_ids(file_path: str, offset: int = 0, chunk_size: int = 1048576) -> set:
+    """
+    This function collects the ids of all tracks played in a single gdpr .json file.
+    The raw text is searched for the track uris instead of decoding the json, which is a lot faster.
 
-    track_ids = []
-    all_songs_played_info = []
-    token = simple_authenticate()
+    :param: file_path path to the gdpr .json file
+    :param: offset byte offset to start at, read from the import checkpoint
+    :param: chunk_size number of bytes searched at once
+    :return: set of track ids
+    """
+    track_ids = set()
+    tail = b''
+
+    with open(file_path, 'rb') as file:
+        file.seek(offset)
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                return track_ids
+            buffer = tail + chunk
+            track_ids.update(track_id.decode('utf-8') for track_id in TRACK_URI_PATTERN.findall(buffer))
+            # An uri cut off at the end of the chunk is complete in the next buffer, matching it twice is harmless
+            tail = buffer[-TRACK_URI_OVERLAP:]
+
+
+def _gdpr_track_ids(checkpoints: dict = None) -> set:
+    """
+    This function collects the ids of all tracks played in the gdpr files which are not imported yet.
 
-    processed_songs_id = set()
+    :param: checkpoints dict mapping file names to the byte offset their import is resumed at
+    :return: set of track ids
+    """
+    checkpoints = checkpoints or {}
+    track_ids = set()
+    for file_path in _gdpr_files():
+        try:
+            track_ids.update(_scan_track_ids(file_path, checkpoints.get(os.path.basename(file_path), 0)))
+        except Exception as e:
+            log.error(f'Failed to read the track ids of {file_path}: {e}')
 
-    counter = 0
+    return track_ids
 
-    for entry in all_songs_played:
-        track_id = entry['id']
 
-        if track_id not in processed_songs_id:
-            track_ids.append(track_id)
-            processed_songs_id.add(track_id)
-            counter += 1
+def _unresolved_track_ids(db: Database, track_ids) -> list:
+    """
+    This function finds the tracks whose album and artist ids are not in the track mapping yet.
 
-        if (counter + 1) % 50 == 0 and len(track_ids) > 0:
-            track_ids_tuple = tuple(track_ids)
-            track_ids.clear()
-            response = get_multiple_field_information(token, 'tracks', 50, *track_ids_tuple)
-            all_songs_played_info.extend(_sort_and_create_required_dataset(response))
-            counter = 0
+    :param: db Database
+    :param: track_ids iterable of track ids
+    :return: list of track ids, sorted so the batches are the same in every run
+    """
+    track_ids = set(track_ids)
+    track_ids.difference_update(track_id for track_id, in db.read_rows_by_ids(Table.TRACK_MAPPING, 'track_id', track_ids, 'track_id'))
+    return sorted(track_ids)
 
-    if len(track_ids) > 0:
-        track_ids_tuple = tuple(track_ids)
-        response = get_multiple_field_information(token, 'tracks', 50, *track_ids_tuple)
-        all_songs_played_info.extend(_sort_and_create_required_dataset(response))
 
-    return all_songs_played_info
+def _load_resolved_ids(db: Database, all_songs_played: list) -> dict:
+    """
+    This function reads the album and artist ids of the songs played from the track mapping.
+
+    :param: db Database
+    :param: all_songs_played list of songs played
+    :return: dict mapping track ids to their album and artist ids
+    """
+    all_songs_catalogued = {}
+    track_ids = {entry['id'] for entry in all_songs_played}
+    for track_id, artist_id, album_id in db.read_rows_by_ids(Table.TRACK_MAPPING, 'track_id', track_ids,
+                                                             'track_id, artist_id, album_id'):
+        all_songs_catalogued[track_id] = {'album_id': album_id, 'artist_id': artist_id}
+
+    return all_songs_catalogued
+
+
+def _save_resolved_ids(db: Database, track_ids: tuple, response) -> None:
+    """
+    This function saves the album and artist ids of a resolved batch of tracks right away,
+    so an interrupted import does not request them again.
+    Tracks the api returns as null are saved without album and artist ids, they are not requested again
+    and their plays are imported without them. Nothing is saved for a failed request, its tracks are requested again.
+
+    :param: db Database
+    :param: track_ids tuple of the requested track ids
+    :param: response json response of the tracks endpoint, None if the request failed
+    """
+    track_id_to_artist_album = _sort_and_create_required_dataset(response)
+    rows = [(track_id, ids['artist_id'], ids['album_id']) for track_id, ids in track_id_to_artist_album.items()]
+    if response is not None:
+        unknown_track_ids = [track_id for track_id in track_ids if track_id not in track_id_to_artist_album]
+        if unknown_track_ids:
+            log.warning(f'{len(unknown_track_ids)} gdpr tracks are unknown to the api, their plays have no album and artist ids')
+        rows.extend((track_id, None, None) for track_id in unknown_track_ids)
+    db.add_track_mappings(rows)
+
+
+def _populate_ids(db: Database, track_ids: list, token: str) -> None:
+    """
+    This function requests the album and artist ids of the tracks and saves them to the track mapping.
+
+    :param: db Database
+    :param: track_ids list of distinct track ids which are not in the track mapping
+    :param: token bearer token for the api
+    """
+    limit = endpoint_limit('tracks')
+    for track_ids_tuple in iter_id_batches(track_ids, limit):
+        response = get_multiple_field_information(token, 'tracks', limit, *track_ids_tuple)
+        _save_resolved_ids(db, track_ids_tuple, response)
+
+
+async def _populate_ids_async(db: Database, track_ids: list, token: str, concurrency: int) -> None:
+    """
+    This function requests the album and artist ids of the tracks concurrently through the asyncio client
+    and saves them to the track mapping. The responses are saved on the event loop, so there is a single writer.
+
+    :param: db Database
+    :param: track_ids list of distinct track ids which are not in the track mapping
+    :param: token bearer token for the api
+    :param: concurrency maximal number of requests in flight
+    """
+    limit = endpoint_limit('tracks')
+
+    async with AsyncSpotifyClient(max_in_flight=concurrency) as client:
+        async def resolve_batch(track_ids_tuple: tuple) -> None:
+            response = await client.get_multiple_field_information(token, 'tracks', limit, *track_ids_tuple)
+            # Saved as soon as the response arrives, a batch failing later does not discard it
+            _save_resolved_ids(db, track_ids_tuple, response)
+
+        await gather_or_cancel(*(resolve_batch(track_ids_tuple) for track_ids_tuple in iter_id_batches(track_ids, limit)))
 
 
 def _sort_and_create_required_dataset(response) -> dict:
 
-    track_list = []
+    track_id_to_artist_album = {}
+
+    if response is None:
+        log.error('No response for a batch of tracks, their album and artist ids stay empty')
+        return track_id_to_artist_album
 
     for entry in response['tracks']:
-        track_data = {
-            'track_id': entry['id'],
+        # Unknown ids are returned as null
+        if entry is None:
+            continue
+        track_id_to_artist_album[entry['id']] = {
             'album_id': entry['album']['id'],
             'artist_id': entry['artists'][0]['id']
         }
-        track_list.append(track_data)
 
-    return track_list
+    return track_id_to_artist_album
 
 
-def _fill_missing_ids(all_songs_played, all_songs_catalogued):
+def _fill_missing_ids(all_songs_played, all_songs_catalogued: dict):
 
-    # Create a dictionary to map track_id to artist_id and album_id
-    track_id_to_artist_album = {data['track_id']: {'album_id': data['album_id'], 'artist_id': data['artist_id']} for data in all_songs_catalogued}
-
-    # Now, we will update the original `tracks` list by adding artist_id and album_id
+    # Update the original `tracks` list by adding artist_id and album_id
     for track in all_songs_played:
-        track_info = track_id_to_artist_album.get(track['id'])
+        track_info = all_songs_catalogued.get(track['id'])
         if track_info:
             track['artist_id'] = track_info['artist_id']
             track['album_id'] = track_info['album_id']
@@ -128,22 +548,113 @@ def _fill_missing_ids(all_songs_played, all_songs_catalogued):
     return all_songs_played
 
 
-def _insert_data_into_db(db: Database, all_songs_played: list):
+def _import_checkpoints(all_songs_played: list, stalled_files: set, fingerprints: dict) -> dict:
+    """
+    This function finds the end offset of the last imported song played of every file.
+    A file stalls at its first song played whose ids could not be resolved, so a resumed import retries it.
+
+    :param: all_songs_played list of songs played, ordered by timestamp ascending
+    :param: stalled_files set of file names whose checkpoint is not advanced anymore, extended in place
+    :param: fingerprints dict mapping file names to the fingerprint of the file, saved with its offset
+    :return: dict mapping file names to (byte offset, file size, modification time in ns) tuples
+    """
+    offsets = {}
+    for entry in all_songs_played:
+        file_name = entry['file']
+        if file_name in stalled_files:
+            continue
+        if 'artist_id' not in entry:
+            stalled_files.add(file_name)
+            continue
+        offsets[file_name] = entry['offset']
+
+    return {file_name: (offset, *fingerprints[file_name]) for file_name, offset in offsets.items()}
+
+
+def _insert_data_into_db(db: Database, all_songs_played: list, flush_size: int = 5000, checkpoints: dict = None):
     """
-    This function takes a list of all played songs and inserts these into the database.
+    This function takes a list of all played songs and inserts these into the database,
+    together with their gdpr fields into the play events.
+    The songs played are committed in a single transaction together with the import checkpoints,
+    songs played which are already in the database are skipped, so a resumed import can insert them again.
+    A play and its play event are written together, if writing fails the whole transaction is rolled back and raised.
 
     :param: all_songs_played list of all songs
+    :param: flush_size number of rows written at once
+    :param: checkpoints dict mapping file names to the (byte offset, file size, modification time) imported with this chunk
     """
+    plays = []
+    events = []
     for entry in all_songs_played:
         try:
-            db.add_row(Table.RECENTLY_PLAYED, (entry['timestamp'], entry['id'], entry['artist_id'], entry['album_id']))
+            play = (entry['timestamp'], entry['id'], entry['artist_id'], entry['album_id'])
+            event = (entry['timestamp'], entry['ms_played'], entry['conn_country'], entry['platform'],
+                     entry['reason_start'], entry['reason_end'], entry['flags'])
         except Exception as e:
             log.error(f'Failed adding {entry} to database, error {e}')
+            continue
+        plays.append(play)
+        events.append(event)
+
+    with db.transaction():
+        for start in range(0, len(plays), flush_size):
+            db.add_plays_with_events(plays[start:start + flush_size], events[start:start + flush_size])
 
+        if checkpoints:
+            db.save_import_checkpoints(checkpoints)
+
+
+def export_gdpr_data(db: Database, n_limit: int = 100, chunk_size: int = 5000, workers: int = 1,
+                     use_async: bool = False, concurrency: int = 10) -> None:
+    """
+    This function streams the gdpr data into the database chunk by chunk.
+    The album and artist ids of the tracks are resolved before, from the track mapping filled by the scraper and
+    earlier imports, only the tracks missing there are requested in full batches and saved to the mapping right away.
+    An import of the whole history is resumable: every chunk is committed together with the byte offset reached in
+    every file, so after a crash or a rate limit the import continues from its last chunk.
+    The size and modification time of a file are saved with its offset, a changed file is imported from its start.
+
+    :param: db Database
+    :param: n_limit only the last n_limit songs played are exported, None exports the whole history
+    :param: chunk_size number of songs played inserted at once
+    :param: workers number of processes parsing the gdpr files, 1 parses them sequentially in a stream
+    :param: use_async request the ids with the asyncio client instead of one request after another
+    :param: concurrency maximal number of requests in flight of the asyncio client
+    """
+    # The checkpoints are skipped when only the last n_limit plays are exported, the earlier plays are not imported
+    resumable = n_limit is None
+    fingerprints = {os.path.basename(file_path): _file_fingerprint(file_path) for file_path in _gdpr_files()} if resumable else {}
+    checkpoints = _resume_offsets(db, fingerprints) if resumable else {}
+    if checkpoints:
+        log.info(f'Resuming the gdpr import of {len(checkpoints)} files from their checkpoints')
+
+    if workers > 1:
+        all_songs_played = _read_gdrp_data_parallel(workers, checkpoints)
+    else:
+        all_songs_played = _read_gdrp_data(checkpoints)
+    if n_limit is not None:
+        # Only the last n_limit plays are kept, which bounds the memory by the limit instead of the history size
+        all_songs_played = deque(all_songs_played, maxlen=n_limit)
+        track_ids = {entry['id'] for entry in all_songs_played}
+    else:
+        track_ids = _gdpr_track_ids(checkpoints)
+    unresolved_track_ids = _unresolved_track_ids(db, track_ids)
+    log.info(f'Resolved {len(track_ids) - len(unresolved_track_ids)} of {len(track_ids)} gdpr tracks from the track mapping, '
+             f'requesting {len(unresolved_track_ids)}')
+
+    if unresolved_track_ids:
+        token = simple_authenticate()
+        if use_async:
+            asyncio.run(_populate_ids_async(db, unresolved_track_ids, token, concurrency))
+        else:
+            _populate_ids(db, unresolved_track_ids, token)
+
+    stalled_files = set()
+    try:
+        for chunk in _chunked(all_songs_played, chunk_size):
+            chunk = _fill_missing_ids(chunk, _load_resolved_ids(db, chunk))
+            _insert_data_into_db(db, chunk, checkpoints=_import_checkpoints(chunk, stalled_files, fingerprints) if resumable else None)
+    except Exception as e:
+        log.error(f'Stopping the gdpr import, the chunk being written was rolled back: {e}')
 
-def export_gdpr_data(db: Database, n_limit: int = 100) -> None:
-    all_songs_played = _read_gdrp_data()
-    all_songs_played = all_songs_played[-n_limit:]
-    all_songs_catalogued = _populate_ids(all_songs_played)
-    all_songs_played = _fill_missing_ids(all_songs_played, all_songs_catalogued)
-    _insert_data_into_db(db, all_songs_played)
+    get_cache().log_stats('export_gdpr_data')
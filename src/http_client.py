@@ -0,0 +1,253 @@
+import asyncio
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from logger import LoggerWrapper
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+log = LoggerWrapper()
+
+
+class RequestScheduler:
+    """
+    A token bucket shared by all threads and event loops sending requests to the api.
+    The rate adapts to the api: it is halved whenever a request is throttled and slowly increased again
+    on every successful request, so sustained workloads settle just below the rate limit.
+    """
+
+    def __init__(self, rate: float = 10, max_rate: float = 30, min_rate: float = 0.5, burst: int = 10):
+        """
+        :param rate: float initial number of requests per second
+        :param max_rate: float upper bound of the adaptive rate
+        :param min_rate: float lower bound of the adaptive rate
+        :param burst: int number of requests which may be sent at once
+        """
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+        self.requests = 0
+        self.throttled_responses = 0
+        # Seconds waited because the api throttled the requests, and seconds waited to keep the rate
+        self.throttled_seconds = 0.0
+        self.paced_seconds = 0.0
+
+    def acquire(self) -> None:
+        """Block until a request may be sent"""
+        while True:
+            wait = self._try_acquire()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self) -> None:
+        """Wait on the event loop until a request may be sent"""
+        while True:
+            wait = self._try_acquire()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def _try_acquire(self) -> float:
+        """
+        Take a token if one is available
+
+        :return: float seconds to wait before trying again, 0 if a token was taken
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait = self.blocked_until - now
+            if wait > 0:
+                self.throttled_seconds += wait
+                return wait
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.requests += 1
+                return 0.0
+            wait = (1 - self.tokens) / self.rate
+            self.paced_seconds += wait
+            return wait
+
+    def throttle(self, retry_after: float) -> None:
+        """
+        Pause all requests for retry_after seconds and halve the rate
+
+        :param retry_after: float seconds until requests may be sent again
+        """
+        with self.lock:
+            self.throttled_responses += 1
+            self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+        log.warning(f"Request throttled, pausing for {retry_after:.1f}s and lowering the rate to {self.rate:.2f} requests/s")
+
+    def success(self) -> None:
+        """Increase the rate after a successful request"""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + 0.1)
+
+    def stats(self) -> dict:
+        """Return the counters of the scheduler"""
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'throttled_responses': self.throttled_responses,
+                'throttled_seconds': round(self.throttled_seconds, 3),
+                'paced_seconds': round(self.paced_seconds, 3),
+                'rate': round(self.rate, 2),
+            }
+
+
+def _retry_after(response: requests.Response, default: float) -> float:
+    """
+    Read the number of seconds to wait from the Retry-After header of a response
+
+    :param response: requests.Response
+    :param default: float used if the header is missing or not a number of seconds
+    :return: float
+    """
+    try:
+        return max(float(response.headers['Retry-After']), 0.0)
+    except (KeyError, TypeError, ValueError):
+        return default
+
+
+class HttpClient:
+    """
+    A class wrapping a pooled requests session, so connections are kept alive and reused between requests
+    """
+
+    def __init__(self, pool_size: int = 10, timeout: float = 10, bearer_token: str = None,
+                 scheduler: RequestScheduler = None, max_retries: int = 5, backoff: float = 1, max_backoff: float = 60):
+        """
+        Initialize the session and its connection pool
+
+        :param pool_size: int maximal number of connections kept alive per host
+        :param timeout: float default timeout in seconds for connecting and reading
+        :param bearer_token: str optional token sent with every request
+        :param scheduler: RequestScheduler limiting the request rate, a new one is created if not given
+        :param max_retries: int number of retries of idempotent requests which were throttled or failed
+        :param backoff: float seconds waited before the first retry, doubled on every further retry
+        :param max_backoff: float maximal seconds waited before a retry
+        """
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.scheduler = scheduler or RequestScheduler()
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        if bearer_token:
+            self.set_bearer_token(bearer_token)
+
+    def set_bearer_token(self, bearer_token: str) -> None:
+        """Set the default bearer token sent with every request"""
+        self.session.headers['Authorization'] = f'Bearer {bearer_token}'
+
+    def request(self, method: str, url: str, bearer_token: str = None, **kwargs) -> requests.Response:
+        """
+        Send a request through the pooled session.
+        Every request waits for the scheduler, idempotent requests are retried on throttling, server errors
+        and connection errors, honoring the Retry-After header of the api.
+
+        :param method: str http method
+        :param url: str
+        :param bearer_token: str optional token overriding the default token for this request
+        :return: requests.Response the last response, also if all retries failed
+        """
+        headers = dict(kwargs.pop('headers', None) or {})
+        if bearer_token:
+            headers['Authorization'] = f'Bearer {bearer_token}'
+        kwargs.setdefault('timeout', self.timeout)
+
+        retries = self.max_retries if method.upper() in IDEMPOTENT_METHODS else 0
+
+        for attempt in range(retries + 1):
+            backoff = min(self.max_backoff, self.backoff * 2 ** attempt)
+            self.scheduler.acquire()
+            log.debug(f"{method} Request: {url}")
+
+            try:
+                response = self.session.request(method, url, headers=headers, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt == retries:
+                    raise
+                log.warning(f"{method} {url} failed: {e}. Retrying in {backoff:.1f}s")
+                time.sleep(backoff)
+                continue
+
+            if response.status_code == 429:
+                # Also on the last attempt, so the other requests pause until the api accepts requests again
+                self.scheduler.throttle(_retry_after(response, backoff))
+
+            if response.status_code not in RETRY_STATUS_CODES or attempt == retries:
+                if response.status_code < 400:
+                    self.scheduler.success()
+                return response
+
+            # The response is discarded, closing it returns its connection to the pool even if its body was streamed
+            response.close()
+            if response.status_code != 429:
+                log.warning(f"{method} {url} returned {response.status_code}. Retrying in {backoff:.1f}s")
+                time.sleep(backoff)
+
+        return response
+
+    def get(self, url: str, bearer_token: str = None, **kwargs) -> requests.Response:
+        """Send a GET request through the pooled session"""
+        return self.request('GET', url, bearer_token=bearer_token, **kwargs)
+
+    def post(self, url: str, bearer_token: str = None, **kwargs) -> requests.Response:
+        """Send a POST request through the pooled session"""
+        return self.request('POST', url, bearer_token=bearer_token, **kwargs)
+
+    def close(self) -> None:
+        """Close all pooled connections"""
+        self.session.close()
+
+
+_client = None
+
+
+def get_client() -> HttpClient:
+    """
+    Return the http client shared by all api calls, creating it on first use
+
+    :return: HttpClient
+    """
+    global _client
+    if _client is None:
+        _client = HttpClient()
+    return _client
+
+
+def configure_client(pool_size: int = 10, timeout: float = 10) -> HttpClient:
+    """
+    Replace the shared http client with one using the given pool size and timeout
+
+    :param pool_size: int
+    :param timeout: float
+    :return: HttpClient
+    """
+    global _client
+    if _client is not None:
+        _client.close()
+    _client = HttpClient(pool_size=pool_size, timeout=timeout)
+    return _client
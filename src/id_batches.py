@@ -0,0 +1,41 @@
+from itertools import islice
+
+# Maximal number of ids the endpoints requesting multiple entries at once accept
+ENDPOINT_LIMITS = {
+    'tracks': 50,
+    'artists': 50,
+    'albums': 20,
+    'audio-features': 100,
+}
+
+
+def endpoint_limit(endpoint_name: str) -> int:
+    """
+    Return the maximal number of ids of one request to an endpoint
+
+    :param endpoint_name: str e.g. tracks or audio-features
+    :return: int
+    """
+    return ENDPOINT_LIMITS[endpoint_name]
+
+
+def iter_id_batches(ids, limit: int):
+    """
+    Split ids into batches of exactly limit distinct ids, only the last batch can be smaller.
+    Duplicates are dropped before they take a place in a batch, so n distinct ids take ceil(n / limit) requests.
+
+    :param ids: iterable of ids, consumed lazily
+    :param limit: int number of ids per batch
+    :return: generator yielding tuples of ids in the order they first occur
+    """
+    if limit < 1:
+        raise ValueError(f'The batch limit has to be positive, got {limit}')
+
+    seen = set()
+    distinct_ids = (id_value for id_value in ids if not (id_value in seen or seen.add(id_value)))
+
+    while True:
+        batch = tuple(islice(distinct_ids, limit))
+        if not batch:
+            return
+        yield batch
@@ -0,0 +1,83 @@
+import sqlite3
+from typing import Iterable, Optional
+
+from logger import LoggerWrapper
+
+ID_DICTIONARY_TABLE = "id_dictionary"
+
+log = LoggerWrapper()
+
+
+class IdDictionary:
+    """
+    A class which interns Spotify ids as dense integer keys, shared by tracks, artists and albums.
+    The mapping is persisted in the id_dictionary table and kept in memory in both directions:
+    a dict from id to key and a list indexed by key, which shares the string objects of the dict,
+    so the reverse direction costs one pointer per id.
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        """
+        :param conn: sqlite3.Connection holding the id_dictionary table, new ids are written in its current transaction
+        """
+        self.conn = conn
+        self.reload()
+
+    def reload(self) -> None:
+        """Load the mapping from the database, dropping ids which were interned but never written"""
+        self.key_by_id = {}
+        self.ids = []
+        self.pending = []
+
+        for key, spotify_id in self.conn.execute(f"SELECT id_key, spotify_id FROM {ID_DICTIONARY_TABLE} ORDER BY id_key"):
+            # Keys are assigned densely from 0, gaps only appear if rows were deleted by hand
+            self.ids.extend([None] * (key - len(self.ids)))
+            self.ids.append(spotify_id)
+            self.key_by_id[spotify_id] = key
+        log.debug(f"Loaded {len(self.key_by_id)} ids into the id dictionary")
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def key(self, spotify_id: Optional[str]) -> Optional[int]:
+        """Return the key of an id without interning it, None if the id is unknown"""
+        return self.key_by_id.get(spotify_id)
+
+    def spotify_id(self, key: Optional[int]) -> Optional[str]:
+        """Return the Spotify id of a key, None for a missing key"""
+        return None if key is None else self.ids[key]
+
+    def intern(self, spotify_id: Optional[str]) -> Optional[int]:
+        """
+        Return the key of an id, assigning the next free key to unknown ids.
+        New ids are only written to the database by flush.
+
+        :param spotify_id: str or None
+        :return: int or None for a missing id
+        """
+        if spotify_id is None:
+            return None
+        key = self.key_by_id.get(spotify_id)
+        if key is None:
+            key = len(self.ids)
+            self.ids.append(spotify_id)
+            self.key_by_id[spotify_id] = key
+            self.pending.append((key, spotify_id))
+        return key
+
+    def intern_many(self, spotify_ids: Iterable[Optional[str]]) -> list:
+        """Intern multiple ids, see intern"""
+        return [self.intern(spotify_id) for spotify_id in spotify_ids]
+
+    def flush(self) -> int:
+        """
+        Write the ids interned since the last flush, inside the current transaction of the connection.
+
+        :return: int number of written ids
+        """
+        if not self.pending:
+            return 0
+        self.conn.executemany(f"INSERT INTO {ID_DICTIONARY_TABLE} VALUES (?, ?)", self.pending)
+        n_written = len(self.pending)
+        self.pending = []
+        return n_written
@@ -0,0 +1,106 @@
+from enum import IntEnum, IntFlag
+from functools import lru_cache
+
+
+class PlayReason(IntEnum):
+    """Why a play started or ended, the reason_start and reason_end fields of the gdpr data"""
+    UNKNOWN = 0
+    TRACKDONE = 1
+    CLICKROW = 2
+    FWDBTN = 3
+    BACKBTN = 4
+    PLAYBTN = 5
+    ENDPLAY = 6
+    APPLOAD = 7
+    REMOTE = 8
+    TRACKERROR = 9
+    LOGOUT = 10
+    UNEXPECTED_EXIT = 11
+    UNEXPECTED_EXIT_WHILE_PAUSED = 12
+    POPUP = 13
+    URIOPEN = 14
+    PERSISTED = 15
+    SWITCHED_TO_AUDIO = 16
+    SWITCHED_TO_VIDEO = 17
+    CLICKSIDE = 18
+
+
+class Platform(IntEnum):
+    """The device family of the free text platform field of the gdpr data"""
+    UNKNOWN = 0
+    ANDROID = 1
+    IOS = 2
+    WINDOWS = 3
+    MACOS = 4
+    LINUX = 5
+    WEB = 6
+    CONNECTED_DEVICE = 7
+    OTHER = 8
+
+
+class PlayFlag(IntFlag):
+    """The boolean fields of the gdpr data, stored as bits of one integer"""
+    SHUFFLE = 1
+    SKIPPED = 2
+    OFFLINE = 4
+    INCOGNITO = 8
+
+
+# Substrings of the lower case platform field and their family, the first match wins
+PLATFORM_PATTERNS = (
+    ('web_player', Platform.WEB),
+    ('webplayer', Platform.WEB),
+    ('android', Platform.ANDROID),
+    ('ios', Platform.IOS),
+    ('iphone', Platform.IOS),
+    ('ipad', Platform.IOS),
+    ('windows', Platform.WINDOWS),
+    ('os x', Platform.MACOS),
+    ('osx', Platform.MACOS),
+    ('macos', Platform.MACOS),
+    ('linux', Platform.LINUX),
+    ('cast', Platform.CONNECTED_DEVICE),
+    ('partner', Platform.CONNECTED_DEVICE),
+    ('sonos', Platform.CONNECTED_DEVICE),
+    ('tv', Platform.CONNECTED_DEVICE),
+)
+
+_SHUFFLE, _SKIPPED, _OFFLINE, _INCOGNITO = (flag.value for flag in PlayFlag)
+_REASONS = {reason.name.lower().replace('_', '-'): reason.value for reason in PlayReason}
+
+
+def encode_reason(reason: str) -> int:
+    """
+    Encode a reason_start or reason_end value, unrecognized and missing reasons are encoded as UNKNOWN
+
+    :param reason: str e.g. trackdone or unexpected-exit
+    :return: int PlayReason
+    """
+    return _REASONS.get(reason, PlayReason.UNKNOWN.value)
+
+
+@lru_cache(maxsize=1024)
+def encode_platform(platform: str) -> int:
+    """
+    Encode the platform field as its device family, the few distinct values of a history are cached
+
+    :param platform: str e.g. Android OS 11 API 30 (Samsung, SM-G991B)
+    :return: int Platform
+    """
+    if not platform:
+        return Platform.UNKNOWN.value
+    platform = platform.lower()
+    for pattern, family in PLATFORM_PATTERNS:
+        if pattern in platform:
+            return family.value
+    return Platform.OTHER.value
+
+
+def encode_flags(shuffle: bool, skipped: bool, offline: bool, incognito: bool) -> int:
+    """
+    Encode the boolean fields as bits, missing values are encoded as unset
+
+    :return: int PlayFlag
+    """
+    return ((_SHUFFLE if shuffle else 0) | (_SKIPPED if skipped else 0)
+            | (_OFFLINE if offline else 0) | (_INCOGNITO if incognito else 0))
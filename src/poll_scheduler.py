@@ -0,0 +1,98 @@
+import time
+from collections import deque
+
+from logger import LoggerWrapper
+
+# The recently played endpoint only returns the last 50 plays, and a play is only counted after 30 seconds
+RECENTLY_PLAYED_WINDOW = 50
+MIN_PLAY_SECONDS = 30
+
+log = LoggerWrapper()
+
+
+class PollScheduler:
+    """
+    A class which decides when the recently played endpoint is polled and when missing infos are backfilled.
+    The poll interval follows the observed play rate, so the 50 play window is polled about twice while it fills up,
+    but never less often than the window could fill up when skipping through tracks after 30 seconds each.
+    The backfill runs on its own, longer interval and only if new plays were added since the last one.
+    """
+
+    def __init__(self, min_interval: float = 300, max_interval: float = RECENTLY_PLAYED_WINDOW * MIN_PLAY_SECONDS,
+                 backfill_interval: float = 3600, safety_factor: float = 0.5, smoothing: float = 0.3):
+        """
+        :param min_interval: float shortest number of seconds between two polls
+        :param max_interval: float longest number of seconds between two polls, capped at the time the window needs to overflow
+        :param backfill_interval: float shortest number of seconds between two backfills
+        :param safety_factor: float fraction of the window which may fill up between two polls
+        :param smoothing: float weight of the latest observation in the moving average of the play rate
+        """
+        self.max_interval = min(max_interval, RECENTLY_PLAYED_WINDOW * MIN_PLAY_SECONDS)
+        self.min_interval = min(min_interval, self.max_interval)
+        self.backfill_interval = backfill_interval
+        self.safety_factor = safety_factor
+        self.smoothing = smoothing
+
+        self.play_rate = 0.0
+        self.interval = self.min_interval
+        self.pending_plays = 0
+        self.last_backfill = time.monotonic()
+        self.history = deque(maxlen=1000)
+
+    def record_poll(self, n_new_plays: int, elapsed: float, latency: float) -> float:
+        """
+        Update the play rate with the result of a poll and compute the interval until the next poll
+
+        :param n_new_plays: int number of new plays returned by the poll
+        :param elapsed: float seconds since the previous poll
+        :param latency: float seconds the poll took
+        :return: float seconds until the next poll
+        """
+        observed_rate = n_new_plays / max(elapsed, 1.0)
+        self.play_rate = self.smoothing * observed_rate + (1 - self.smoothing) * self.play_rate
+        self.pending_plays += n_new_plays
+
+        if n_new_plays >= RECENTLY_PLAYED_WINDOW:
+            log.warning(f"Poll returned {n_new_plays} new plays, plays older than the last {RECENTLY_PLAYED_WINDOW} may have been missed")
+            self.interval = self.min_interval
+        elif self.play_rate > 0:
+            interval = self.safety_factor * RECENTLY_PLAYED_WINDOW / self.play_rate
+            self.interval = max(self.min_interval, min(self.max_interval, interval))
+        else:
+            self.interval = self.max_interval
+
+        self.history.append((time.time(), latency, n_new_plays))
+        log.info(f"Poll took {latency:.2f}s and added {n_new_plays} new plays "
+                 f"({self.play_rate * 3600:.1f} plays/h), next poll in {self.interval:.0f}s")
+        return self.interval
+
+    def backfill_due(self) -> bool:
+        """Return whether there are new plays and the backfill interval has passed"""
+        return self.pending_plays > 0 and time.monotonic() - self.last_backfill >= self.backfill_interval
+
+    def record_backfill(self) -> None:
+        """Reset the backfill interval after a backfill"""
+        self.pending_plays = 0
+        self.last_backfill = time.monotonic()
+
+    def run(self, poll, backfill) -> None:
+        """
+        Poll and backfill forever
+
+        :param poll: callable returning the number of new plays
+        :param backfill: callable requesting the missing infos
+        """
+        last_poll = time.monotonic() - self.interval
+
+        while True:
+            start = time.monotonic()
+            n_new_plays = poll()
+            interval = self.record_poll(n_new_plays, start - last_poll, time.monotonic() - start)
+            last_poll = start
+
+            if self.backfill_due():
+                log.info('Backfilling missing infos...')
+                backfill()
+                self.record_backfill()
+
+            time.sleep(max(0.0, interval - (time.monotonic() - start)))
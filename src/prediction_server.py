@@ -0,0 +1,214 @@
+import json
+import math
+import queue
+import statistics
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from logger import LoggerWrapper
+
+MAX_K = 100
+
+log = LoggerWrapper()
+
+
+class PredictionServer:
+    """
+    A local http server answering next track predictions of a model loaded once at startup.
+    Requests arriving within batch_window seconds of each other are predicted together in one call of the model,
+    recent results are cached and the latency of every request is recorded.
+    The http server and the batching run in daemon threads, so serving never blocks the scraping loop.
+
+    GET /predict?track_id=<id>&k=10 returns the predicted successors of a track, the track_id parameter can be
+    repeated to pass the recent history, oldest first. GET /stats returns the latency percentiles and counters.
+    """
+
+    def __init__(self, predict_batch, host: str = '127.0.0.1', port: int = 8080, max_batch_size: int = 64,
+                 batch_window: float = 0.002, cache_size: int = 10000):
+        """
+        :param predict_batch: callable mapping a list of track id histories and k to a list of (track_id, probability) lists
+        :param host: str address the server listens on
+        :param port: int port the server listens on, 0 picks a free port
+        :param max_batch_size: int maximal number of requests predicted at once
+        :param batch_window: float seconds the first request of a batch waits for more requests
+        :param cache_size: int number of cached results
+        """
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.cache_size = cache_size
+
+        self.requests = queue.Queue()
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=10000)
+        self.n_requests = 0
+        self.n_cache_hits = 0
+        self.n_batches = 0
+        self.n_batched_requests = 0
+
+        handler = type('_BoundPredictionHandler', (_PredictionHandler,), {'prediction_server': self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.threads = []
+
+    @property
+    def address(self) -> tuple:
+        return self.server.server_address
+
+    def start(self) -> 'PredictionServer':
+        """Start serving in background threads"""
+        self.threads = [threading.Thread(target=self.server.serve_forever, daemon=True, name='prediction-server'),
+                        threading.Thread(target=self._batch_loop, daemon=True, name='prediction-batcher')]
+        for thread in self.threads:
+            thread.start()
+        log.info(f"Serving predictions on http://{self.address[0]}:{self.address[1]}/predict")
+        return self
+
+    def stop(self) -> None:
+        """Stop serving and wait for the background threads"""
+        self.server.shutdown()
+        self.server.server_close()
+        self.requests.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def predict(self, history: tuple, k: int, timeout: float = 5) -> list:
+        """
+        Return the predictions for a history, from the cache or from the next batch of the model
+
+        :param history: tuple of track ids, oldest first
+        :param k: int number of predictions
+        :param timeout: float seconds to wait for the batch
+        :return: list of (track_id, probability) tuples
+        """
+        start = time.perf_counter()
+        key = (history, k)
+        with self.lock:
+            self.n_requests += 1
+            result = self.cache.get(key)
+            if result is not None:
+                self.cache.move_to_end(key)
+                self.n_cache_hits += 1
+
+        if result is None:
+            future = Future()
+            self.requests.put((history, k, future))
+            result = future.result(timeout)
+            with self.lock:
+                self.cache[key] = result
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+        with self.lock:
+            self.latencies.append(time.perf_counter() - start)
+        return result
+
+    def clear_cache(self) -> None:
+        """Drop the cached results, called after the model was updated"""
+        with self.lock:
+            self.cache.clear()
+
+    def _batch_loop(self) -> None:
+        """Collect the queued requests into batches and predict them together"""
+        stopped = False
+        while not stopped:
+            item = self.requests.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.batch_window
+
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopped = True
+                    break
+                batch.append(item)
+
+            try:
+                results = self.predict_batch([history for history, _, _ in batch], max(k for _, k, _ in batch))
+            except Exception as e:
+                log.error(f"Error while predicting a batch of {len(batch)} requests: {e}")
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            with self.lock:
+                self.n_batches += 1
+                self.n_batched_requests += len(batch)
+            for (_, k, future), result in zip(batch, results):
+                future.set_result(result[:k])
+
+    def stats(self) -> dict:
+        """Return the latency percentiles of the recent requests in milliseconds and the request counters"""
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = {
+                'requests': self.n_requests,
+                'cache_hits': self.n_cache_hits,
+                'batches': self.n_batches,
+                'mean_batch_size': round(self.n_batched_requests / self.n_batches, 2) if self.n_batches else 0.0,
+            }
+        if latencies:
+            stats['p50_ms'] = round(statistics.median(latencies) * 1000, 3)
+            # Nearest rank, the smallest latency at least 99% of the requests did not exceed
+            stats['p99_ms'] = round(latencies[min(len(latencies) - 1, math.ceil(0.99 * len(latencies)) - 1)] * 1000, 3)
+        return stats
+
+
+class _PredictionHandler(BaseHTTPRequestHandler):
+    """Answers the requests of a PredictionServer with json"""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    prediction_server = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/stats':
+            self._send_json(200, self.prediction_server.stats())
+            return
+        if url.path != '/predict':
+            self._send_json(404, {'error': f'unknown path {url.path}'})
+            return
+
+        query_params = parse_qs(url.query)
+        history = tuple(query_params.get('track_id', []))
+        try:
+            k = int(query_params.get('k', ['10'])[0])
+        except ValueError:
+            k = 0
+        if not history or not 1 <= k <= MAX_K:
+            self._send_json(400, {'error': f'pass at least one track_id and k between 1 and {MAX_K}'})
+            return
+
+        try:
+            predictions = self.prediction_server.predict(history, k)
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+            return
+        self._send_json(200, {'track_id': history[-1],
+                              'predictions': [{'track_id': track_id, 'probability': probability}
+                                              for track_id, probability in predictions]})
+
+    def _send_json(self, status: int, body: dict) -> None:
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(f"Prediction server: {format % args}")
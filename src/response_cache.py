@@ -0,0 +1,174 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from logger import LoggerWrapper
+
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'response_cache.db')
+
+log = LoggerWrapper()
+
+
+class ResponseCache:
+    """
+    An on disk cache of api responses keyed by endpoint and id, stored in a SQLite file.
+    Entries expire after ttl seconds, and the least recently used entries are evicted once more than max_entries are stored.
+    """
+
+    def __init__(self, db_name: str = CACHE_PATH, ttl: float = 30 * 24 * 3600, max_entries: int = 500000):
+        """
+        Initialize the connection to the cache file
+
+        :param db_name: str path of the cache file
+        :param ttl: float seconds after which an entry is stale
+        :param max_entries: int maximal number of entries kept
+        """
+        if db_name != ':memory:':
+            Path(os.path.dirname(os.path.abspath(db_name))).mkdir(parents=True, exist_ok=True)
+
+        self.db_name = db_name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        # The cache is shared by the threads of the concurrent backfill, all access is serialized by the lock
+        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            endpoint TEXT,
+            id TEXT,
+            response TEXT,
+            created_at REAL,
+            accessed_at REAL,
+            PRIMARY KEY (endpoint, id)
+        );
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_response_cache_accessed_at ON response_cache (accessed_at);')
+        self.conn.commit()
+        # Counted once, kept up to date by put_many, so a put does not scan the whole cache
+        self.n_entries = self.conn.execute('SELECT COUNT(*) FROM response_cache').fetchone()[0]
+
+    def get_many(self, endpoint: str, ids) -> dict:
+        """
+        Look up the cached responses for the given ids
+
+        :param endpoint: str api endpoint, e.g. tracks
+        :param ids: iterable of ids
+        :return: dict mapping the ids found in the cache to their response
+        """
+        ids = list(ids)
+        if not ids:
+            return {}
+
+        now = time.time()
+        placeholders = ', '.join(['?'] * len(ids))
+
+        with self.lock:
+            rows = self.conn.execute(f'''
+            SELECT id, response FROM response_cache
+            WHERE endpoint = ? AND id IN ({placeholders}) AND created_at > ?
+            ''', (endpoint, *ids, now - self.ttl)).fetchall()
+
+            if rows:
+                self.conn.executemany('UPDATE response_cache SET accessed_at = ? WHERE endpoint = ? AND id = ?',
+                                      [(now, endpoint, row[0]) for row in rows])
+                self.conn.commit()
+
+            self.hits += len(rows)
+            self.misses += len(ids) - len(rows)
+
+        return {row[0]: json.loads(row[1]) for row in rows}
+
+    def get(self, endpoint: str, id: str):
+        """
+        Look up the cached response for a single id
+
+        :return: dict or None on a cache miss
+        """
+        return self.get_many(endpoint, (id,)).get(id)
+
+    def put_many(self, endpoint: str, responses: dict) -> None:
+        """
+        Save responses in the cache and evict the least recently used entries if the cache is full
+
+        :param endpoint: str api endpoint, e.g. tracks
+        :param responses: dict mapping ids to their response
+        """
+        if not responses:
+            return
+
+        now = time.time()
+        placeholders = ', '.join(['?'] * len(responses))
+        with self.lock:
+            # Replaced entries are looked up by their primary key, only new entries grow the cache
+            n_replaced = self.conn.execute(f'SELECT COUNT(*) FROM response_cache WHERE endpoint = ? AND id IN ({placeholders})',
+                                           (endpoint, *responses)).fetchone()[0]
+            self.conn.executemany('INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?)',
+                                  [(endpoint, id, json.dumps(response), now, now) for id, response in responses.items()])
+            self.n_entries += len(responses) - n_replaced
+            if self.n_entries > self.max_entries:
+                cursor = self.conn.execute('''
+                DELETE FROM response_cache WHERE rowid IN (
+                    SELECT rowid FROM response_cache ORDER BY accessed_at LIMIT ?
+                )
+                ''', (self.n_entries - self.max_entries,))
+                self.n_entries -= cursor.rowcount
+            self.conn.commit()
+
+    def put(self, endpoint: str, id: str, response: dict) -> None:
+        """Save the response for a single id in the cache"""
+        self.put_many(endpoint, {id: response})
+
+    def stats(self) -> dict:
+        """Return the hit and miss counters"""
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            }
+
+    def log_stats(self, message: str) -> None:
+        """Log the hit and miss counters of the current run and reset them"""
+        log.info(f"Response cache stats for {message}: {self.stats()}")
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+
+    def close(self) -> None:
+        """Close the connection to the cache file"""
+        self.conn.close()
+
+
+_cache = None
+
+
+def get_cache() -> ResponseCache:
+    """
+    Return the response cache shared by all api calls, creating it on first use
+
+    :return: ResponseCache
+    """
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache()
+    return _cache
+
+
+def configure_cache(db_name: str = CACHE_PATH, ttl: float = 30 * 24 * 3600, max_entries: int = 500000) -> ResponseCache:
+    """
+    Replace the shared response cache with one using the given file, ttl and size
+
+    :return: ResponseCache
+    """
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = ResponseCache(db_name, ttl, max_entries)
+    return _cache
@@ -3,12 +3,15 @@ import atexit
 import os
 import sys
 import traceback
-from time import sleep
 
-from database_handler import Database
+from ai_analysis.next_song import NextSongModel
+from database_handler import PROFILES, Database
 from gdpr_export import export_gdpr_data
+from http_client import configure_client
 from logger import LoggerWrapper
-from scraper import scrape_missing_infos, scraping
+from poll_scheduler import PollScheduler
+from prediction_server import PredictionServer
+from scraper import poll_recently_played, scrape_missing_infos
 
 log = LoggerWrapper()
 
@@ -28,48 +31,104 @@ def _log_crash_info(exc_type, exc_value, exc_tb):
     log.critical("Stack trace:\n%s", ''.join(traceback.format_tb(exc_tb)))
 
 
-# Register the exit handler and excepthook
-atexit.register(_handle_exit)
-sys.excepthook = _log_crash_info
+def _parse_args() -> argparse.Namespace:
+    """Parse the command line arguments"""
+    parser = argparse.ArgumentParser(description="A python script written in Python3.13 which continuously checks what spotify songs "
+                                                 "the user is listening to and logging these in a local database. \n"
+                                                 "The Script also has a export function where it can read out the gdpr data exported by the user.")
+
+    # Add optional arguments
+    parser.add_argument('--verbose', '-v', action='store_true', help="Enable verbose output")
+    parser.add_argument('--export', type=str, choices=['TEST', 'PRODUCTION'], required=True,
+                        help="Export the gdpr data from spotify if not done already. Choose between TEST and PRODUCTION."
+                        "TEST will export only a small number of songs, PRODUCTION will export all songs.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of processes parsing the gdpr files in parallel. 1 parses them sequentially.")
+    parser.add_argument('--backfill-interval', type=int, default=3600,
+                        help="Minimal number of seconds between two backfills of missing track, album and artist infos.")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="Request missing infos and gdpr ids with the asyncio client, bounded by --concurrency.")
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help="Maximal number of metadata requests in flight while scraping missing infos and resolving gdpr ids. "
+                        "1 sends them one after another.")
+    parser.add_argument('--db-profile', type=str, choices=list(PROFILES), default='performance',
+                        help="SQLite settings of the database connections. default keeps the SQLite defaults, "
+                        "performance uses a write ahead log, a larger page cache and memory mapped reads.")
+    parser.add_argument('--serve', type=str, choices=['markov', 'sequence'],
+                        help="Serve next track predictions of the model over http while scraping. markov serves the transition model "
+                        "updated on every poll, sequence the model trained by ai_analysis.sequence_training.")
+    parser.add_argument('--serve-port', type=int, default=8080, help="Local port of the prediction server.")
+
+    return parser.parse_args()
+
+
+def main() -> None:
+    # Register the exit handler and excepthook
+    atexit.register(_handle_exit)
+    sys.excepthook = _log_crash_info
+
+    args = _parse_args()
+
+    if args.verbose:
+        log.set_console_handler_to_debug()
+        log.info('Enabled verbose mode')
+
+    configure_client(pool_size=max(10, args.concurrency))
+
+    data_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+    db_path = os.path.join(data_path, f'spotify_scrape_{args.export}.db')
+
+    # The models are loaded before the export, so predictions are served from the saved state while it runs
+    model_path = os.path.join(data_path, f'next_song_model_{args.export}.pkl')
+    next_song_model = NextSongModel.load(model_path)
+    prediction_server = None
+
+    if args.serve == 'markov':
+        prediction_server = PredictionServer(next_song_model.predict_batch, port=args.serve_port).start()
+    elif args.serve == 'sequence':
+        # TensorFlow is only imported when the sequence model is served
+        from ai_analysis.sequence_training import SequencePredictor
+        sequence_predictor = SequencePredictor(os.path.join(data_path, f'sequence_model_{args.export}'))
+        prediction_server = PredictionServer(sequence_predictor.predict_batch, port=args.serve_port).start()
+
+    if args.export == 'TEST':
+        export_size = 10000
+        log.info(f'Scraping GDPR Data. Sample size: {export_size}')
+        db = Database(db_path, args.db_profile)
+        export_gdpr_data(db, export_size, workers=args.workers, use_async=args.use_async, concurrency=max(1, args.concurrency))
+        scrape_missing_infos(db, args.concurrency, args.use_async)
+    elif args.export == 'PRODUCTION':
+        export_size = None
+        log.info('Scraping all GDPR Data.')
+        db = Database(db_path, args.db_profile)
+        export_gdpr_data(db, export_size, workers=args.workers, use_async=args.use_async, concurrency=max(1, args.concurrency))
+        scrape_missing_infos(db, args.concurrency, args.use_async)
+    else:
+        raise ValueError('Invalid export type. Please choose between TEST and PRODUCTION.')
+
+    def update_next_song_model() -> None:
+        """Add the new plays to the next song model and drop the predictions served from its previous state"""
+        next_song_model.update(db)
+        next_song_model.save(model_path)
+        if args.serve == 'markov':
+            prediction_server.clear_cache()
+
+    def poll() -> int:
+        """Poll the recently played tracks and add the new plays to the next song model"""
+        n_new_plays = poll_recently_played(db)
+        if n_new_plays:
+            update_next_song_model()
+        if prediction_server is not None:
+            log.info(f"Prediction server stats: {prediction_server.stats()}")
+        return n_new_plays
+
+    update_next_song_model()
 
+    log.info('Scraping API...')
+    scheduler = PollScheduler(backfill_interval=args.backfill_interval)
+    scheduler.run(poll, lambda: scrape_missing_infos(db, args.concurrency, args.use_async))
 
-# Initialize the parser
-parser = argparse.ArgumentParser(description="A python script written in Python3.13 which continuously checks what spotify songs "
-                                             "the user is listening to and logging these in a local database. \n"
-                                             "The Script also has a export function where it can read out the gdpr data exported by the user.")
-
-# Add optional arguments
-parser.add_argument('--verbose', '-v', action='store_true', help="Enable verbose output")
-parser.add_argument('--export', type=str, choices=['TEST', 'PRODUCTION'], required=True,
-                    help="Export the gdpr data from spotify if not done already. Choose between TEST and PRODUCTION."
-                    "TEST will export only a small number of songs, PRODUCTION will export all songs.")
-
-# Parse the arguments
-args = parser.parse_args()
-
-if args.verbose:
-    log.set_console_handler_to_debug()
-    log.info('Enabled verbose mode')
-
-db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', f'spotify_scrape_{args.export}.db')
-
-if args.export == 'TEST':
-    export_size = 10000
-    log.info(f'Scraping GDPR Data. Sample size: {export_size}')
-    db = Database(db_path)
-    export_gdpr_data(db, export_size)
-    scrape_missing_infos(db)
-elif args.export == 'PRODUCTION':
-    export_size = 1000000
-    log.info('Scraping all GDPR Data.')
-    db = Database(db_path)
-    export_gdpr_data(db, export_size)
-    scrape_missing_infos(db)
-else:
-    raise ValueError('Invalid export type. Please choose between TEST and PRODUCTION.')
 
-while True:
-    log.info('Scraping API...')
-    scraping(db)
-    log.info('Done scraping API. Sleeping for 30 minutes...')
-    sleep(1800)
+# The gdpr import starts worker processes, which import this module again under the spawn and forkserver start methods
+if __name__ == '__main__':
+    main()
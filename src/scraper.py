@@ -1,131 +1,306 @@
+import asyncio
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime
+from itertools import chain
+
+from async_spotify_api import AsyncSpotifyClient
 from auth import authenticate, simple_authenticate
 from database_handler import Database, Table
+from http_client import get_client
+from id_batches import endpoint_limit, iter_id_batches
 from logger import LoggerWrapper
+from response_cache import get_cache
 from spotify_api import get_last_played_track, get_multiple_field_information
 
+RECENTLY_PLAYED_URL = "https://api.spotify.com/v1/me/player/recently-played?limit=50"
+RECENTLY_PLAYED_AFTER_KEY = "recently_played_after"
+MAX_RECENTLY_PLAYED_PAGES = 10
+# Key of the entries in the response of every information table
+RESPONSE_KEYS = {
+    Table.TRACK_INFORMATION: 'tracks',
+    Table.ALBUM_INFORMATION: 'albums',
+    Table.ARTIST_INFORMATION: 'artists',
+    Table.TRACK_ATTRIBUTES: 'audio_features',
+}
+
 log = LoggerWrapper()
 
 
-def scraping(db: Database) -> None:
+def scraping(db: Database, concurrency: int = 1) -> int:
     """
     This function is the main function that will be executed when the script is run
+
+    :param db: Database
+    :param concurrency: int maximal number of metadata requests in flight
+    :return: int number of new plays
+    """
+
+    n_new_plays = poll_recently_played(db)
+    scrape_missing_infos(db, concurrency)
+    return n_new_plays
+
+
+def poll_recently_played(db: Database) -> int:
+    """
+    This function adds the plays since the last poll into the database without requesting missing infos.
+
+    :param db: Database
+    :return: int number of new plays
     """
 
     scope = "user-read-recently-played"
     bearer_token = authenticate(scope)
 
-    _read_recently_played_page_and_add_to_db(db, bearer_token)
-    scrape_missing_infos(db)
+    return _read_recently_played_page_and_add_to_db(db, bearer_token)
 
 
-def _read_recently_played_page_and_add_to_db(db: Database, bearer_token: str) -> None:
+def _read_recently_played_page_and_add_to_db(db: Database, bearer_token: str) -> int:
     """
-    This function gets a list of song play history and adds it into the database.
+    This function gets the plays since the last poll and adds them into the database.
+    The played_at timestamp of the newest play is stored as high-water mark and passed as after cursor to the next poll.
+    The pages are read forward from the mark with the after cursor of each response, the next link of the api is a
+    before cursor walking back past the mark. Only new plays are inserted in a single transaction.
+
+    :return: int number of new plays
     """
 
-    last_played_track = get_last_played_track(bearer_token=bearer_token)
+    after = db.get_state(RECENTLY_PLAYED_AFTER_KEY)
+    mark = None if after is None else int(after)
+
+    rows = []
+    for _ in range(MAX_RECENTLY_PLAYED_PAGES):
+        url = RECENTLY_PLAYED_URL if after is None else f"{RECENTLY_PLAYED_URL}&after={after}"
+        last_played_track = get_last_played_track(bearer_token=bearer_token, url=url)
+        if last_played_track is None:
+            break
+
+        try:
+            items = last_played_track['items']
+            for track in reversed(items):
+                played_at = track['played_at']
+                if mark is not None and _played_at_to_epoch_ms(played_at) <= mark:
+                    continue
+                track_id = track['track']['id']
+                album_id = track['track']['album']['id']
+                artist_id = track['track']['artists'][0]['id']
+                rows.append((played_at, track_id, artist_id, album_id))
+        except Exception as e:
+            log.error(f"Failed to add returned play history to database: {e}"
+                      f"\nReturned Value: {last_played_track}")
+            break
+
+        # Without a mark the first page already holds the most recent plays, a partial page holds all plays after the mark
+        next_after = (last_played_track.get('cursors') or {}).get('after')
+        if after is None or next_after is None or len(items) < last_played_track.get('limit', 50) \
+                or int(next_after) <= int(after):
+            break
+        after = next_after
 
-    try:
-        for track in reversed(last_played_track['items']):
-            track_id = track['track']['id']
-            played_at = track['played_at']
-            album_id = track['track']['album']['id']
-            artist_id = track['track']['artists'][0]['id']
-            db.add_row(Table.RECENTLY_PLAYED, (played_at, track_id, artist_id, album_id))
-    except Exception as e:
-        log.error(f"Failed to add returned play history to database: {e}"
-                  f"\nReturned Value: {last_played_track}")
+    if not rows:
+        return 0
 
+    newest_played_at = max(_played_at_to_epoch_ms(row[0]) for row in rows)
 
-def scrape_missing_infos(db: Database) -> None:
+    with db.transaction():
+        n_new_plays = db.add_rows(Table.RECENTLY_PLAYED, rows, ignore_duplicates=True)
+        # The items carry the full track, so its album and artist never have to be requested by the gdpr import
+        db.add_track_mappings((track_id, artist_id, album_id) for _, track_id, artist_id, album_id in rows)
+        if mark is None or newest_played_at > mark:
+            db.set_state(RECENTLY_PLAYED_AFTER_KEY, str(newest_played_at))
+
+    log.debug(f"Added {n_new_plays} new plays to the database")
+    return n_new_plays
+
+
+def _played_at_to_epoch_ms(played_at: str) -> int:
     """
+    This function converts a played_at timestamp of the api into unix milliseconds, the format of the after cursor.
 
+    :param played_at: str ISO 8601 timestamp, e.g. 2025-01-01T12:00:00.000Z
+    :return: int
     """
-    bearer_token_simple = simple_authenticate()
+    return int(datetime.fromisoformat(played_at.replace('Z', '+00:00')).timestamp() * 1000)
+
 
-    _process_missing_info(db, bearer_token_simple, Table.TRACK_INFORMATION, 'track_id', 'tracks')
-    _process_missing_info(db, bearer_token_simple, Table.ALBUM_INFORMATION, 'album_id', 'albums')
-    _process_missing_info(db, bearer_token_simple, Table.ARTIST_INFORMATION, 'artist_id', 'artists')
-    # _process_missing_info(db, bearer_token_simple, Table.TRACK_ATTRIBUTES, 'track_id', 'audio-features')
+def scrape_missing_infos(db: Database, concurrency: int = 1, use_async: bool = False) -> None:
+    """
+    This function requests the information of all tracks, albums and artists which are played but not saved yet.
 
+    :param db: Database
+    :param concurrency: int maximal number of requests in flight, 1 processes the batches one after another
+    :param use_async: bool request the batches with the asyncio client instead of a thread pool
+    """
+    bearer_token_simple = simple_authenticate()
 
-def _process_missing_info(db: Database, bearer_token_simple: str, table_name: Table, id_field_name: str, endpoint_name: str) -> None:
+    batches = [
+        _missing_info_batches(db, Table.TRACK_INFORMATION, 'track_id', 'tracks'),
+        _missing_info_batches(db, Table.ALBUM_INFORMATION, 'album_id', 'albums'),
+        _missing_info_batches(db, Table.ARTIST_INFORMATION, 'artist_id', 'artists'),
+        # _missing_info_batches(db, Table.TRACK_ATTRIBUTES, 'track_id', 'audio-features'),
+    ]
 
-    if endpoint_name == 'albums':
-        limit = 20
-    elif endpoint_name == 'audio-features':
-        limit = 100
+    if use_async:
+        asyncio.run(_process_missing_info_async(db, bearer_token_simple, _round_robin(*batches), concurrency))
+    elif concurrency <= 1:
+        _process_missing_info(db, bearer_token_simple, chain(*batches))
     else:
-        limit = 50
+        # Interleave the entity types so all endpoints are requested at the same time
+        _process_missing_info_concurrently(db, bearer_token_simple, _round_robin(*batches), concurrency)
+
+    log.info(f"Request scheduler stats: {get_client().scheduler.stats()}")
+    get_cache().log_stats('scrape_missing_infos')
+
+    # The backfill changes the size of the tables most, so the planner statistics are refreshed after it
+    db.optimize()
+
+
+def _missing_info_batches(db: Database, table_name: Table, id_field_name: str, endpoint_name: str):
+    """
+    This function yields the ids missing in the specified table in full batches of the endpoint limit.
+
+    :return: generator yielding (table_name, endpoint_name, limit, ids) tuples
+    """
+
+    limit = endpoint_limit(endpoint_name)
+    n_missing = 0
 
-    all_ids_recently_played = db.read_all_rows(Table.RECENTLY_PLAYED, id_field_name)
-    all_ids_saved = db.read_all_rows(table_name, id_field_name)
-    all_ids_missing = list(set(all_ids_recently_played) - set(all_ids_saved))
+    for ids_tuple in iter_id_batches(db.iter_missing_ids(table_name, id_field_name), limit):
+        n_missing += len(ids_tuple)
+        yield table_name, endpoint_name, limit, ids_tuple
 
-    log.debug(f"Number of missing {table_name.name} entries: {len(all_ids_missing)}. Inserting...")
+    log.debug(f"Number of missing {table_name.name} entries: {n_missing}")
 
-    ids = []
-    processed_ids = set()
 
-    counter = 0
+def _round_robin(*iterables):
+    """
+    This function yields the items of all iterables alternating between them until all are exhausted.
+    """
+    iterators = deque(iter(iterable) for iterable in iterables)
+    while iterators:
+        iterator = iterators.popleft()
+        try:
+            yield next(iterator)
+        except StopIteration:
+            continue
+        iterators.append(iterator)
+
 
-    for id_value in all_ids_missing:
+def _process_missing_info(db: Database, bearer_token_simple: str, batches) -> None:
+    """
+    This function requests and saves the batches one after another.
+    """
+    for table_name, endpoint_name, limit, ids in batches:
+        response = get_multiple_field_information(bearer_token_simple, endpoint_name, limit, *ids)
+        _add_data_to_database(db, table_name, response, ids)
+
+
+def _process_missing_info_concurrently(db: Database, bearer_token_simple: str, batches, concurrency: int) -> None:
+    """
+    This function requests the batches in a thread pool with at most concurrency requests in flight.
+    The responses are written to the database from the calling thread only, so there is a single writer.
+    """
+    in_flight = {}
 
-        id_value_str = id_value[0]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for table_name, endpoint_name, limit, ids in batches:
+            if len(in_flight) >= concurrency:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    table_name_done, ids_done = in_flight.pop(future)
+                    _add_data_to_database(db, table_name_done, future.result(), ids_done)
 
-        if id_value_str not in processed_ids:
-            ids.append(id_value_str)
-            processed_ids.add(id_value_str)
-            counter += 1
+            future = executor.submit(get_multiple_field_information, bearer_token_simple, endpoint_name, limit, *ids)
+            in_flight[future] = (table_name, ids)
 
-        if (counter + 1) % limit == 0 and len(ids) > 0:
-            ids_tuple = tuple(ids)
-            ids.clear()
-            response = get_multiple_field_information(bearer_token_simple, endpoint_name, limit, *ids_tuple)
-            _add_data_to_database(db, table_name, response)
-            counter = 0
+        for future in as_completed(in_flight):
+            table_name, ids = in_flight[future]
+            _add_data_to_database(db, table_name, future.result(), ids)
 
-    if len(ids) > 0:
-        ids_tuple = tuple(ids)
-        ids.clear()
-        response = get_multiple_field_information(bearer_token_simple, endpoint_name, limit, *ids_tuple)
-        _add_data_to_database(db, table_name, response)
 
+async def _fetch_batch(client: AsyncSpotifyClient, bearer_token_simple: str, table_name: Table, endpoint_name: str, limit: int, ids: tuple) -> tuple:
+    return table_name, await client.get_multiple_field_information(bearer_token_simple, endpoint_name, limit, *ids), ids
 
-def _add_data_to_database(db: Database, table_name: Table, response) -> None:
+
+async def _process_missing_info_async(db: Database, bearer_token_simple: str, batches, concurrency: int) -> None:
+    """
+    This function requests the batches on an event loop with at most concurrency requests in flight.
+    The responses are written to the database from the event loop only, so there is a single writer.
+    """
+    in_flight = set()
+
+    async with AsyncSpotifyClient(max_in_flight=concurrency) as client:
+        try:
+            for table_name, endpoint_name, limit, ids in batches:
+                if len(in_flight) >= concurrency:
+                    done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        _add_data_to_database(db, *task.result())
+
+                in_flight.add(asyncio.ensure_future(_fetch_batch(client, bearer_token_simple, table_name, endpoint_name, limit, ids)))
+
+            for task in asyncio.as_completed(in_flight):
+                _add_data_to_database(db, *await task)
+        except BaseException:
+            for task in in_flight:
+                task.cancel()
+            raise
+
+
+def _add_data_to_database(db: Database, table_name: Table, response, ids: tuple = ()) -> None:
+
+    if response is None:
+        # The ids of a failed batch stay missing and are requested again in the next run
+        log.error(f'No response for a batch of {table_name.name} entries, skipping it')
+        return
+
+    # Unknown ids are returned as null, they are saved without information so they are not requested in every run
+    entries = [entry for entry in response[RESPONSE_KEYS[table_name]] if entry is not None]
+    returned_ids = {entry['id'] for entry in entries}
+    unknown_ids = [id_value for id_value in ids if id_value not in returned_ids]
+    if unknown_ids:
+        log.warning(f'{len(unknown_ids)} {table_name.name} entries are unknown to the api, saving them without information')
+        db.add_unknown_ids(table_name, unknown_ids)
+
+    rows = []
 
     if table_name == Table.TRACK_INFORMATION:
         log.debug('Adding track information to database')
-        for entry in response['tracks']:
+        track_mappings = []
+        for entry in entries:
             log.debug(f"Adding track: {entry['name']}")
-            db.add_row(table_name, (entry['id'], entry['name'], entry['duration_ms'], entry['explicit'], entry['popularity']))
+            rows.append((entry['id'], entry['name'], entry['duration_ms'], entry['explicit'], entry['popularity']))
+            track_mappings.append((entry['id'], entry['artists'][0]['id'], entry['album']['id']))
+        db.add_track_mappings(track_mappings)
 
     elif table_name == Table.ALBUM_INFORMATION:
         log.debug('Adding album information to database')
-        for entry in response['albums']:
+        for entry in entries:
             log.debug(f"Adding album: {entry['name']}")
             try:
                 release_year = entry['release_date'][:4]
             except Exception:
                 release_year = ""
-            db.add_row(table_name, (entry['id'], entry['name'], entry['album_type'], entry['total_tracks'], release_year, entry['label']))
+            rows.append((entry['id'], entry['name'], entry['album_type'], entry['total_tracks'], release_year, entry['label']))
 
     elif table_name == Table.ARTIST_INFORMATION:
         log.debug('Adding artist information to database')
-        for entry in response['artists']:
+        for entry in entries:
             log.debug(f"Adding artist: {entry['name']}")
             try:
                 genre = entry['genres'][0]
             except IndexError:
                 genre = ""
-            db.add_row(Table.ARTIST_INFORMATION, (entry['id'], entry['name'], entry['followers']['total'], genre, entry['popularity']))
+            rows.append((entry['id'], entry['name'], entry['followers']['total'], genre, entry['popularity']))
 
     elif table_name == Table.TRACK_ATTRIBUTES:
         log.debug('Adding track attributes to database')
-        for entry in response['audio_features']:
+        for entry in entries:
             log.debug(f"Adding track attributes: {entry['id']}")
             try:
-                db.add_row(Table.TRACK_ATTRIBUTES, (entry['id'], entry['aucousticness'], entry['danceability'], entry['duration_ms'], entry['energy'], entry['instrumentalness'], entry['key'], entry['liveness'], entry['loudness'], entry['speechiness'], entry['tempo'], entry['time_signature'], entry['valence']))
+                rows.append((entry['id'], entry['aucousticness'], entry['danceability'], entry['duration_ms'], entry['energy'], entry['instrumentalness'], entry['key'], entry['liveness'], entry['loudness'], entry['speechiness'], entry['tempo'], entry['time_signature'], entry['valence']))
             except Exception as e:
                 log.error(f"Failed to add track attributes to database: {e}"
                           f"\nReturned Value: {response}")
+
+    db.add_rows(table_name, rows)
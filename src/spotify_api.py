@@ -2,7 +2,9 @@ from typing import Union
 
 import requests
 
+from http_client import get_client
 from logger import LoggerWrapper
+from response_cache import get_cache
 
 log = LoggerWrapper()
 
@@ -16,13 +18,11 @@ def get_last_played_track(bearer_token: str, url: str = "https://api.spotify.com
     :return: dict
     """
 
-    header = {
-        'Authorization': f'Bearer {bearer_token}'
-    }
-
     try:
-        log.debug(f"GET Request: {url}")
-        response = requests.get(url, headers=header)
+        response = get_client().get(url, bearer_token=bearer_token)
+        if response.status_code != 200:
+            log.error(f"Error in get_last_played_track {response.status_code}: {response.text}")
+            return None
         response_json = response.json()
         return response_json
     except requests.exceptions.RequestException as e:
@@ -39,15 +39,19 @@ def get_track_information(track_id: str, bearer_token: str) -> Union[dict, None]
     :return: dict
     """
 
+    cached_response = get_cache().get('tracks', track_id)
+    if cached_response is not None:
+        return cached_response
+
     url = f"https://api.spotify.com/v1/tracks/{track_id}"
-    header = {
-        'Authorization': f'Bearer {bearer_token}'
-    }
 
     try:
-        log.debug(f"GET Request: {url}")
-        response = requests.get(url, headers=header)
+        response = get_client().get(url, bearer_token=bearer_token)
+        if response.status_code != 200:
+            log.error(f"Error in get_track_information {response.status_code}: {response.text}")
+            return None
         response_json = response.json()
+        get_cache().put('tracks', track_id, response_json)
         return response_json
     except requests.exceptions.RequestException as e:
         log.error(f"Error in get_track_information: {e}")
@@ -63,14 +67,18 @@ def get_artist_information(artist_id: str, bearer_token: str) -> Union[dict, Non
     :return: dict
     """
 
+    cached_response = get_cache().get('artists', artist_id)
+    if cached_response is not None:
+        return cached_response
+
     url = f"https://api.spotify.com/v1/artists/{artist_id}"
-    header = {
-        'Authorization': f'Bearer {bearer_token}'
-    }
     try:
-        log.debug(f"GET Request: {url}")
-        response = requests.get(url, headers=header)
+        response = get_client().get(url, bearer_token=bearer_token)
+        if response.status_code != 200:
+            log.error(f"Error in get_artist_information {response.status_code}: {response.text}")
+            return None
         response_json = response.json()
+        get_cache().put('artists', artist_id, response_json)
         return response_json
     except requests.exceptions.RequestException as e:
         log.error(f"Error in get_artist_information: {e}")
@@ -86,15 +94,19 @@ def get_album_information(album_id: str, bearer_token: str) -> Union[dict, None]
     :return: dict
     """
 
+    cached_response = get_cache().get('albums', album_id)
+    if cached_response is not None:
+        return cached_response
+
     url = f"https://api.spotify.com/v1/albums/{album_id}"
-    header = {
-        'Authorization': f'Bearer {bearer_token}'
-    }
 
     try:
-        log.debug(f"GET Request: {url}")
-        response = requests.get(url, headers=header)
+        response = get_client().get(url, bearer_token=bearer_token)
+        if response.status_code != 200:
+            log.error(f"Error in get_album_information {response.status_code}: {response.text}")
+            return None
         response_json = response.json()
+        get_cache().put('albums', album_id, response_json)
         return response_json
     except requests.exceptions.RequestException as e:
         log.error(f"Error in get_album_information: {e}")
@@ -103,7 +115,8 @@ def get_album_information(album_id: str, bearer_token: str) -> Union[dict, None]
 
 def get_multiple_field_information(bearer_token: str, api_type: str, limit: int,  *track_ids) -> Union[dict, None]:
     """
-    This function returns the track information based on the track id
+    This function returns the track information based on the track id.
+    Ids found in the response cache are not requested again, only the cache misses hit the api.
 
     :param *track_id: str
     :param bearer_token: str
@@ -114,10 +127,17 @@ def get_multiple_field_information(bearer_token: str, api_type: str, limit: int,
         log.error(f'exceeding the limit if ids {limit} for endpoint {api_type}')
         return None
 
+    response_key = api_type.replace('-', '_')
+    cached_responses = get_cache().get_many(api_type, track_ids)
+    missing_ids = [track_id for track_id in track_ids if track_id not in cached_responses]
+
+    if not missing_ids:
+        return {response_key: list(cached_responses.values())}
+
     url_suffix = "ids="
     separator = ","
     try:
-        for track_id in track_ids:
+        for track_id in missing_ids:
             url_suffix = url_suffix + track_id + separator
     except Exception as e:
         log.error(f"Failed setting up the url for multiple ids request."
@@ -126,14 +146,16 @@ def get_multiple_field_information(bearer_token: str, api_type: str, limit: int,
 
     url = f"https://api.spotify.com/v1/{api_type}?{url_suffix}"
     url = url[:-len(separator)]
-    header = {
-        'Authorization': f'Bearer {bearer_token}'
-    }
 
     try:
-        log.debug(f"GET Request: {url}")
-        response = requests.get(url, headers=header)
+        response = get_client().get(url, bearer_token=bearer_token)
+        if response.status_code != 200:
+            log.error(f"Error in get_multiple_field_information {response.status_code}: {response.text}")
+            return None
         response_json = response.json()
+        entries = response_json.get(response_key) or []
+        get_cache().put_many(api_type, {entry['id']: entry for entry in entries if entry})
+        response_json[response_key] = list(cached_responses.values()) + entries
         return response_json
     except requests.exceptions.RequestException as e:
         log.error(f"Error in get_multiple_field_information: {e}")
@@ -0,0 +1,10 @@
+import pytest
+
+from database_handler import Database
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / 'test.db'))
+    yield db
+    db.close('test')
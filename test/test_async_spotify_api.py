@@ -0,0 +1,115 @@
+import asyncio
+import time
+
+from aiohttp import web
+
+import http_client
+from async_spotify_api import AsyncSpotifyClient, gather_or_cancel
+from http_client import RequestScheduler
+
+
+def fast_scheduler():
+    return RequestScheduler(rate=1e6, max_rate=1e6, burst=1000)
+
+
+async def serve(handler):
+    """Start a local server answering every GET request with handler and return its runner and url"""
+    app = web.Application()
+    app.router.add_get('/{tail:.*}', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f'http://127.0.0.1:{port}'
+
+
+def test_client_shares_the_scheduler_of_the_http_client(monkeypatch):
+    monkeypatch.setattr(http_client, '_client', None)
+    assert AsyncSpotifyClient().scheduler is http_client.get_client().scheduler
+
+
+def test_requests_in_flight_are_bounded():
+    in_flight = [0, 0]
+
+    async def handler(request):
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight[1], in_flight[0])
+        await asyncio.sleep(0.02)
+        in_flight[0] -= 1
+        return web.json_response({'id': request.path})
+
+    async def run():
+        runner, url = await serve(handler)
+        try:
+            async with AsyncSpotifyClient(max_in_flight=3, scheduler=fast_scheduler()) as client:
+                return await gather_or_cancel(*(client.get_json(f'{url}/{i}') for i in range(12)))
+        finally:
+            await runner.cleanup()
+
+    responses = asyncio.run(run())
+
+    assert [response['id'] for response in responses] == [f'/{i}' for i in range(12)]
+    assert in_flight[1] == 3
+
+
+def test_throttled_request_pauses_the_shared_scheduler():
+    calls = []
+
+    async def handler(request):
+        calls.append(request.path)
+        if len(calls) == 1:
+            return web.Response(status=429, headers={'Retry-After': '0.1'})
+        return web.json_response({'ok': True})
+
+    scheduler = fast_scheduler()
+
+    async def run():
+        runner, url = await serve(handler)
+        try:
+            async with AsyncSpotifyClient(scheduler=scheduler, backoff=0) as client:
+                return await client.get_json(f'{url}/tracks')
+        finally:
+            await runner.cleanup()
+
+    assert asyncio.run(run()) == {'ok': True}
+    assert len(calls) == 2
+    stats = scheduler.stats()
+    assert stats['requests'] == 2
+    assert stats['throttled_responses'] == 1
+    assert stats['throttled_seconds'] > 0
+
+
+def test_throttled_last_attempt_still_throttles():
+    async def handler(request):
+        return web.Response(status=429, headers={'Retry-After': '0'})
+
+    scheduler = fast_scheduler()
+
+    async def run():
+        runner, url = await serve(handler)
+        try:
+            async with AsyncSpotifyClient(scheduler=scheduler, max_retries=2) as client:
+                return await client.get_json(f'{url}/tracks')
+        finally:
+            await runner.cleanup()
+
+    assert asyncio.run(run()) is None
+    assert scheduler.stats()['throttled_responses'] == 3
+
+
+def test_backoff_is_capped():
+    async def handler(request):
+        return web.Response(status=503)
+
+    async def run():
+        runner, url = await serve(handler)
+        try:
+            async with AsyncSpotifyClient(scheduler=fast_scheduler(), max_retries=2, backoff=10, max_backoff=0.05) as client:
+                return await client.get_json(f'{url}/tracks')
+        finally:
+            await runner.cleanup()
+
+    start = time.perf_counter()
+    assert asyncio.run(run()) is None
+    assert time.perf_counter() - start < 5
@@ -0,0 +1,68 @@
+import hashlib
+import os
+
+import numpy as np
+import pytest
+
+from database_handler import Table
+
+pytest.importorskip('librosa')
+
+from ai_analysis import audio_features  # noqa: E402
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.body = body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+
+class FakeClient:
+    def __init__(self):
+        self.requested = []
+
+    def get(self, url, stream=False):
+        self.requested.append(url)
+        return FakeResponse(url.encode() * 1000)
+
+
+def test_preview_is_stored_once_under_its_hash(tmp_path):
+    client = FakeClient()
+    content_hash = audio_features.download_preview(client, 'https://p.scdn.co/a', str(tmp_path))
+
+    assert content_hash == hashlib.sha256(b'https://p.scdn.co/a' * 1000).hexdigest()
+    assert os.path.exists(audio_features._cache_file_path(content_hash, str(tmp_path)))
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.part')]
+
+
+def test_tracks_without_preview_are_not_picked_again(db, tmp_path):
+    db.add_rows(Table.PREVIEW_URL, [('track1', None, '2025-01-01T00:00:00Z'), ('track2', None, '2025-01-01T00:00:00Z')])
+    client = FakeClient()
+
+    assert audio_features.extract_audio_features(db, workers=1, cache_path=str(tmp_path), client=client) == 0
+
+    assert not list(db.iter_missing_ids(Table.AUDIO_FEATURES, 'track_id', Table.PREVIEW_URL))
+    assert client.requested == []
+
+
+def test_tracks_without_features_are_not_loaded(db):
+    features = np.arange(len(audio_features.FEATURE_NAMES), dtype=np.float32)
+    db.add_rows(Table.AUDIO_FEATURES, [('track1', 'hash', features.tobytes(), '2025-01-01T00:00:00Z'),
+                                       ('track2', None, None, '2025-01-01T00:00:00Z')])
+
+    track_ids, matrix = audio_features.load_audio_features(db)
+
+    assert track_ids == ['track1']
+    assert np.array_equal(matrix, features[None, :])
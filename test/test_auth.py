@@ -0,0 +1,83 @@
+import threading
+import time
+
+import pytest
+
+import auth
+from auth import TokenManager
+
+
+@pytest.fixture
+def manager():
+    manager = TokenManager(refresh_margin=300, retry_interval=30)
+    yield manager
+    manager.stop()
+
+
+@pytest.fixture
+def token_endpoint(monkeypatch):
+    """Count the token requests, every token is valid for an hour"""
+    calls = []
+
+    def request_simple_token(grant_type):
+        calls.append(grant_type)
+        time.sleep(0.05)
+        return f'token{len(calls)}', time.time() + 3600
+
+    monkeypatch.setattr(auth, '_request_simple_token', request_simple_token)
+    return calls
+
+
+def test_token_is_fetched_once_and_cached(manager, token_endpoint):
+    assert manager.get_token('client_credentials') == 'token1'
+    assert manager.get_token('client_credentials') == 'token1'
+    assert token_endpoint == ['client_credentials']
+
+
+def test_concurrent_first_calls_share_one_fetch(manager, token_endpoint):
+    barrier = threading.Barrier(8)
+    tokens = []
+
+    def get_token():
+        barrier.wait()
+        tokens.append(manager.get_token('client_credentials'))
+
+    threads = [threading.Thread(target=get_token) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert tokens == ['token1'] * 8
+    assert len(token_endpoint) == 1
+
+
+def test_refresh_is_scheduled_before_the_expiry(manager, token_endpoint):
+    manager.get_token('client_credentials')
+    timer = manager.timers[('client_credentials', None)]
+    assert 3600 - 300 - 5 < timer.interval <= 3600 - 300
+
+
+def test_background_refresh_replaces_the_token(manager, monkeypatch):
+    tokens = iter([('old', time.time() + 0.1), ('new', time.time() + 3600)])
+    monkeypatch.setattr(auth, '_request_simple_token', lambda grant_type: next(tokens))
+    manager.refresh_margin = 0
+
+    assert manager.get_token('client_credentials') == 'old'
+    time.sleep(0.3)
+    assert manager.get_token('client_credentials') == 'new'
+
+
+def test_failed_background_refresh_is_retried(manager, monkeypatch):
+    monkeypatch.setattr(auth, '_request_simple_token', lambda grant_type: None)
+    manager.tokens[('client_credentials', None)] = ('token', time.time() + 3600)
+
+    manager._background_refresh(('client_credentials', None))
+
+    assert manager.timers[('client_credentials', None)].interval == 30
+    assert manager.get_token('client_credentials') == 'token'
+
+
+def test_expired_token_is_fetched_again(manager, token_endpoint):
+    manager.tokens[('client_credentials', None)] = ('expired', time.time() - 1)
+    assert manager.get_token('client_credentials') == 'token1'
@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+
+from columnar_export import export_columns, load_columns, load_vocabulary
+from database_handler import Table
+
+
+def play_rows(start, stop):
+    return [(f'2025-01-01T00:{i // 60:02d}:{i % 60:02d}Z', f'track{i % 7}', f'artist{i % 3}', f'album{i % 5}') for i in range(start, stop)]
+
+
+def decode(export_path, columns, name):
+    vocabulary = load_vocabulary(export_path)
+    return [vocabulary[code] for code in columns[name]]
+
+
+def test_export_appends_only_new_plays(db, tmp_path):
+    export_path = str(tmp_path / 'columnar')
+    db.add_rows(Table.RECENTLY_PLAYED, play_rows(0, 50))
+    assert export_columns(db, export_path, chunk_size=16) == 50
+
+    db.add_rows(Table.RECENTLY_PLAYED, play_rows(50, 80))
+    assert export_columns(db, export_path, chunk_size=16) == 30
+    assert export_columns(db, export_path) == 0
+
+    columns = load_columns(export_path)
+    rows = play_rows(0, 80)
+    assert len(columns['played_at']) == 80
+    assert columns['played_at'][1] - columns['played_at'][0] == 1000
+    assert decode(export_path, columns, 'track') == [row[1] for row in rows]
+    assert decode(export_path, columns, 'artist') == [row[2] for row in rows]
+    assert decode(export_path, columns, 'album') == [row[3] for row in rows]
+    # The codes are the keys of the id dictionary
+    assert columns['track'][0] == db.ids.key_by_id['track0']
+
+
+def test_missing_durations_are_filled_in_by_the_next_export(db, tmp_path):
+    export_path = str(tmp_path / 'columnar')
+    db.add_rows(Table.TRACK_INFORMATION, [('track0', 'title0', 1000, False, 1)])
+    db.add_rows(Table.RECENTLY_PLAYED, play_rows(0, 10))
+    export_columns(db, export_path)
+
+    durations = np.asarray(load_columns(export_path)['duration_ms'])
+    assert sorted(set(durations.tolist())) == [-1, 1000]
+
+    db.add_rows(Table.TRACK_INFORMATION, [(f'track{i}', f'title{i}', 1000 * (i + 1), False, 1) for i in range(1, 7)])
+    export_columns(db, export_path)
+
+    assert load_columns(export_path)['duration_ms'].tolist() == [1000 * (i % 7 + 1) for i in range(10)]
+
+
+def test_interrupted_export_is_truncated(db, tmp_path):
+    export_path = str(tmp_path / 'columnar')
+    db.add_rows(Table.RECENTLY_PLAYED, play_rows(0, 10))
+    export_columns(db, export_path)
+    with open(os.path.join(export_path, 'track.bin'), 'ab') as file:
+        file.write(b'\xff' * 12)
+
+    db.add_rows(Table.RECENTLY_PLAYED, play_rows(10, 20))
+    export_columns(db, export_path)
+
+    assert decode(export_path, load_columns(export_path), 'track') == [row[1] for row in play_rows(0, 20)]
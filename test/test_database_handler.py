@@ -0,0 +1,146 @@
+import logging
+import threading
+
+import pytest
+
+from database_handler import Database, Table
+
+
+def track_rows(start, stop):
+    return [(f'track{i}', f'title{i}', 1000 * i, False, i) for i in range(start, stop)]
+
+
+def count(db, table):
+    return db.cursor.execute(f"SELECT COUNT(*) FROM {table.value}").fetchone()[0]
+
+
+def test_add_rows_inserts_all_rows(db):
+    assert db.add_rows(Table.TRACK_INFORMATION, track_rows(0, 100)) == 100
+    assert count(db, Table.TRACK_INFORMATION) == 100
+
+
+def test_add_rows_skips_only_duplicates(db, caplog):
+    db.add_rows(Table.TRACK_INFORMATION, track_rows(0, 10))
+
+    with caplog.at_level(logging.DEBUG):
+        inserted = db.add_rows(Table.TRACK_INFORMATION, track_rows(5, 20))
+
+    assert inserted == 10
+    assert count(db, Table.TRACK_INFORMATION) == 20
+    assert not [record for record in caplog.records if record.levelno >= logging.ERROR]
+
+
+def test_add_rows_ignoring_duplicates(db):
+    db.add_rows(Table.TRACK_INFORMATION, track_rows(0, 10))
+
+    assert db.add_rows(Table.TRACK_INFORMATION, track_rows(5, 20), ignore_duplicates=True) == 10
+    assert count(db, Table.TRACK_INFORMATION) == 20
+
+
+def test_failed_batch_inside_transaction_keeps_earlier_writes(db):
+    with db.transaction():
+        db.add_rows(Table.TRACK_INFORMATION, track_rows(0, 10))
+        # The duplicate in the middle makes the batch fall back to single inserts after a partial executemany
+        assert db.add_rows(Table.TRACK_INFORMATION, track_rows(10, 15) + track_rows(3, 4) + track_rows(15, 20)) == 10
+
+    assert count(db, Table.TRACK_INFORMATION) == 20
+    assert db.cursor.execute("SELECT COUNT(DISTINCT track_id) FROM track_information").fetchone()[0] == 20
+
+
+def test_transaction_is_rolled_back_on_exception(db):
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            db.add_rows(Table.TRACK_INFORMATION, track_rows(0, 10))
+            db.add_rows(Table.TRACK_INFORMATION, track_rows(10, 20))
+            raise RuntimeError('abort')
+
+    assert count(db, Table.TRACK_INFORMATION) == 0
+
+
+def test_write_buffer_flushes_in_batches(db):
+    with db.write_buffer(Table.TRACK_INFORMATION, flush_size=30) as buffer:
+        for row in track_rows(0, 100):
+            buffer.add(row)
+            assert len(buffer.rows) < 30
+        assert count(db, Table.TRACK_INFORMATION) == 90
+
+    assert buffer.inserted == 100
+    assert count(db, Table.TRACK_INFORMATION) == 100
+
+
+def play_rows(n, offset=0):
+    return [(f'2024-01-01T00:{(offset + i) // 60:02d}:{(offset + i) % 60:02d}Z', f'track{i % 7}', f'artist{i % 3}', f'album{i % 5}')
+            for i in range(n)]
+
+
+def test_missing_ids_are_the_played_ids_without_information(db):
+    db.add_rows(Table.RECENTLY_PLAYED, play_rows(50))
+    db.add_rows(Table.TRACK_INFORMATION, [('track1', 'one', 1, False, 1), ('track4', 'four', 4, False, 4)])
+
+    assert sorted(db.iter_missing_ids(Table.TRACK_INFORMATION, 'track_id')) == ['track0', 'track2', 'track3', 'track5', 'track6']
+    assert sorted(db.iter_missing_ids(Table.ARTIST_INFORMATION, 'artist_id')) == ['artist0', 'artist1', 'artist2']
+    assert sorted(db.iter_missing_ids(Table.ALBUM_INFORMATION, 'album_id')) == [f'album{i}' for i in range(5)]
+
+
+def test_total_overview_joins_the_plays_with_their_information(db):
+    db.add_rows(Table.RECENTLY_PLAYED, play_rows(10))
+    db.add_rows(Table.TRACK_INFORMATION, track_rows(0, 7))
+    db.add_rows(Table.ARTIST_INFORMATION, [(f'artist{i}', f'Artist {i}', 0, '', 0) for i in range(3)])
+    # album4 has no information, its plays are left out
+    db.add_rows(Table.ALBUM_INFORMATION, [(f'album{i}', f'Album {i}', 'album', 10, '2025', '') for i in range(4)])
+
+    overview = db.get_total_overview()
+
+    expected = [(played_at, track_id, f'title{track_id[5:]}', artist_id, f'Artist {artist_id[6:]}', album_id, f'Album {album_id[5:]}')
+                for played_at, track_id, artist_id, album_id in play_rows(10) if album_id != 'album4']
+    assert overview == sorted(expected, reverse=True)
+
+
+def test_missing_ids_of_another_source_table(db):
+    db.add_rows(Table.TRACK_INFORMATION, [('track1', 'one', 1, False, 1), ('track2', 'two', 2, False, 2)])
+    db.add_rows(Table.PREVIEW_URL, [('track2', 'https://p.scdn.co/2', None)])
+
+    assert list(db.iter_missing_ids(Table.PREVIEW_URL, 'track_id', Table.TRACK_INFORMATION)) == ['track1']
+
+
+def test_missing_ids_can_be_streamed_while_writing(db):
+    db.add_rows(Table.RECENTLY_PLAYED, play_rows(50))
+
+    for track_id in db.iter_missing_ids(Table.TRACK_INFORMATION, 'track_id'):
+        db.add_rows(Table.TRACK_INFORMATION, [(track_id, track_id, 1, False, 1)])
+
+    assert list(db.iter_missing_ids(Table.TRACK_INFORMATION, 'track_id')) == []
+
+
+def test_default_profile_keeps_the_sqlite_defaults(db):
+    assert db.profile == 'default'
+    assert db.conn.execute("PRAGMA journal_mode").fetchone()[0] == 'delete'
+
+
+def test_performance_profile_uses_a_write_ahead_log(tmp_path):
+    db = Database(str(tmp_path / 'test.db'), 'performance')
+    try:
+        assert db.conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+        assert db.read_connection().execute("PRAGMA cache_size").fetchone()[0] == -65536
+    finally:
+        db.close('test')
+
+
+def test_reads_inside_a_transaction_see_its_writes(tmp_path):
+    db = Database(str(tmp_path / 'test.db'), 'performance')
+    other_thread_rows = []
+    try:
+        with db.transaction():
+            db.add_rows(Table.TRACK_INFORMATION, track_rows(0, 5))
+            assert len(db.read_all_rows(Table.TRACK_INFORMATION)) == 5
+
+            # Other threads only see committed writes
+            thread = threading.Thread(target=lambda: other_thread_rows.extend(db.read_all_rows(Table.TRACK_INFORMATION)))
+            thread.start()
+            thread.join()
+            assert other_thread_rows == []
+
+        assert db.read_connection() is not db.conn
+        assert len(db.read_all_rows(Table.TRACK_INFORMATION)) == 5
+    finally:
+        db.close('test')
@@ -0,0 +1,289 @@
+import json
+import logging
+import math
+import os
+
+import pytest
+
+import gdpr_export
+from database_handler import Database, Table
+
+
+def gdpr_entry(timestamp, track_id, **fields):
+    """A play of the extended streaming history, a track_id of None makes it a podcast"""
+    entry = {
+        'ts': timestamp,
+        'platform': 'Android OS 11 API 30 (Samsung, SM-G991B)',
+        'ms_played': 180000,
+        'conn_country': 'AT',
+        'master_metadata_track_name': 'Título ✓',
+        'master_metadata_album_artist_name': 'Artist',
+        'master_metadata_album_album_name': 'Album',
+        'spotify_track_uri': None if track_id is None else f'spotify:track:{track_id}',
+        'reason_start': 'trackdone',
+        'reason_end': 'endplay',
+        'shuffle': False,
+        'skipped': False,
+        'offline': False,
+        'incognito_mode': False,
+    }
+    entry.update(fields)
+    return entry
+
+
+def write_gdpr_file(folder, name, entries, indent=None):
+    path = folder / name
+    path.write_text(json.dumps(entries, ensure_ascii=False, indent=indent), encoding='utf-8')
+    return str(path)
+
+
+@pytest.fixture
+def gdpr_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(gdpr_export, 'folder_path', str(tmp_path))
+    return tmp_path
+
+
+def timestamp(i):
+    return f'2024-01-{1 + i // 1440:02d}T{i // 60 % 24:02d}:{i % 60:02d}:00Z'
+
+
+@pytest.mark.parametrize('indent', [None, 2])
+def test_json_array_is_streamed_in_small_chunks(gdpr_folder, indent):
+    entries = [gdpr_entry(timestamp(i), f'track{i}') for i in range(200)]
+    path = write_gdpr_file(gdpr_folder, 'Streaming_History_Audio_0.json', entries, indent)
+
+    assert [item for item, _ in gdpr_export._iter_json_array(path, chunk_size=100)] == entries
+
+
+def test_files_are_merged_by_timestamp(gdpr_folder):
+    write_gdpr_file(gdpr_folder, 'Streaming_History_Audio_0.json', [gdpr_entry(timestamp(i), f'track{i}') for i in range(0, 300, 3)])
+    write_gdpr_file(gdpr_folder, 'Streaming_History_Audio_1.json', [gdpr_entry(timestamp(i), f'track{i}') for i in range(1, 300, 3)])
+    write_gdpr_file(gdpr_folder, 'Streaming_History_Audio_2.json', [gdpr_entry(timestamp(i), None) for i in range(2, 300, 3)])
+
+    plays = list(gdpr_export._read_gdrp_data())
+
+    assert [play['timestamp'] for play in plays] == sorted(timestamp(i) for i in range(300) if i % 3 != 2)
+    assert all(play['id'].startswith('track') for play in plays)
+
+
+def test_unordered_file_is_reported_once(gdpr_folder, caplog):
+    write_gdpr_file(gdpr_folder, 'Streaming_History_Audio_0.json', [gdpr_entry(timestamp(i), f'track{i}') for i in reversed(range(100))])
+
+    with caplog.at_level(logging.WARNING):
+        plays = list(gdpr_export._read_gdrp_data())
+
+    assert len(plays) == 100
+    assert len([record for record in caplog.records if 'not ordered by timestamp' in record.getMessage()]) == 1
+
+
+def test_parallel_reader_yields_the_streamed_plays(gdpr_folder):
+    write_gdpr_file(gdpr_folder, 'Streaming_History_Audio_0.json', [gdpr_entry(timestamp(i), f'track{i}') for i in range(0, 300, 2)])
+    write_gdpr_file(gdpr_folder, 'Streaming_History_Audio_1.json',
+                    [gdpr_entry(timestamp(i), f'track{i}', conn_country=None, ms_played=None) for i in range(1, 300, 2)])
+
+    streamed = [{key: play[key] for key in ('timestamp', 'id', 'conn_country', 'ms_played', 'file', 'offset')}
+                for play in gdpr_export._read_gdrp_data()]
+    parsed = [{key: play[key] for key in ('timestamp', 'id', 'conn_country', 'ms_played', 'file', 'offset')}
+              for play in gdpr_export._read_gdrp_data_parallel(2)]
+
+    for play in streamed:
+        play['ms_played'] = play['ms_played'] or 0
+    assert parsed == streamed
+
+
+def test_packed_strings_keep_every_value():
+    values = ['2024-01-01T00:00:00Z', None, '', 'ünïcödé ✓', None, 'AT']
+    column = gdpr_export._PackedStrings()
+    for value in values:
+        column.append(value)
+
+    assert len(column) == len(values)
+    assert list(column) == values
+
+
+@pytest.fixture
+def requests(monkeypatch):
+    """Answer every tracks request with made up album and artist ids and record the requested ids"""
+    sent = []
+
+    def get_multiple_field_information(bearer_token, api_type, limit, *ids):
+        assert len(ids) <= limit
+        sent.append(ids)
+        return {'tracks': [{'id': track_id, 'album': {'id': f'album_{track_id}'}, 'artists': [{'id': f'artist_{track_id}'}]}
+                           for track_id in ids]}
+
+    monkeypatch.setattr(gdpr_export, 'get_multiple_field_information', get_multiple_field_information)
+    return sent
+
+
+@pytest.mark.parametrize('n_ids', [1, 49, 50, 51, 100, 101, 1234])
+def test_track_ids_are_requested_in_full_batches(requests, n_ids):
+    db = Database(':memory:')
+
+    gdpr_export._populate_ids(db, [f'track{i}' for i in range(n_ids)], 'token')
+
+    assert len(requests) == math.ceil(n_ids / 50)
+    assert all(len(ids) == 50 for ids in requests[:-1])
+    assert len(db.read_all_rows(Table.TRACK_MAPPING)) == n_ids
+
+
+def test_only_unresolved_track_ids_are_requested(requests):
+    db = Database(':memory:')
+    db.add_track_mappings([(f'track{i}', f'artist{i}', f'album{i}') for i in range(0, 200, 2)])
+
+    unresolved_track_ids = gdpr_export._unresolved_track_ids(db, [f'track{i}' for i in range(200)] * 2)
+    gdpr_export._populate_ids(db, unresolved_track_ids, 'token')
+
+    assert len(requests) == 2
+    assert {track_id for ids in requests for track_id in ids} == {f'track{i}' for i in range(1, 200, 2)}
+
+
+def song_played(i, **fields):
+    """A parsed play as it is passed to the database, with its ids resolved"""
+    entry = {'timestamp': timestamp(i), 'id': f'track{i}', 'artist_id': f'artist{i}', 'album_id': f'album{i}',
+             'ms_played': 1000 * i, 'conn_country': 'AT', 'platform': 1, 'reason_start': 1, 'reason_end': 6, 'flags': 0}
+    entry.update(fields)
+    return entry
+
+
+def count(db, table):
+    return db.cursor.execute(f"SELECT COUNT(*) FROM {table.value}").fetchone()[0]
+
+
+def test_plays_are_written_with_their_events():
+    db = Database(':memory:')
+
+    gdpr_export._insert_data_into_db(db, [song_played(i) for i in range(10)], flush_size=3, checkpoints={'a.json': (100, 2000, 1)})
+    # A resumed import writes the same plays again
+    gdpr_export._insert_data_into_db(db, [song_played(i) for i in range(5, 15)], flush_size=3)
+
+    assert count(db, Table.PLAYS) == count(db, Table.PLAY_EVENTS) == 15
+    assert db.cursor.execute(f"SELECT ms_played FROM {Table.PLAY_EVENTS.value} WHERE played_at = ?", (timestamp(7),)).fetchone() == (7000,)
+    assert db.get_import_checkpoints() == {'a.json': (100, 2000, 1)}
+
+
+def test_play_without_all_fields_is_skipped_with_its_event():
+    db = Database(':memory:')
+    entries = [song_played(i) for i in range(5)]
+    del entries[2]['ms_played']
+
+    gdpr_export._insert_data_into_db(db, entries)
+
+    assert count(db, Table.PLAYS) == count(db, Table.PLAY_EVENTS) == 4
+
+
+def test_failed_write_rolls_back_the_plays_events_and_checkpoints():
+    db = Database(':memory:')
+    gdpr_export._insert_data_into_db(db, [song_played(0)], checkpoints={'a.json': (10, 2000, 1)})
+    # The event of the last play can not be written, sqlite does not accept a dict
+    entries = [song_played(i) for i in range(1, 10)] + [song_played(10, conn_country={'country': 'AT'})]
+
+    with pytest.raises(Exception):
+        gdpr_export._insert_data_into_db(db, entries, flush_size=4, checkpoints={'a.json': (100, 2000, 1)})
+
+    assert count(db, Table.PLAYS) == count(db, Table.PLAY_EVENTS) == 1
+    assert db.get_import_checkpoints() == {'a.json': (10, 2000, 1)}
+    assert db.ids.key('track5') is None
+
+
+def write_crlf_gdpr_file(folder, name, entries):
+    path = folder / name
+    path.write_bytes(json.dumps(entries, ensure_ascii=False, indent=2).replace('\n', '\r\n').encode('utf-8'))
+    return str(path)
+
+
+def test_offsets_of_a_crlf_file_are_byte_offsets(gdpr_folder):
+    entries = [gdpr_entry(timestamp(i), f'track{i}') for i in range(20)]
+    path = write_crlf_gdpr_file(gdpr_folder, 'Streaming_History_Audio_0.json', entries)
+    data = open(path, 'rb').read()
+
+    offsets = [offset for _, offset in gdpr_export._iter_json_array(path, chunk_size=100)]
+
+    assert all(data[offset - 1:offset] == b'}' for offset in offsets)
+    for i, offset in enumerate(offsets):
+        assert [item for item, _ in gdpr_export._iter_json_array(path, chunk_size=100, offset=offset)] == entries[i + 1:]
+        assert gdpr_export._scan_track_ids(path, offset, chunk_size=100) == {f'track{j}' for j in range(i + 1, 20)}
+
+
+@pytest.fixture
+def import_db(monkeypatch):
+    """A database mapping every track, so the import needs no requests"""
+    monkeypatch.setattr(gdpr_export, 'get_cache', lambda: type('Cache', (), {'log_stats': lambda self, message: None})())
+    db = Database(':memory:')
+    db.add_track_mappings([(f'track{i}', f'artist{i}', f'album{i}') for i in range(100)])
+    return db
+
+
+def test_interrupted_import_resumes_from_its_checkpoints(gdpr_folder, import_db, monkeypatch):
+    write_crlf_gdpr_file(gdpr_folder, 'Streaming_History_Audio_0.json', [gdpr_entry(timestamp(i), f'track{i}') for i in range(0, 60, 2)])
+    write_gdpr_file(gdpr_folder, 'Streaming_History_Audio_1.json', [gdpr_entry(timestamp(i), f'track{i}') for i in range(1, 60, 2)], indent=2)
+    insert_data_into_db = gdpr_export._insert_data_into_db
+    inserted = []
+
+    def fail_after_two_chunks(db, chunk, *args, **kwargs):
+        if len(inserted) == 2:
+            raise RuntimeError('interrupted')
+        insert_data_into_db(db, chunk, *args, **kwargs)
+        inserted.append([entry['timestamp'] for entry in chunk])
+
+    monkeypatch.setattr(gdpr_export, '_insert_data_into_db', fail_after_two_chunks)
+    gdpr_export.export_gdpr_data(import_db, n_limit=None, chunk_size=10)
+    assert count(import_db, Table.PLAYS) == 20
+
+    monkeypatch.setattr(gdpr_export, '_insert_data_into_db', insert_data_into_db)
+    resumed = list(gdpr_export._read_gdrp_data(gdpr_export._resume_offsets(
+        import_db, {name: gdpr_export._file_fingerprint(str(gdpr_folder / name)) for name in os.listdir(gdpr_folder)})))
+    assert [play['timestamp'] for play in resumed] == [timestamp(i) for i in range(20, 60)]
+
+    gdpr_export.export_gdpr_data(import_db, n_limit=None, chunk_size=10)
+    assert count(import_db, Table.PLAYS) == count(import_db, Table.PLAY_EVENTS) == 60
+
+
+def test_changed_file_is_imported_from_its_start(gdpr_folder, import_db, caplog):
+    path = write_gdpr_file(gdpr_folder, 'Streaming_History_Audio_0.json', [gdpr_entry(timestamp(i), f'track{i}') for i in range(30)])
+    gdpr_export.export_gdpr_data(import_db, n_limit=None)
+    assert import_db.get_import_checkpoints()['Streaming_History_Audio_0.json'][1:] == gdpr_export._file_fingerprint(path)
+
+    # A newer export of the same name, the old offset points into the middle of its plays
+    write_gdpr_file(gdpr_folder, 'Streaming_History_Audio_0.json', [gdpr_entry(timestamp(i), f'track{i}') for i in range(30, 90)])
+    with caplog.at_level(logging.WARNING):
+        gdpr_export.export_gdpr_data(import_db, n_limit=None)
+
+    assert count(import_db, Table.PLAYS) == 90
+    assert any('changed since its import checkpoint' in record.getMessage() for record in caplog.records)
+
+
+def test_unknown_tracks_are_mapped_without_ids_and_imported(gdpr_folder, import_db, monkeypatch):
+    sent = []
+
+    def get_multiple_field_information(bearer_token, api_type, limit, *ids):
+        sent.append(ids)
+        # The api answers unknown ids with null
+        return {'tracks': [None if track_id.startswith('unknown') else
+                           {'id': track_id, 'album': {'id': f'album_{track_id}'}, 'artists': [{'id': f'artist_{track_id}'}]}
+                           for track_id in ids]}
+
+    monkeypatch.setattr(gdpr_export, 'get_multiple_field_information', get_multiple_field_information)
+    monkeypatch.setattr(gdpr_export, 'simple_authenticate', lambda: 'token')
+    path = write_gdpr_file(gdpr_folder, 'Streaming_History_Audio_0.json',
+                           [gdpr_entry(timestamp(i), f'unknown{i}' if i % 3 == 0 else f'new{i}') for i in range(30)])
+
+    gdpr_export.export_gdpr_data(import_db, n_limit=None)
+
+    assert count(import_db, Table.PLAYS) == 30
+    assert import_db.cursor.execute(f"SELECT COUNT(*) FROM {Table.PLAYS.value} WHERE artist_key IS NULL").fetchone() == (10,)
+    assert import_db.get_import_checkpoints()['Streaming_History_Audio_0.json'][0] == os.path.getsize(path) - 1
+    assert gdpr_export._unresolved_track_ids(import_db, [f'unknown{i}' for i in range(0, 30, 3)]) == []
+
+    sent.clear()
+    gdpr_export.export_gdpr_data(import_db, n_limit=None)
+    assert sent == []
+
+
+def test_tracks_of_a_failed_request_are_requested_again(monkeypatch):
+    db = Database(':memory:')
+    monkeypatch.setattr(gdpr_export, 'get_multiple_field_information', lambda bearer_token, api_type, limit, *ids: None)
+
+    gdpr_export._populate_ids(db, ['track0', 'track1'], 'token')
+
+    assert gdpr_export._unresolved_track_ids(db, ['track0', 'track1']) == ['track0', 'track1']
@@ -0,0 +1,146 @@
+import time
+
+import requests
+
+import http_client
+from http_client import HttpClient, RequestScheduler
+
+
+def make_response(status_code, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response.closed = False
+
+    def close():
+        response.closed = True
+
+    response.close = close
+    return response
+
+
+class FakeSession:
+    """Stands in for the session of a client, answering with the given responses and recording the requests"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.sent = []
+        self.headers = {}
+
+    def request(self, method, url, headers=None, **kwargs):
+        self.sent.append((method, url, headers, kwargs))
+        return self.responses.pop(0)
+
+
+def make_client(responses, **kwargs):
+    client = HttpClient(backoff=0, scheduler=RequestScheduler(rate=1000, burst=1000), **kwargs)
+    client.session = FakeSession(responses)
+    return client
+
+
+def test_session_pool_is_sized():
+    client = HttpClient(pool_size=7)
+    adapter = client.session.get_adapter('https://api.spotify.com')
+
+    assert adapter._pool_connections == 7
+    assert adapter._pool_maxsize == 7
+    client.close()
+
+
+def test_requests_share_one_session():
+    client = make_client([make_response(200), make_response(200)])
+
+    client.get('https://api.spotify.com/v1/tracks/1')
+    client.get('https://api.spotify.com/v1/tracks/2')
+
+    assert [url for _, url, _, _ in client.session.sent] == ['https://api.spotify.com/v1/tracks/1', 'https://api.spotify.com/v1/tracks/2']
+
+
+def test_bearer_token_of_a_request_overrides_the_default():
+    client = make_client([make_response(200)], bearer_token='default')
+
+    client.get('https://api.spotify.com/v1/me', bearer_token='override', timeout=3)
+
+    _, _, headers, kwargs = client.session.sent[0]
+    assert headers['Authorization'] == 'Bearer override'
+    assert kwargs['timeout'] == 3
+
+
+def test_shared_client_is_replaced_by_configure_client(monkeypatch):
+    monkeypatch.setattr(http_client, '_client', None)
+
+    client = http_client.get_client()
+    assert http_client.get_client() is client
+
+    configured = http_client.configure_client(pool_size=3, timeout=5)
+    assert http_client.get_client() is configured is not client
+    assert configured.timeout == 5
+    configured.close()
+
+
+def test_throttled_request_is_retried_after_retry_after():
+    throttled = make_response(429, {'Retry-After': '0'})
+    client = make_client([throttled, make_response(200)])
+
+    response = client.get('https://api.spotify.com/v1/tracks')
+
+    assert response.status_code == 200
+    assert throttled.closed
+    assert client.scheduler.stats()['throttled_responses'] == 1
+
+
+def test_throttling_on_the_last_attempt_pauses_the_scheduler():
+    client = make_client([make_response(429, {'Retry-After': '0'})] * 3, max_retries=2)
+
+    response = client.get('https://api.spotify.com/v1/tracks')
+
+    assert response.status_code == 429
+    assert client.scheduler.stats()['throttled_responses'] == 3
+    assert len(client.session.sent) == 3
+
+
+def test_server_errors_are_retried_and_closed():
+    failed = make_response(503)
+    client = make_client([failed, make_response(200)])
+
+    assert client.get('https://api.spotify.com/v1/tracks').status_code == 200
+    assert failed.closed
+
+
+def test_post_is_not_retried():
+    client = make_client([make_response(503), make_response(200)])
+
+    assert client.post('https://accounts.spotify.com/api/token').status_code == 503
+    assert len(client.session.sent) == 1
+
+
+def test_throttle_halves_the_rate_and_success_raises_it():
+    scheduler = RequestScheduler(rate=8, min_rate=1, max_rate=8.2)
+
+    scheduler.throttle(0)
+    assert scheduler.rate == 4
+    scheduler.success()
+    assert scheduler.rate == 4.1
+
+
+def test_pacing_is_not_counted_as_throttling():
+    scheduler = RequestScheduler(rate=200, burst=1)
+
+    for _ in range(5):
+        scheduler.acquire()
+
+    stats = scheduler.stats()
+    assert stats['requests'] == 5
+    assert stats['throttled_seconds'] == 0
+    assert stats['paced_seconds'] > 0
+
+
+def test_throttling_blocks_acquire():
+    scheduler = RequestScheduler(rate=1000, burst=10)
+
+    scheduler.throttle(0.05)
+    start = time.monotonic()
+    scheduler.acquire()
+
+    assert time.monotonic() - start >= 0.04
+    assert scheduler.stats()['throttled_seconds'] > 0
@@ -0,0 +1,52 @@
+import math
+
+import pytest
+
+from id_batches import ENDPOINT_LIMITS, endpoint_limit, iter_id_batches
+
+
+@pytest.mark.parametrize('n_ids', [0, 1, 49, 50, 51, 99, 100, 101, 1000])
+@pytest.mark.parametrize('limit', [20, 50, 100])
+def test_batches_are_full(n_ids, limit):
+    ids = [f'id{i}' for i in range(n_ids)]
+
+    batches = list(iter_id_batches(ids, limit))
+
+    assert len(batches) == math.ceil(n_ids / limit)
+    assert all(len(batch) == limit for batch in batches[:-1])
+    assert [id_value for batch in batches for id_value in batch] == ids
+
+
+def test_duplicates_do_not_take_a_place_in_a_batch():
+    ids = [f'id{i % 120}' for i in range(1000)]
+
+    batches = list(iter_id_batches(ids, 50))
+
+    assert [len(batch) for batch in batches] == [50, 50, 20]
+    assert len({id_value for batch in batches for id_value in batch}) == 120
+
+
+def test_ids_are_consumed_lazily():
+    consumed = []
+
+    def ids():
+        for i in range(1000):
+            consumed.append(i)
+            yield f'id{i}'
+
+    next(iter_id_batches(ids(), 50))
+
+    assert len(consumed) == 50
+
+
+def test_endpoint_limits():
+    assert endpoint_limit('tracks') == 50
+    assert endpoint_limit('artists') == 50
+    assert endpoint_limit('albums') == 20
+    assert endpoint_limit('audio-features') == 100
+    assert set(ENDPOINT_LIMITS) == {'tracks', 'artists', 'albums', 'audio-features'}
+
+
+def test_limit_has_to_be_positive():
+    with pytest.raises(ValueError):
+        list(iter_id_batches(['id'], 0))
@@ -0,0 +1,94 @@
+import sqlite3
+
+import pytest
+
+from database_handler import Database, Table
+from id_dictionary import ID_DICTIONARY_TABLE, IdDictionary
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.execute(f"CREATE TABLE {ID_DICTIONARY_TABLE} (id_key INTEGER PRIMARY KEY, spotify_id TEXT UNIQUE)")
+    yield conn
+    conn.close()
+
+
+def test_keys_are_dense_and_stable(conn):
+    ids = IdDictionary(conn)
+    assert ids.intern_many(['a', 'b', None, 'a', 'c']) == [0, 1, None, 0, 2]
+    assert ids.spotify_id(1) == 'b'
+    assert ids.spotify_id(None) is None
+    assert ids.key('d') is None
+
+    assert ids.flush() == 3
+    assert ids.flush() == 0
+    conn.commit()
+
+    reloaded = IdDictionary(conn)
+    assert reloaded.ids == ['a', 'b', 'c']
+    assert reloaded.intern('d') == 3
+
+
+def test_reload_drops_ids_which_were_never_written(conn):
+    ids = IdDictionary(conn)
+    ids.intern('a')
+    ids.flush()
+    conn.commit()
+
+    ids.intern('b')
+    ids.flush()
+    conn.rollback()
+    ids.reload()
+
+    assert ids.ids == ['a']
+    assert ids.intern('c') == 1
+
+
+def test_rolled_back_transaction_drops_its_ids(db):
+    db.add_rows(Table.RECENTLY_PLAYED, [('2025-01-01T00:00:00Z', 'track1', 'artist1', 'album1')])
+    n_ids = len(db.ids)
+
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            db.add_rows(Table.RECENTLY_PLAYED, [('2025-01-01T00:01:00Z', 'track2', 'artist2', 'album2')])
+            raise RuntimeError
+
+    assert len(db.ids) == n_ids
+    assert db.ids.key('track2') is None
+    # The keys freed by the rollback are assigned again without conflicts
+    db.add_rows(Table.RECENTLY_PLAYED, [('2025-01-01T00:02:00Z', 'track3', 'artist3', 'album3')])
+    assert db.read_all_rows(Table.RECENTLY_PLAYED, 'track_id') == [('track1',), ('track3',)]
+
+
+def test_recently_played_table_is_migrated_to_integer_keys(tmp_path):
+    path = str(tmp_path / 'old.db')
+    conn = sqlite3.connect(path)
+    conn.execute(f'''
+    CREATE TABLE {Table.RECENTLY_PLAYED.value} (
+        played_at TIMESTAMP PRIMARY KEY,
+        track_id TEXT,
+        artist_id TEXT,
+        album_id TEXT
+    )''')
+    rows = [(f'2025-01-01T00:00:{i:02d}Z', f'track{i % 4}', f'artist{i % 2}', None if i == 3 else f'album{i % 3}') for i in range(10)]
+    conn.executemany(f"INSERT INTO {Table.RECENTLY_PLAYED.value} VALUES (?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+    db = Database(path)
+    try:
+        table_type = db.cursor.execute("SELECT type FROM sqlite_master WHERE name = ?", (Table.RECENTLY_PLAYED.value,)).fetchone()[0]
+        assert table_type == 'view'
+        assert db.read_all_rows(Table.RECENTLY_PLAYED, 'played_at, track_id, artist_id, album_id') == rows
+        assert db.cursor.execute(f"SELECT COUNT(*) FROM {Table.PLAYS.value}").fetchone()[0] == 10
+        assert sorted(spotify_id for spotify_id in db.ids.ids) == sorted({value for row in rows for value in row[1:] if value})
+    finally:
+        db.close('test')
+
+    # Opening the migrated database again keeps the plays
+    db = Database(path)
+    try:
+        assert len(db.read_all_rows(Table.RECENTLY_PLAYED)) == 10
+    finally:
+        db.close('test')
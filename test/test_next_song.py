@@ -0,0 +1,59 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from ai_analysis.next_song import NextSongModel
+from database_handler import Table
+
+START = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+def play(minutes, track, artist='artist'):
+    return ((START + timedelta(minutes=minutes)).strftime('%Y-%m-%dT%H:%M:%SZ'), track, artist, 'album')
+
+
+def test_transitions_are_counted_within_sessions(db):
+    # The gap of two hours before the last play starts a new session
+    db.add_rows(Table.RECENTLY_PLAYED, [play(0, 'a'), play(3, 'b'), play(6, 'a'), play(9, 'c'), play(12, 'a'), play(15, 'b'),
+                                        play(135, 'c')])
+    model = NextSongModel()
+
+    assert model.update(db) == 7
+
+    assert model.predict_next('a') == [('b', pytest.approx(2 / 3)), ('c', pytest.approx(1 / 3))]
+    assert model.predict_next('b') == [('a', 1.0)]
+    assert model.predict_next('c') == [('a', 1.0)]
+    assert model.predict_next('unknown') == []
+    assert model.predict_next('a', k=1) == [('b', pytest.approx(2 / 3))]
+
+
+def test_incremental_updates_equal_a_full_update(db):
+    plays = [play(3 * i, f'track{i * 7 % 5}', f'artist{i % 3}') for i in range(40)]
+    incremental = NextSongModel(top_k=3)
+    for start in range(0, 40, 9):
+        db.add_rows(Table.RECENTLY_PLAYED, plays[start:start + 9])
+        incremental.update(db, chunk_size=4)
+
+    full = NextSongModel(top_k=3)
+    full.update(db)
+
+    assert incremental.tracks.index == full.tracks.index
+    assert incremental.artists.index == full.artists.index
+    assert incremental.update(db) == 0
+
+
+def test_saved_model_continues_where_it_stopped(db, tmp_path):
+    path = str(tmp_path / 'model.pkl')
+    assert NextSongModel.load(path, top_k=5).tracks.top_k == 5
+
+    db.add_rows(Table.RECENTLY_PLAYED, [play(0, 'a'), play(3, 'b')])
+    model = NextSongModel()
+    model.update(db)
+    model.save(path)
+
+    db.add_rows(Table.RECENTLY_PLAYED, [play(6, 'c')])
+    loaded = NextSongModel.load(path)
+    assert loaded.update(db) == 1
+    assert loaded.predict_next('b') == [('c', 1.0)]
+    assert loaded.predict_batch([['a'], ['x', 'b'], []]) == [[('b', 1.0)], [('c', 1.0)], []]
+    assert loaded.predict_next_artist('artist') == [('artist', 1.0)]
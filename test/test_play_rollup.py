@@ -0,0 +1,111 @@
+from collections import Counter
+
+import pytest
+
+from database_handler import Database, Table
+
+
+def play_rows():
+    # Plays spread over three months, two of them on the same day
+    return [(f'2025-0{month}-{day:02d}T12:{minute:02d}:00Z', f'track{(month + day) % 3}', f'artist{day % 2}', 'album')
+            for month in (1, 2, 3) for day in (1, 15, 28) for minute in range(month)]
+
+
+def durations():
+    return {'track0': 1000, 'track1': 2000, 'track2': 3000}
+
+
+def expected_totals(rows, period_length):
+    counts = Counter(row[0][:period_length] for row in rows)
+    listened = Counter()
+    for row in rows:
+        listened[row[0][:period_length]] += durations()[row[1]]
+    return [(bucket, counts[bucket], listened[bucket]) for bucket in sorted(counts)]
+
+
+def track_rows():
+    return [(track_id, track_id, duration, False, 1) for track_id, duration in durations().items()]
+
+
+def test_totals_are_counted_on_insert(db):
+    db.add_rows(Table.TRACK_INFORMATION, track_rows())
+    db.add_rows(Table.RECENTLY_PLAYED, play_rows())
+
+    assert db.get_play_totals('month') == expected_totals(play_rows(), 7)
+    assert db.get_play_totals('day') == expected_totals(play_rows(), 10)
+    assert db.get_play_totals('month', start='2025-02', end='2025-02') == expected_totals(play_rows(), 7)[1:2]
+    assert sum(row[1] for row in db.get_play_totals('week')) == len(play_rows())
+
+
+def test_durations_saved_after_the_plays_are_added_to_the_totals(db):
+    db.add_rows(Table.RECENTLY_PLAYED, play_rows())
+    assert {row[2] for row in db.get_play_totals('month')} == {0}
+
+    db.add_rows(Table.TRACK_INFORMATION, track_rows())
+
+    assert db.get_play_totals('month') == expected_totals(play_rows(), 7)
+    assert db.get_play_totals('day') == expected_totals(play_rows(), 10)
+
+
+def test_top_tracks_of_every_bucket(db):
+    db.add_rows(Table.TRACK_INFORMATION, track_rows())
+    db.add_rows(Table.RECENTLY_PLAYED, play_rows())
+
+    counts = Counter(row[1] for row in play_rows())
+    top = db.get_top('track_id', 'month', limit=None)
+    assert [(track_id, play_count) for track_id, play_count, _ in top] == counts.most_common()
+    assert all(estimated_ms == play_count * durations()[track_id] for track_id, play_count, estimated_ms in top)
+
+    per_bucket = db.get_top('artist_id', 'month', limit=1, per_bucket=True)
+    assert [bucket for bucket, _, _, _ in per_bucket] == ['2025-01', '2025-02', '2025-03']
+
+
+def test_rollups_and_totals_of_an_older_database_are_backfilled(tmp_path):
+    path = str(tmp_path / 'test.db')
+    db = Database(path)
+    db.add_rows(Table.TRACK_INFORMATION, track_rows())
+    db.add_rows(Table.RECENTLY_PLAYED, play_rows())
+    expected_rollup = db.cursor.execute(f"SELECT * FROM {Table.PLAY_ROLLUP.value} ORDER BY 1, 2, 3, 4, 5").fetchall()
+
+    # A database created before the rollups
+    db.cursor.execute(f"DELETE FROM {Table.PLAY_ROLLUP.value}")
+    db.cursor.execute(f"DROP TABLE {Table.PLAY_TOTALS.value}")
+    db.conn.commit()
+    db.close('test')
+
+    db = Database(path)
+    try:
+        assert db.cursor.execute(f"SELECT * FROM {Table.PLAY_ROLLUP.value} ORDER BY 1, 2, 3, 4, 5").fetchall() == expected_rollup
+        assert db.get_play_totals('month') == expected_totals(play_rows(), 7)
+
+        # Plays added later are counted when they are inserted
+        db.add_rows(Table.RECENTLY_PLAYED, [('2025-04-01T00:00:00Z', 'track0', 'artist0', 'album')])
+        assert db.get_play_totals('month')[-1] == ('2025-04', 1, 1000)
+    finally:
+        db.close('test')
+
+
+def test_every_insert_path_counts_each_new_play_once(db):
+    db.add_rows(Table.TRACK_INFORMATION, track_rows())
+    rows = play_rows()
+    db.add_rows(Table.RECENTLY_PLAYED, rows[:5])
+    # A batch with a duplicate is inserted row by row, the duplicate is not counted again
+    db.add_rows(Table.RECENTLY_PLAYED, rows[4:10])
+    db.add_rows(Table.RECENTLY_PLAYED, rows[:12], ignore_duplicates=True)
+    db.add_row(Table.RECENTLY_PLAYED, rows[12])
+    db.add_row(Table.RECENTLY_PLAYED, rows[12])
+    db.add_plays_with_events(rows[10:], [(row[0], 0, 'AT', 0, 0, 0, 0) for row in rows[10:]])
+
+    assert db.get_play_totals('month') == expected_totals(rows, 7)
+    week = db.get_play_totals('week')
+    assert sum(row[1] for row in week) == len(rows)
+    assert sum(row[2] for row in week) == sum(durations()[row[1]] for row in rows)
+
+
+def test_failed_batch_is_not_counted(db):
+    db.add_rows(Table.RECENTLY_PLAYED, play_rows()[:3])
+
+    with pytest.raises(Exception):
+        db.add_plays_with_events(play_rows()[3:6], [(None,)] * 3)
+
+    assert db.get_play_totals('month') == [('2025-01', 3, 0)]
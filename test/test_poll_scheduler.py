@@ -0,0 +1,74 @@
+import pytest
+
+import poll_scheduler
+from poll_scheduler import MIN_PLAY_SECONDS, RECENTLY_PLAYED_WINDOW, PollScheduler
+
+
+def test_interval_is_capped_at_the_time_the_window_needs_to_overflow():
+    scheduler = PollScheduler(min_interval=10, max_interval=10 ** 6)
+    assert scheduler.max_interval == RECENTLY_PLAYED_WINDOW * MIN_PLAY_SECONDS
+
+
+def test_idle_polls_wait_the_maximal_interval():
+    scheduler = PollScheduler(min_interval=60, max_interval=1200)
+    assert scheduler.record_poll(0, elapsed=600, latency=0.1) == 1200
+
+
+def test_interval_follows_the_play_rate():
+    scheduler = PollScheduler(min_interval=60, max_interval=1500, smoothing=1.0)
+    # One play every 20 seconds fills half the window in 500 seconds
+    assert scheduler.record_poll(30, elapsed=600, latency=0.1) == pytest.approx(500)
+    assert scheduler.record_poll(1, elapsed=10 ** 4, latency=0.1) == 1500
+    assert scheduler.record_poll(49, elapsed=49, latency=0.1) == 60
+
+
+def test_full_window_polls_again_after_the_minimal_interval(caplog):
+    scheduler = PollScheduler(min_interval=60, max_interval=1500)
+    assert scheduler.record_poll(RECENTLY_PLAYED_WINDOW, elapsed=10 ** 4, latency=0.1) == 60
+    assert 'may have been missed' in caplog.text
+
+
+def test_backfill_is_due_only_after_new_plays_and_the_interval(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(poll_scheduler.time, 'monotonic', lambda: now[0])
+    scheduler = PollScheduler(backfill_interval=3600)
+
+    now[0] += 4000
+    assert not scheduler.backfill_due()
+
+    scheduler.record_poll(3, elapsed=300, latency=0.1)
+    assert scheduler.backfill_due()
+
+    scheduler.record_backfill()
+    scheduler.record_poll(3, elapsed=300, latency=0.1)
+    assert not scheduler.backfill_due()
+    now[0] += 3600
+    assert scheduler.backfill_due()
+
+
+def test_run_polls_and_backfills_between_sleeps(monkeypatch):
+    now = [0.0]
+    sleeps = []
+
+    class Stop(Exception):
+        pass
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+        if len(sleeps) == 4:
+            raise Stop
+
+    monkeypatch.setattr(poll_scheduler.time, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(poll_scheduler.time, 'sleep', sleep)
+
+    plays = iter([5, 0, 0, 0])
+    backfills = []
+    scheduler = PollScheduler(min_interval=60, max_interval=1200, backfill_interval=0)
+
+    with pytest.raises(Stop):
+        scheduler.run(lambda: next(plays), lambda: backfills.append(now[0]))
+
+    # Only the poll which added plays triggers a backfill, the idle polls wait the maximal interval
+    assert len(backfills) == 1
+    assert sleeps[1:] == [1200, 1200, 1200]
@@ -0,0 +1,119 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from prediction_server import PredictionServer
+
+
+class Model:
+    """Predicts the successors of the last track of a history, counting its calls"""
+
+    def __init__(self):
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def predict_batch(self, histories, k):
+        with self.lock:
+            self.batches.append(len(histories))
+        return [[(f'{history[-1]}-next{i}', 1 / (i + 1)) for i in range(k)] for history in histories]
+
+
+@pytest.fixture
+def model():
+    return Model()
+
+
+@pytest.fixture
+def server(model):
+    server = PredictionServer(model.predict_batch, port=0, batch_window=0.05).start()
+    yield server
+    server.stop()
+
+
+def get(server, path):
+    host, port = server.address
+    try:
+        with urllib.request.urlopen(f'http://{host}:{port}{path}', timeout=5) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_predictions_are_served_over_http(server):
+    status, body = get(server, '/predict?track_id=a&track_id=b&k=2')
+
+    assert status == 200
+    assert body == {'track_id': 'b', 'predictions': [{'track_id': 'b-next0', 'probability': 1.0},
+                                                     {'track_id': 'b-next1', 'probability': 0.5}]}
+
+
+@pytest.mark.parametrize('path', ['/predict', '/predict?track_id=a&k=0', '/predict?track_id=a&k=x', '/predict?track_id=a&k=101'])
+def test_invalid_requests_are_rejected(server, path):
+    assert get(server, path)[0] == 400
+
+
+def test_unknown_path_is_not_found(server):
+    assert get(server, '/unknown')[0] == 404
+
+
+def test_concurrent_requests_are_batched(server, model):
+    results = {}
+    barrier = threading.Barrier(16)
+
+    def request(i):
+        barrier.wait()
+        results[i] = server.predict((f'track{i}',), 3)
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == {i: [(f'track{i}-next{j}', 1 / (j + 1)) for j in range(3)] for i in range(16)}
+    assert sum(model.batches) == 16
+    assert len(model.batches) < 16
+    assert server.stats()['mean_batch_size'] > 1
+
+
+def test_results_are_cached_until_cleared(server, model):
+    server.predict(('a',), 5)
+    assert server.predict(('a',), 5) == server.predict(('a',), 5)
+    assert len(model.batches) == 1
+
+    server.clear_cache()
+    server.predict(('a',), 5)
+    assert len(model.batches) == 2
+
+    stats = server.stats()
+    assert stats['requests'] == 4
+    assert stats['cache_hits'] == 2
+    assert 'p50_ms' in stats and 'p99_ms' in stats
+
+
+def test_failed_batch_is_reported_to_every_request():
+    def predict_batch(histories, k):
+        raise RuntimeError('model failed')
+
+    server = PredictionServer(predict_batch, port=0).start()
+    try:
+        with pytest.raises(RuntimeError):
+            server.predict(('a',), 1)
+        status, body = get(server, '/predict?track_id=a')
+        assert status == 500
+        assert body == {'error': 'model failed'}
+    finally:
+        server.stop()
+
+
+@pytest.mark.parametrize('n, p50, p99', [(1, 1.0, 1.0), (50, 25.5, 50.0), (100, 50.5, 99.0), (200, 100.5, 198.0)])
+def test_latency_percentiles_use_the_nearest_rank(server, n, p50, p99):
+    server.latencies.extend((i + 1) / 1000 for i in reversed(range(n)))
+
+    stats = server.stats()
+
+    assert stats['p50_ms'] == p50
+    assert stats['p99_ms'] == p99
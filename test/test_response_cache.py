@@ -0,0 +1,97 @@
+import time
+
+import pytest
+
+import response_cache
+import spotify_api
+from response_cache import ResponseCache
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = ResponseCache(':memory:')
+    monkeypatch.setattr(response_cache, '_cache', cache)
+    yield cache
+    cache.close()
+
+
+def test_cached_responses_are_returned(cache):
+    cache.put_many('tracks', {'a': {'id': 'a', 'name': 'A'}, 'b': {'id': 'b', 'name': 'B'}})
+
+    assert cache.get_many('tracks', ['a', 'b', 'c']) == {'a': {'id': 'a', 'name': 'A'}, 'b': {'id': 'b', 'name': 'B'}}
+    assert cache.get('albums', 'a') is None
+    assert cache.stats() == {'hits': 2, 'misses': 2, 'hit_rate': 0.5}
+
+
+def test_stale_entries_are_misses(cache):
+    cache.put('tracks', 'a', {'id': 'a'})
+    cache.ttl = 0
+
+    assert cache.get('tracks', 'a') is None
+
+
+def test_least_recently_used_entries_are_evicted(cache):
+    cache.max_entries = 2
+    cache.put('tracks', 'a', {'id': 'a'})
+    time.sleep(0.01)
+    cache.put('tracks', 'b', {'id': 'b'})
+    time.sleep(0.01)
+    cache.get('tracks', 'a')
+    time.sleep(0.01)
+
+    cache.put('tracks', 'c', {'id': 'c'})
+
+    assert set(cache.get_many('tracks', ['a', 'b', 'c'])) == {'a', 'c'}
+
+
+def test_entry_count_is_kept_without_scanning(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache = ResponseCache(path, max_entries=3)
+    cache.put_many('tracks', {'a': {}, 'b': {}})
+    # Replacing an entry does not grow the cache, the same id of another endpoint does
+    cache.put_many('tracks', {'a': {'name': 'A'}})
+    cache.put_many('albums', {'a': {}})
+    assert cache.n_entries == 3
+    cache.close()
+
+    cache = ResponseCache(path, max_entries=3)
+    assert cache.n_entries == 3
+    cache.put_many('tracks', {'c': {}, 'd': {}})
+    assert cache.n_entries == cache.conn.execute('SELECT COUNT(*) FROM response_cache').fetchone()[0] == 3
+    cache.close()
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class FakeClient:
+    """Answers the multiple ids endpoints with one entry per requested id"""
+
+    def __init__(self):
+        self.urls = []
+
+    def get(self, url, bearer_token=None):
+        self.urls.append(url)
+        ids = url.split('ids=')[1].split(',')
+        return FakeResponse({'tracks': [{'id': track_id} for track_id in ids]})
+
+
+def test_only_cache_misses_are_requested(cache, monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(spotify_api, 'get_client', lambda: client)
+    cache.put('tracks', 'a', {'id': 'a'})
+
+    response = spotify_api.get_multiple_field_information('token', 'tracks', 50, 'a', 'b', 'c')
+
+    assert client.urls == ['https://api.spotify.com/v1/tracks?ids=b,c']
+    assert sorted(entry['id'] for entry in response['tracks']) == ['a', 'b', 'c']
+
+    spotify_api.get_multiple_field_information('token', 'tracks', 50, 'a', 'b', 'c')
+    assert len(client.urls) == 1
@@ -0,0 +1,202 @@
+import math
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from itertools import chain
+
+import pytest
+
+import scraper
+from database_handler import Table
+
+
+class MissingIdsDatabase:
+    """Stands in for the database, returning the same missing ids for every table"""
+
+    def __init__(self, ids):
+        self.ids = ids
+
+    def iter_missing_ids(self, table, id_field):
+        return iter(self.ids)
+
+
+@pytest.fixture
+def requests(monkeypatch):
+    """Record the ids of every metadata request instead of sending it"""
+    sent = []
+
+    def get_multiple_field_information(bearer_token, api_type, limit, *ids):
+        assert len(ids) <= limit
+        sent.append((api_type, ids))
+        return None
+
+    monkeypatch.setattr(scraper, 'get_multiple_field_information', get_multiple_field_information)
+    monkeypatch.setattr(scraper, '_add_data_to_database', lambda db, table_name, response, ids: None)
+    return sent
+
+
+@pytest.mark.parametrize('n_ids', [1, 19, 20, 21, 49, 50, 51, 100, 101, 1234])
+def test_missing_infos_are_requested_in_full_batches(requests, n_ids):
+    # Every id is missing twice, as a track played twice is returned twice
+    db = MissingIdsDatabase([f'id{i}' for i in range(n_ids)] * 2)
+    batches = [
+        scraper._missing_info_batches(db, Table.TRACK_INFORMATION, 'track_id', 'tracks'),
+        scraper._missing_info_batches(db, Table.ALBUM_INFORMATION, 'album_id', 'albums'),
+        scraper._missing_info_batches(db, Table.ARTIST_INFORMATION, 'artist_id', 'artists'),
+        scraper._missing_info_batches(db, Table.TRACK_ATTRIBUTES, 'track_id', 'audio-features'),
+    ]
+
+    scraper._process_missing_info(db, 'token', chain(*batches))
+
+    for endpoint_name, limit in [('tracks', 50), ('albums', 20), ('artists', 50), ('audio-features', 100)]:
+        sent = [ids for api_type, ids in requests if api_type == endpoint_name]
+        assert len(sent) == math.ceil(n_ids / limit)
+        assert all(len(ids) == limit for ids in sent[:-1])
+        assert sorted(id_value for ids in sent for id_value in ids) == sorted(f'id{i}' for i in range(n_ids))
+
+
+def test_round_robin_interleaves_the_entity_types():
+    assert list(scraper._round_robin('aaa', 'b', 'cc')) == ['a', 'b', 'c', 'a', 'c', 'a']
+
+
+def test_concurrent_backfill_bounds_requests_and_writes_from_one_thread(monkeypatch):
+    lock = threading.Lock()
+    in_flight = [0]
+    max_in_flight = [0]
+    writer_threads = set()
+    saved = []
+
+    def get_multiple_field_information(bearer_token, api_type, limit, *ids):
+        with lock:
+            in_flight[0] += 1
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+        time.sleep(0.01)
+        with lock:
+            in_flight[0] -= 1
+        return ids
+
+    def add_data_to_database(db, table_name, response, ids):
+        writer_threads.add(threading.get_ident())
+        saved.extend(response)
+
+    monkeypatch.setattr(scraper, 'get_multiple_field_information', get_multiple_field_information)
+    monkeypatch.setattr(scraper, '_add_data_to_database', add_data_to_database)
+    db = MissingIdsDatabase([f'id{i}' for i in range(500)])
+
+    scraper._process_missing_info_concurrently(db, 'token', scraper._missing_info_batches(db, Table.ALBUM_INFORMATION, 'album_id', 'albums'), 4)
+
+    assert sorted(saved) == sorted(f'id{i}' for i in range(500))
+    assert 1 < max_in_flight[0] <= 4
+    assert writer_threads == {threading.get_ident()}
+
+
+def track_entry(i):
+    return {'id': f'track{i}', 'name': f'title{i}', 'duration_ms': 1000, 'explicit': False, 'popularity': 1,
+            'artists': [{'id': f'artist{i}'}], 'album': {'id': f'album{i}'}}
+
+
+def test_tracks_returned_as_null_are_saved_without_information(db):
+    scraper._add_data_to_database(db, Table.TRACK_INFORMATION, {'tracks': [None, track_entry(1)]}, ('track0', 'track1'))
+
+    rows = db.cursor.execute(f"SELECT track_id, title FROM {Table.TRACK_INFORMATION.value} ORDER BY track_id").fetchall()
+    assert rows == [('track0', None), ('track1', 'title1')]
+
+
+def test_backfill_requests_unknown_tracks_once(monkeypatch, db):
+    db.add_rows(Table.RECENTLY_PLAYED, [(f'2025-01-01T00:00:0{i}Z', f'track{i}', None, None) for i in range(2)])
+    sent = []
+
+    def get_multiple_field_information(bearer_token, api_type, limit, *ids):
+        sent.append(ids)
+        return {'tracks': [None if id_value == 'track0' else track_entry(1) for id_value in ids]}
+
+    monkeypatch.setattr(scraper, 'simple_authenticate', lambda: 'token')
+    monkeypatch.setattr(scraper, 'get_multiple_field_information', get_multiple_field_information)
+    scraper.scrape_missing_infos(db)
+    scraper.scrape_missing_infos(db)
+
+    assert sent == [('track0', 'track1')]
+    assert list(db.iter_missing_ids(Table.TRACK_INFORMATION, 'track_id')) == []
+
+
+START = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+def played_at(i):
+    return (START + timedelta(minutes=i)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def epoch_ms(i):
+    return int((START + timedelta(minutes=i)).timestamp() * 1000)
+
+
+class RecentlyPlayedApi:
+    """Serves the plays of a history like /me/player/recently-played, the newest play first"""
+
+    def __init__(self, n_plays, limit=50):
+        self.n_plays = n_plays
+        self.limit = limit
+        self.urls = []
+
+    def __call__(self, bearer_token, url):
+        self.urls.append(url)
+        plays = list(range(self.n_plays))
+        if 'after=' in url:
+            after = int(url.split('after=')[1])
+            plays = [i for i in plays if epoch_ms(i) > after][:self.limit]
+        else:
+            plays = plays[-self.limit:]
+        items = [{'played_at': played_at(i),
+                  'track': {'id': f'track{i}', 'album': {'id': f'album{i}'}, 'artists': [{'id': f'artist{i}'}]}}
+                 for i in reversed(plays)]
+        cursors = {'after': str(epoch_ms(plays[-1])), 'before': str(epoch_ms(plays[0]))} if plays else None
+        # The next link is a before cursor, following it would walk back past the high-water mark
+        return {'items': items, 'limit': self.limit, 'cursors': cursors, 'next': f'{scraper.RECENTLY_PLAYED_URL}&before=0'}
+
+
+def played_tracks(db):
+    return [row[0] for row in db.cursor.execute(f"SELECT track_id FROM {Table.RECENTLY_PLAYED.value} ORDER BY played_at")]
+
+
+def test_first_poll_reads_one_page_and_stores_the_mark(monkeypatch, db):
+    api = RecentlyPlayedApi(80)
+    monkeypatch.setattr(scraper, 'get_last_played_track', api)
+
+    assert scraper._read_recently_played_page_and_add_to_db(db, 'token') == 50
+
+    assert api.urls == [scraper.RECENTLY_PLAYED_URL]
+    assert played_tracks(db) == [f'track{i}' for i in range(30, 80)]
+    assert db.get_state(scraper.RECENTLY_PLAYED_AFTER_KEY) == str(epoch_ms(79))
+
+
+def test_poll_pages_forward_from_the_mark(monkeypatch, db):
+    db.set_state(scraper.RECENTLY_PLAYED_AFTER_KEY, str(epoch_ms(9)))
+    api = RecentlyPlayedApi(130)
+    monkeypatch.setattr(scraper, 'get_last_played_track', api)
+
+    assert scraper._read_recently_played_page_and_add_to_db(db, 'token') == 120
+
+    assert api.urls == [f'{scraper.RECENTLY_PLAYED_URL}&after={epoch_ms(i)}' for i in (9, 59, 109)]
+    assert played_tracks(db) == [f'track{i}' for i in range(10, 130)]
+    assert db.get_state(scraper.RECENTLY_PLAYED_AFTER_KEY) == str(epoch_ms(129))
+
+
+def test_poll_without_new_plays_sends_a_single_request(monkeypatch, db):
+    db.set_state(scraper.RECENTLY_PLAYED_AFTER_KEY, str(epoch_ms(19)))
+    api = RecentlyPlayedApi(20)
+    monkeypatch.setattr(scraper, 'get_last_played_track', api)
+
+    assert scraper._read_recently_played_page_and_add_to_db(db, 'token') == 0
+
+    assert len(api.urls) == 1
+    assert db.get_state(scraper.RECENTLY_PLAYED_AFTER_KEY) == str(epoch_ms(19))
+
+
+def test_plays_at_or_below_the_mark_are_skipped(monkeypatch, db):
+    db.set_state(scraper.RECENTLY_PLAYED_AFTER_KEY, str(epoch_ms(14)))
+    api = RecentlyPlayedApi(20)
+    # An api ignoring the after cursor returns the plays before the mark as well
+    monkeypatch.setattr(scraper, 'get_last_played_track', lambda bearer_token, url: api(bearer_token, scraper.RECENTLY_PLAYED_URL))
+
+    assert scraper._read_recently_played_page_and_add_to_db(db, 'token') == 5
+    assert played_tracks(db) == [f'track{i}' for i in range(15, 20)]
@@ -0,0 +1,43 @@
+import numpy as np
+
+from ai_analysis.sequence_windows import build_windows
+
+MINUTE_MS = 60 * 1000
+
+
+def test_windows_slide_over_the_class_sequence():
+    played_at = np.arange(6, dtype=np.int64) * MINUTE_MS
+    tracks = np.array([5, 7, 5, 7, 5, 7], dtype=np.int32)
+
+    windows, indexes, keys = build_windows(played_at, tracks, window=2)
+
+    assert keys.tolist() == [-1, 5, 7]
+    assert windows.tolist() == [[1, 2, 1], [2, 1, 2], [1, 2, 1], [2, 1, 2]]
+    assert indexes.tolist() == [0, 1, 2, 3]
+
+
+def test_plays_are_sorted_by_time():
+    played_at = np.array([2, 0, 1, 3], dtype=np.int64) * MINUTE_MS
+    tracks = np.array([7, 5, 6, 5], dtype=np.int32)
+
+    windows, indexes, keys = build_windows(played_at, tracks, window=1, min_count=1)
+
+    assert [[keys[c] for c in windows[i]] for i in indexes] == [[5, 6], [6, 7], [7, 5]]
+
+
+def test_session_breaks_missing_and_rare_tracks_drop_windows():
+    # A session break after the third play, a missing track at the fifth and the rare track 9 at the end
+    played_at = np.array([0, 1, 2, 100, 101, 102, 103, 104], dtype=np.int64) * MINUTE_MS
+    tracks = np.array([5, 7, 5, 7, -1, 5, 7, 9], dtype=np.int32)
+
+    windows, indexes, keys = build_windows(played_at, tracks, window=1)
+
+    assert keys.tolist() == [-1, 5, 7]
+    assert [windows[i].tolist() for i in indexes] == [[1, 2], [2, 1], [1, 2]]
+    assert indexes.tolist() == [0, 1, 5]
+
+
+def test_history_shorter_than_a_window_has_no_windows():
+    windows, indexes, keys = build_windows(np.array([0], dtype=np.int64), np.array([5], dtype=np.int32), window=3)
+    assert windows.shape == (0, 4)
+    assert len(indexes) == 0
@@ -0,0 +1,82 @@
+import threading
+
+import requests
+
+from ai_analysis import spotify_preview
+from database_handler import Table
+
+PAGE = b'<html>' + b'x' * 50000 + b'"audioPreview": {"url": "https://p.scdn.co/mp3-preview/%s"}' + b'y' * 50000
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=b''):
+        self.status_code = status_code
+        self.body = body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f'{self.status_code} Error')
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+
+class FakeClient:
+    """Serves embed pages by track id: a preview, a page without preview, 404 or a server error"""
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.requested = []
+        self.lock = threading.Lock()
+
+    def get(self, url, stream=False):
+        track_id = url.rsplit('/', 1)[1]
+        with self.lock:
+            self.requested.append(track_id)
+        status = self.statuses.get(track_id, 200)
+        if status != 200:
+            return FakeResponse(status)
+        if track_id.startswith('nopreview'):
+            return FakeResponse(200, b'<html>' + b'x' * 50000)
+        return FakeResponse(200, PAGE % track_id.encode())
+
+
+def test_preview_url_is_found_across_chunks():
+    client = FakeClient({})
+    for chunk_size in (7, 1000, 16384):
+        assert spotify_preview._scan_preview_url(client, 'track1', chunk_size) == 'https://p.scdn.co/mp3-preview/track1'
+
+
+def test_page_without_preview_or_embed_page_has_no_preview():
+    client = FakeClient({'missing': 404})
+    assert spotify_preview._scan_preview_url(client, 'nopreview1') is None
+    assert spotify_preview._scan_preview_url(client, 'missing') is None
+
+
+def test_failed_fetch_is_logged(monkeypatch, caplog):
+    monkeypatch.setattr(spotify_preview, '_client', FakeClient({'broken': 500}))
+    assert spotify_preview.get_spotify_preview_url('broken') is None
+    assert 'Failed to fetch Spotify preview URL' in caplog.text
+
+
+def test_resolved_previews_and_misses_are_not_requested_again(db):
+    client = FakeClient({'missing': 404, 'broken': 500})
+    track_ids = ['track1', 'nopreview1', 'missing', 'broken', 'track1']
+
+    preview_urls = spotify_preview.resolve_preview_urls(track_ids, db, max_workers=4, client=client)
+
+    assert preview_urls == {'track1': 'https://p.scdn.co/mp3-preview/track1', 'nopreview1': None, 'missing': None}
+    assert sorted(client.requested) == ['broken', 'missing', 'nopreview1', 'track1']
+    assert sorted(db.read_all_rows(Table.PREVIEW_URL, 'track_id')) == [('missing',), ('nopreview1',), ('track1',)]
+
+    # Only the page which failed with a server error is requested again
+    client.requested.clear()
+    assert spotify_preview.resolve_preview_urls(track_ids, db, max_workers=4, client=client) == preview_urls
+    assert client.requested == ['broken']